@@ -0,0 +1,100 @@
+"""
+Static Asset Pipeline
+Fingerprints every file under static/ at startup so templates can link it by
+content hash and browsers can cache it forever. Text assets are pre-compressed
+with gzip (and brotli when the module is installed); the best encoding is
+picked per request from Accept-Encoding.
+"""
+
+import os
+import gzip
+import hashlib
+import mimetypes
+from typing import Dict, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "application/manifest+json", "image/svg+xml")
+
+# Preferred first
+ENCODINGS = ("br", "gzip")
+
+
+def accepted_encodings(header: str) -> Dict[str, float]:
+    """Parse an Accept-Encoding header into {coding: q}"""
+    accepted = {}
+    for part in header.split(","):
+        coding, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if coding:
+            accepted[coding.strip().lower()] = q
+    return accepted
+
+
+class Asset:
+    """One static file with its fingerprinted name and encoded variants"""
+
+    def __init__(self, name: str, data: bytes):
+        self.name = name
+        self.digest = hashlib.sha256(data).hexdigest()[:12]
+        self.etag = f'"{self.digest}"'
+        stem, dot, extension = name.rpartition(".")
+        self.fingerprinted = f"{stem}.{self.digest}.{extension}" if dot else f"{name}.{self.digest}"
+        self.content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+        self.variants = {"identity": data}
+        if self.content_type.startswith(COMPRESSIBLE_TYPES):
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(compressed) < len(data):
+                self.variants["gzip"] = compressed
+            if brotli:
+                compressed = brotli.compress(data, quality=11)
+                if len(compressed) < len(data):
+                    self.variants["br"] = compressed
+
+    def negotiate(self, accept_encoding: str) -> Tuple[str, bytes]:
+        """Return (content coding, body) of the smallest variant the client accepts"""
+        accepted = accepted_encodings(accept_encoding)
+        for coding in ENCODINGS:
+            if coding in self.variants and accepted.get(coding, accepted.get("*", 0)) > 0:
+                return coding, self.variants[coding]
+        return "identity", self.variants["identity"]
+
+
+class AssetPipeline:
+    """Fingerprinted view of a static directory, built once at startup"""
+
+    def __init__(self, directory: str, prefix: str = "/assets"):
+        self.directory = directory
+        self.prefix = prefix
+        self.assets: Dict[str, Asset] = {}
+        self.by_fingerprint: Dict[str, Asset] = {}
+
+        for root, _, files in os.walk(directory):
+            for file_name in sorted(files):
+                path = os.path.join(root, file_name)
+                name = os.path.relpath(path, directory).replace(os.sep, "/")
+                with open(path, "rb") as f:
+                    asset = Asset(name, f.read())
+                self.assets[name] = asset
+                self.by_fingerprint[asset.fingerprinted] = asset
+
+        combined = "".join(f"{name}:{asset.digest}" for name, asset in sorted(self.assets.items()))
+        self.version = hashlib.sha256(combined.encode()).hexdigest()[:12]
+
+    def url(self, name: str) -> str:
+        """Fingerprinted URL of a static file, falling back to its plain /static path"""
+        asset = self.assets.get(name)
+        return f"{self.prefix}/{asset.fingerprinted}" if asset else f"/static/{name}"
+
+    def get(self, fingerprinted: str) -> Optional[Asset]:
+        return self.by_fingerprint.get(fingerprinted)
@@ -0,0 +1,188 @@
+"""
+Telegram Gateway IPC
+One gateway process owns the Pyrogram session; HTTP worker processes talk to it
+over a Unix socket so the session is never duplicated (AUTH_KEY_DUPLICATED).
+
+Frames are a 4-byte big-endian length followed by a pickled dict. A request is
+{"op", "args", "kwargs"}; the gateway answers with one {"result"} frame, a
+series of {"item"} frames closed by {"end"}, or an {"error"} frame.
+"""
+
+import os
+import io
+import pickle
+import struct
+import asyncio
+import logging
+from typing import Dict, Callable, List
+
+logger = logging.getLogger(__name__)
+
+FRAME_HEADER = struct.Struct(">I")
+
+# Idle connections each worker keeps open to the gateway
+POOL_SIZE = 16
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Dict:
+    """Read one length-prefixed frame"""
+    header = await reader.readexactly(FRAME_HEADER.size)
+    (length,) = FRAME_HEADER.unpack(header)
+    return pickle.loads(await reader.readexactly(length))
+
+
+async def write_frame(writer: asyncio.StreamWriter, frame: Dict):
+    """Write one length-prefixed frame and wait for the socket buffer to drain"""
+    payload = pickle.dumps(frame, protocol=pickle.HIGHEST_PROTOCOL)
+    writer.write(FRAME_HEADER.pack(len(payload)))
+    writer.write(payload)
+    await writer.drain()
+
+
+def portable_error(e: Exception) -> Exception:
+    """Return the exception itself if it survives pickling, else a plain one with the same message"""
+    try:
+        pickle.loads(pickle.dumps(e))
+        return e
+    except Exception:
+        return RuntimeError(f"{type(e).__name__}: {e}")
+
+
+async def serve(path: str, handlers: Dict[str, Callable], streams: Dict[str, Callable]):
+    """
+    Serve gateway requests on a Unix socket until cancelled.
+
+    handlers are coroutine functions answered with a single result; streams
+    are async generator functions whose items are sent as they are produced.
+    """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request = await read_frame(reader)
+                except asyncio.IncompleteReadError:
+                    break
+
+                op = request["op"]
+                try:
+                    if op in streams:
+                        async for item in streams[op](*request["args"], **request["kwargs"]):
+                            await write_frame(writer, {"item": item})
+                        await write_frame(writer, {"end": True})
+                    elif op in handlers:
+                        result = await handlers[op](*request["args"], **request["kwargs"])
+                        await write_frame(writer, {"result": result})
+                    else:
+                        await write_frame(writer, {"error": ValueError(f"Unknown gateway op: {op}")})
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    # Worker went away mid-stream
+                    break
+                except Exception as e:
+                    await write_frame(writer, {"error": portable_error(e)})
+        except Exception as e:
+            logger.warning(f"Gateway connection error: {e}")
+        finally:
+            writer.close()
+
+    if os.path.exists(path):
+        os.unlink(path)
+
+    server = await asyncio.start_unix_server(handle, path=path)
+    os.chmod(path, 0o600)
+    logger.info(f"Gateway listening on {path}")
+
+    async with server:
+        await server.serve_forever()
+
+
+class GatewayClient:
+    """
+    Stand-in for pyrogram.Client inside HTTP workers.
+
+    Implements the subset of the Client API this app uses by forwarding each
+    call to the gateway process. Each call takes a pooled connection for its
+    whole duration, so streams never interleave on one socket.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.is_connected = False
+        self.pool: List = []
+
+    async def acquire(self):
+        if self.pool:
+            return self.pool.pop()
+        return await asyncio.open_unix_connection(self.path)
+
+    def release(self, conn):
+        if len(self.pool) < POOL_SIZE:
+            self.pool.append(conn)
+        else:
+            conn[1].close()
+
+    async def call(self, op: str, *args, **kwargs):
+        """Run a single-result op on the gateway"""
+        reader, writer = conn = await self.acquire()
+        try:
+            await write_frame(writer, {"op": op, "args": args, "kwargs": kwargs})
+            frame = await read_frame(reader)
+        except Exception:
+            writer.close()
+            raise
+        self.release(conn)
+
+        if "error" in frame:
+            raise frame["error"]
+        return frame["result"]
+
+    async def stream(self, op: str, *args, **kwargs):
+        """Run a streaming op on the gateway, yielding items as they arrive"""
+        reader, writer = conn = await self.acquire()
+        finished = False
+        try:
+            await write_frame(writer, {"op": op, "args": args, "kwargs": kwargs})
+            while True:
+                frame = await read_frame(reader)
+                if "item" in frame:
+                    yield frame["item"]
+                elif "end" in frame:
+                    finished = True
+                    return
+                else:
+                    finished = True
+                    raise frame["error"]
+        finally:
+            # A half-read stream leaves frames on the socket - never reuse it
+            if finished:
+                self.release(conn)
+            else:
+                writer.close()
+
+    async def start(self):
+        await self.call("ping")
+        self.is_connected = True
+
+    async def stop(self):
+        for _, writer in self.pool:
+            writer.close()
+        self.pool.clear()
+        self.is_connected = False
+
+    async def get_messages(self, *args, **kwargs):
+        return await self.call("get_messages", *args, **kwargs)
+
+    def get_chat_history(self, *args, **kwargs):
+        return self.stream("get_chat_history", *args, **kwargs)
+
+    def get_dialogs(self, *args, **kwargs):
+        return self.stream("get_dialogs", *args, **kwargs)
+
+    def stream_media(self, *args, **kwargs):
+        return self.stream("stream_media", *args, **kwargs)
+
+    async def download_media(self, message, file=None, in_memory: bool = False, **kwargs):
+        data = await self.call("download_media", message)
+        if file is not None:
+            file.write(data)
+            return file
+        return io.BytesIO(data)
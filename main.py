@@ -1,18 +1,43 @@
 import os
+import sys
 import logging
 import re
-from typing import AsyncGenerator, List, Dict
+import time
+import json
+import hmac
+import base64
+import bisect
+import hashlib
+import shutil
+import zlib
+import asyncio
+import mmap
+from urllib.parse import quote
+from html import escape
+from collections import OrderedDict, deque
+from itertools import islice
+from typing import AsyncGenerator, Awaitable, Callable, List, Dict, Optional, Tuple
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import StreamingResponse, HTMLResponse, Response
+from fastapi.responses import StreamingResponse, HTMLResponse, Response, JSONResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from pyrogram import Client
-from pyrogram.errors import RPCError
+from pydantic import BaseModel
+from pyrogram import Client, raw
+from pyrogram.errors import RPCError, AuthBytesInvalid
+from pyrogram.file_id import FileId, FileType
+from pyrogram.session import Session, Auth
 from pyrogram.types import Message
-import mimetypes
+import httpx
 from dotenv import load_dotenv
 from datetime import datetime
+from email.utils import formatdate
+from gateway import GatewayClient
+from assets import AssetPipeline
+import gateway
+import mp4index
+import probe
+import zipstream
 
 # Load environment variables from .env file
 load_dotenv()
@@ -48,48 +73,2256 @@ PORT = int(os.getenv("PORT", 8000))
 # External TG File Streamer URL (deploy to free host for better performance)
 STREAMER_URL = os.getenv("STREAMER_URL")  # e.g., "https://your-app.onrender.com"
 
+# Several streamer nodes can be listed comma-separated; links are spread over them by consistent hashing
+STREAMER_NODES = [url.strip().rstrip("/") for url in (STREAMER_URL or "").split(",") if url.strip()]
+STREAMER_HEALTH_INTERVAL = int(os.getenv("STREAMER_HEALTH_INTERVAL", 15))  # Seconds between node health checks
+STREAMER_LOAD_FACTOR = float(os.getenv("STREAMER_LOAD_FACTOR", 1.25))  # Max node load relative to fleet average
+
+# Relay mode: serve /stream from main.py and fetch the bytes from the streamer fleet
+STREAMER_RELAY = os.getenv("STREAMER_RELAY", "false").lower() == "true"
+
+# Signed links: shared with tg-streamer so it can stream without a get_messages call
+STREAM_SECRET = os.getenv("STREAM_SECRET")
+STREAM_LINK_TTL = int(os.getenv("STREAM_LINK_TTL", 6 * 3600))  # Seconds a signed link stays valid
+
+# Background warm-up tuning
+FILE_INDEX_TTL = int(os.getenv("FILE_INDEX_TTL", 60))  # Seconds before an unpolled channel listing is re-walked
+FILE_INDEX_MAX_AGE = int(os.getenv("FILE_INDEX_MAX_AGE", min(3600, STREAM_LINK_TTL // 2)))  # Seconds before a polled listing is re-walked anyway (re-signs links)
+WARMUP_THUMBNAILS = int(os.getenv("WARMUP_THUMBNAILS", 24))  # Thumbnails prefetched for the first page
+THUMBNAIL_CACHE_SIZE = int(os.getenv("THUMBNAIL_CACHE_SIZE", 500))  # Thumbnails kept in memory
+
+# Streaming engine caches
+CHUNK_CACHE_MB = int(os.getenv("CHUNK_CACHE_MB", 256))  # Memory budget for cached 1 MiB file chunks
+MEDIA_CACHE_SIZE = int(os.getenv("MEDIA_CACHE_SIZE", 5000))  # Message media references kept in memory
+MP4_INDEX_CACHE_SIZE = int(os.getenv("MP4_INDEX_CACHE_SIZE", 64))  # Parsed MP4 moov atoms kept in memory
+HLS_SEGMENT_SECONDS = float(os.getenv("HLS_SEGMENT_SECONDS", 6))  # Target HLS segment length, cut at keyframes
+
+# Hedged GetFile: a part slower than the DC's latency percentile is requested again on a second session
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", 0.05))  # Fraction of GetFile calls that may be duplicated (0 disables)
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", 95))  # Latency percentile after which a part is hedged
+HEDGE_MIN_MS = int(os.getenv("HEDGE_MIN_MS", 400))  # Never hedge sooner than this
+
+# Mid-stream resume after transient Telegram errors and disconnects
+STREAM_RETRIES = int(os.getenv("STREAM_RETRIES", 5))  # Consecutive failed attempts before a stream gives up
+STREAM_MAX_FLOOD_WAIT = int(os.getenv("STREAM_MAX_FLOOD_WAIT", 60))  # Longest FloodWait (seconds) waited out mid-stream
+
+# Adaptive GetFile part sizing for streams: small first parts after a seek, ramping to 1 MiB
+ADAPTIVE_MIN_KB = int(os.getenv("ADAPTIVE_MIN_KB", 16))  # Smallest first part of a stream
+ADAPTIVE_MAX_INFLIGHT = int(os.getenv("ADAPTIVE_MAX_INFLIGHT", 4))  # Most parts in flight per stream
+
+# On-the-fly remux of containers browsers cannot play (MKV, MOV, AVI) to fragmented MP4
+FFMPEG_PATH = os.getenv("FFMPEG_PATH", "ffmpeg")
+CACHE_DIR = os.getenv("CACHE_DIR", "/tmp/tg-cache")  # Disk cache root
+REMUX_CACHE_MB = int(os.getenv("REMUX_CACHE_MB", 4096))  # Disk budget for remuxed files
+REMUX_MAX_JOBS = int(os.getenv("REMUX_MAX_JOBS", 2))  # Concurrent ffmpeg processes per worker
+FFMPEG_AVAILABLE = shutil.which(FFMPEG_PATH) is not None
+
+# Seek-preview storyboards (sprite sheet + WebVTT), rendered by ffmpeg from keyframes only
+STORYBOARD_TILES = int(os.getenv("STORYBOARD_TILES", 60))  # Thumbnails per video
+STORYBOARD_TILE_WIDTH = int(os.getenv("STORYBOARD_TILE_WIDTH", 160))  # Pixels
+STORYBOARD_WORKERS = int(os.getenv("STORYBOARD_WORKERS", 2))  # Concurrent ffmpeg renders
+STORYBOARD_AUTO = os.getenv("STORYBOARD_AUTO", "true").lower() == "true"  # Render for every indexed MP4 in the background
+
+# Multi-file ZIP downloads
+ZIP_MAX_FILES = int(os.getenv("ZIP_MAX_FILES", 100))  # Message ids per archive
+
+# /dl byte ranges: requests asking for more ranges than this get the whole file
+DL_MAX_RANGES = int(os.getenv("DL_MAX_RANGES", 16))
+
+# File grid paging: cards rendered with the page, and the default /api/files page size
+FILES_PAGE_SIZE = int(os.getenv("FILES_PAGE_SIZE", 50))
+
+# Stream the / page shell before the channel history walk finishes on cold loads
+STREAM_RENDER = os.getenv("STREAM_RENDER", "true").lower() == "true"
+
+# Delta sync: fold new and deleted channel messages into the index without re-walking history
+SYNC_INTERVAL = int(os.getenv("SYNC_INTERVAL", 15))  # Seconds between checks (0 disables)
+SYNC_PAGE = int(os.getenv("SYNC_PAGE", 20))  # Newest messages fetched per check
+
+# Background media probing: sniffed MIME, codecs, resolution, duration and bitrate
+PROBE_AUTO = os.getenv("PROBE_AUTO", "true").lower() == "true"  # Probe every indexed file in the background
+PROBE_HEAD_KB = int(os.getenv("PROBE_HEAD_KB", 128))  # Leading bytes read for sniffing and container headers
+
+# Head-of-file warm cache for the newest and most-played videos
+WARM_CACHE_MB = int(os.getenv("WARM_CACHE_MB", 128))  # Budget for pinned head/moov chunks (0 disables)
+WARM_HEAD_MB = int(os.getenv("WARM_HEAD_MB", 4))  # Leading MiB kept per video
+WARM_VIDEOS = int(os.getenv("WARM_VIDEOS", 10))  # Newest videos kept warm, plus as many most-played
+WARM_INTERVAL = int(os.getenv("WARM_INTERVAL", 300))  # Seconds between refreshes when the index is unchanged
+
+# Whole files copied to disk once played often enough, then served from memory maps
+FILE_CACHE_MB = int(os.getenv("FILE_CACHE_MB", 8192))  # Disk budget for materialized files
+PROMOTE_PLAYS = int(os.getenv("PROMOTE_PLAYS", 3))  # Plays before a file is materialized (0 disables)
+PROMOTE_MAX_MB = int(os.getenv("PROMOTE_MAX_MB", 2048))  # Largest file that is materialized
+
+# Access analytics: decayed per-file popularity ordering chunk eviction, warming and thumbnail prefetch
+HOT_HALF_LIFE_HOURS = float(os.getenv("HOT_HALF_LIFE_HOURS", 24))  # Hours for a file's score to halve
+TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXIES", 0))  # Reverse proxies in front of the app whose X-Forwarded-For hop is trusted
+
 # Validate environment variables
 if not all([API_ID, API_HASH, SESSION_STRING]):
     raise ValueError("Missing required environment variables: TG_API_ID, TG_API_HASH, TG_SESSION_STRING")
 
-# Initialize Pyrogram Client (UserBot mode) with better session handling
-client = Client(
-    name="streaming_bot",
-    api_id=int(API_ID),
-    api_hash=API_HASH,
-    session_string=SESSION_STRING,
-    in_memory=True,
-    no_updates=True,  # Disable updates to prevent conflicts
-    takeout=False     # Disable takeout mode
-)
+# Multi-process mode: one gateway process owns the session, HTTP workers reach it over a Unix socket
+HTTP_WORKERS = int(os.getenv("HTTP_WORKERS", 1))
+GATEWAY_SOCKET = os.getenv("GATEWAY_SOCKET")  # Set for workers; defaults to /tmp/tg-gateway.sock when HTTP_WORKERS > 1
+KEEP_ALIVE_TIMEOUT = int(os.getenv("KEEP_ALIVE_TIMEOUT", 300))  # Seconds an idle HTTP connection is kept open
+
+
+def create_telegram_client() -> Client:
+    """Initialize Pyrogram Client (UserBot mode) with better session handling"""
+    return Client(
+        name="streaming_bot",
+        api_id=int(API_ID),
+        api_hash=API_HASH,
+        session_string=SESSION_STRING,
+        in_memory=True,
+        no_updates=True,  # Disable updates to prevent conflicts
+        takeout=False     # Disable takeout mode
+    )
+
+
+# HTTP workers get a stand-in that forwards every call to the gateway
+client = GatewayClient(GATEWAY_SOCKET) if GATEWAY_SOCKET else create_telegram_client()
+
+# Warm-up state per component, reported by /readyz
+warm_state = {
+    "client": False,
+    "peers": False,
+    "file_index": False,
+    "dc_sessions": False,
+    "thumbnails": False
+}
+warm_errors: Dict[str, str] = {}
+started_at = time.time()
+
+# Components that must be warm before the instance takes media traffic
+READY_COMPONENTS = ("client", "peers", "file_index", "dc_sessions")
+
+# Channel listings keyed by channel id: {"files": [...], "updated": timestamp, "history_end": oldest walked id or None}
+file_index: Dict[str, Dict] = {}
+file_index_lock = asyncio.Lock()
+
+# Bumped whenever a channel listing or one of its entries changes; keys the rendered-page cache
+index_versions: Dict[str, int] = {}
+
+# Rendered / page per channel: {"version", "html", "etag"}
+page_cache: Dict[str, Dict] = {}
+
+# One queue per open SSE stream; receives the key of each channel listing that changed
+sync_listeners: set = set()
+
+# Thumbnail bytes keyed by "chat_id:message_id", oldest evicted first
+thumbnail_cache: "OrderedDict[str, bytes]" = OrderedDict()
+
+# GetFile parts are fetched and cached in aligned 1 MiB chunks keyed by (file_unique_id, index)
+CHUNK_SIZE = 1024 * 1024
+chunk_cache: "OrderedDict[tuple, bytes]" = OrderedDict()
+chunk_inflight: Dict[tuple, asyncio.Future] = {}
+chunk_stats = {"bytes": 0, "hits": 0, "misses": 0}
+
+# Pinned head/moov chunks of warm videos - outside the LRU and its budget - and the indexed
+# videos they are chosen from (offered by the workers in worker mode)
+warm_chunks: Dict[tuple, bytes] = {}
+warm_videos: List[Dict] = []
+warm_lock = asyncio.Lock()
+warm_refresh = asyncio.Event()
+
+# Second media session per DC for hedged requests, GetFile latencies (seconds) per DC, session
+# slot and part size class, and the hedge token bucket (HEDGE_BUDGET tokens per call, one per hedge)
+hedge_sessions: Dict[int, Session] = {}
+getfile_latencies: Dict[tuple, deque] = {}
+hedge_stats = {"tokens": 1.0, "requests": 0, "hedged": 0, "won": 0}
+LATENCY_WINDOW = 200  # Recent GetFile latencies kept per session and size class
+PART_CLASSES = (64 * 1024, 256 * 1024, 1024 * 1024)  # Upper limits of the part size classes
+HEDGE_BURST = 10  # Most hedges that can be saved up
+
+# Live link estimates per DC from a stream's sub-chunk parts: EWMA throughput (bytes/s) and round trip (s)
+dc_links: Dict[int, Dict[str, float]] = {}
+
+# Streams resumed after transient errors: totals, plus the most recent per-stream records
+stream_stats = {"resumed": 0, "retries": 0, "stalled_seconds": 0.0, "failed": 0}
+recent_recoveries: deque = deque(maxlen=20)
+
+# Access stats keyed by file_unique_id (plays, bytes, seeks, client hashes, decayed score),
+# and events not yet appended to ACCESS_LOG. Owned by the gateway in worker mode.
+access_stats: Dict[str, Dict] = {}
+access_pending: List[Dict] = []
+access_state = {"flushed": time.time(), "compacted": time.time()}
+ACCESS_LOG = os.path.join(CACHE_DIR, "access.log")
+ACCESS_COMPACT_INTERVAL = 3600  # Seconds between rewrites of ACCESS_LOG as one snapshot line per file
+REMUX_USER_AGENT = "tg-remux"  # Sent by ffmpeg on loopback source requests, which are not counted as plays
+ACCESS_MAX_CLIENTS = 256  # Client hashes remembered per file
+# Score per play, per whole file's worth of bytes served, per seek and per new client
+ACCESS_WEIGHTS = {"plays": 1.0, "bytes": 1.0, "seeks": 0.1, "clients": 1.0}
+EVICT_SAMPLE = 8  # Oldest cached chunks compared by popularity on eviction
+
+# Memory maps of materialized files keyed by file_unique_id, running copies, and promotions asked for
+local_maps: Dict[str, mmap.mmap] = {}
+materialize_jobs: Dict[str, asyncio.Future] = {}
+promoting: set = set()
+LOCAL_BLOCK_SIZE = 4 * 1024 * 1024  # Slice served per send from a materialized file
+
+# Media references keyed by "chat_id:message_id" - everything needed to read a file without get_messages
+media_cache: "OrderedDict[str, Dict]" = OrderedDict()
+
+# Parsed moov atoms keyed by file_unique_id (None for files that are not usable MP4s)
+mp4_index_cache: "OrderedDict[str, Optional[mp4index.Mp4Index]]" = OrderedDict()
+mp4_index_locks: Dict[str, asyncio.Lock] = {}
+
+# Running remux jobs keyed by file_unique_id, shared by every viewer of the file
+remux_jobs: Dict[str, Dict] = {}
+REMUX_BLOCK_SIZE = 256 * 1024
+REMUX_TYPES = ("video/x-matroska", "video/quicktime", "video/x-msvideo", "video/avi", "video/mp2t", "video/x-flv")
+
+# Storyboard renders keyed by file_unique_id, and the background queue of indexed videos
+# (rendered by the gateway in worker mode); failed renders are not re-queued for a day
+storyboard_jobs: Dict[str, asyncio.Task] = {}
+storyboard_queue: asyncio.Queue = asyncio.Queue()
+storyboard_queued: set = set()
+storyboard_failures: Dict[str, float] = {}
+STORYBOARD_RETRY_AFTER = 24 * 3600
+storyboard_semaphore = asyncio.Semaphore(STORYBOARD_WORKERS)
+STORYBOARD_COLUMNS = 10
+
+# Probe results keyed by file_unique_id, persisted so restarts do not re-probe
+probe_results: Dict[str, Dict] = {}
+probe_queue: asyncio.Queue = asyncio.Queue()
+PROBE_FILE = os.path.join(CACHE_DIR, "probe.json")
+
+# CRC-32 of whole files keyed by file_unique_id, so resumed ZIP downloads need not re-read members
+crc_cache: "OrderedDict[str, int]" = OrderedDict()
+CRC_CACHE_SIZE = 10000
+
+# Fire-and-forget prefetches, referenced so they are not garbage collected mid-flight
+prefetch_tasks = set()
+
+# tg-streamer fleet state, refreshed by the health checker
+streamer_nodes: Dict[str, Dict] = {
+    url: {
+        "healthy": True, "failures": 0, "active_streams": 0, "capacity": 1, "checked": 0.0,
+        # Relay statistics
+        "requests": 0, "errors": 0, "latency_ms": None
+    }
+    for url in STREAMER_NODES
+}
+STREAMER_VNODES = 100  # Virtual nodes per streamer on the hash ring
+STREAMER_MAX_FAILURES = 2  # Failed health checks before a node is dropped
+
+
+def ring_hash(key: str) -> int:
+    """Stable 64-bit position of a key on the hash ring"""
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+# Ring of (position, node url); built once over all nodes so a node going down only moves its own files
+streamer_ring = sorted(
+    (ring_hash(f"{url}#{i}"), url) for url in STREAMER_NODES for i in range(STREAMER_VNODES)
+)
+
+
+def pick_streamer(key: str, exclude=()) -> Optional[str]:
+    """
+    Pick the streamer node for a file by consistent hashing on its key.
+
+    Walks the ring clockwise from the key's position and takes the first
+    healthy node whose load (active streams per unit of capacity) is within
+    STREAMER_LOAD_FACTOR of the fleet average, so a file sticks to one node
+    and its chunk cache unless that node is down or saturated.
+    """
+    if not streamer_ring:
+        return None
+
+    healthy = [url for url, node in streamer_nodes.items() if node["healthy"] and url not in exclude]
+    if not healthy:
+        # Nothing passes health checks - fall back to the plain owner rather than no link at all
+        candidates = [url for url in STREAMER_NODES if url not in exclude] or STREAMER_NODES
+        healthy = candidates
+
+    total_load = sum(streamer_nodes[url]["active_streams"] for url in healthy)
+    total_capacity = sum(streamer_nodes[url]["capacity"] for url in healthy)
+    max_ratio = (total_load + 1) / total_capacity * STREAMER_LOAD_FACTOR
+
+    start = bisect.bisect(streamer_ring, (ring_hash(key),))
+    owner = None
+    for i in range(len(streamer_ring)):
+        url = streamer_ring[(start + i) % len(streamer_ring)][1]
+        if url not in healthy:
+            continue
+        if owner is None:
+            owner = url
+        node = streamer_nodes[url]
+        if (node["active_streams"] + 1) / node["capacity"] <= max_ratio:
+            return url
+    return owner
+
+
+async def check_streamer(http: httpx.AsyncClient, url: str):
+    """Poll one streamer node's /healthz and update its health and load"""
+    node = streamer_nodes[url]
+    try:
+        r = await http.get(f"{url}/healthz")
+        r.raise_for_status()
+        data = r.json()
+        node["active_streams"] = int(data.get("active_streams", 0))
+        node["capacity"] = max(1, int(data.get("capacity", 1)))
+        if not node["healthy"]:
+            logger.info(f"Streamer {url} is back")
+        node["healthy"] = True
+        node["failures"] = 0
+    except Exception as e:
+        node["failures"] += 1
+        if node["healthy"] and node["failures"] >= STREAMER_MAX_FAILURES:
+            node["healthy"] = False
+            logger.warning(f"Streamer {url} dropped after {node['failures']} failed checks: {e}")
+    node["checked"] = time.time()
+
+
+# Pooled keep-alive client for relay mode, opened in lifespan
+relay_http: Optional[httpx.AsyncClient] = None
+
+# Upstream headers passed through to the browser
+RELAY_HEADERS = (
+    "content-type", "content-length", "content-range", "accept-ranges",
+    "content-disposition", "cache-control", "etag", "last-modified"
+)
+
+
+def record_relay_result(url: str, latency: float = None, error: bool = False):
+    """Track per-node request count, errors and time-to-headers (EWMA)"""
+    node = streamer_nodes[url]
+    node["requests"] += 1
+    if error:
+        node["errors"] += 1
+    if latency is not None:
+        latency_ms = latency * 1000
+        node["latency_ms"] = latency_ms if node["latency_ms"] is None else round(0.8 * node["latency_ms"] + 0.2 * latency_ms, 1)
+
+
+async def open_relay(method: str, path: str, key: str, headers: Dict, tried: List[str]) -> Optional[httpx.Response]:
+    """Open an upstream request on the node owning key, failing over along the ring"""
+    for _ in range(len(STREAMER_NODES)):
+        url = pick_streamer(key, exclude=tried)
+        if url is None or url in tried:
+            break
+        tried.append(url)
+
+        started = time.monotonic()
+        try:
+            upstream = await relay_http.send(
+                relay_http.build_request(method, f"{url}{path}", headers=headers),
+                stream=True
+            )
+        except httpx.HTTPError as e:
+            record_relay_result(url, error=True)
+            logger.warning(f"Relay to {url} failed: {e}")
+            continue
+
+        if upstream.status_code >= 500:
+            record_relay_result(url, time.monotonic() - started, error=True)
+            logger.warning(f"Relay to {url} returned {upstream.status_code}")
+            await upstream.aclose()
+            continue
+
+        record_relay_result(url, time.monotonic() - started)
+        return upstream
+    return None
+
+
+def parse_content_range(upstream: httpx.Response):
+    """Return the (start, end) byte span an upstream response covers, if known"""
+    content_range = upstream.headers.get("content-range")
+    if content_range:
+        match = re.match(r"bytes (\d+)-(\d+)/", content_range)
+        if match:
+            return int(match.group(1)), int(match.group(2))
+    content_length = upstream.headers.get("content-length")
+    if content_length and int(content_length) > 0:
+        return 0, int(content_length) - 1
+    return None
+
+
+async def relay_stream(request: Request, path: str, key: str):
+    """
+    Relay a /stream request to the streamer fleet.
+
+    Body chunks are passed through as they arrive (aiter_raw, no decoding or
+    re-buffering). If the node fails mid-body, the relay re-requests the
+    remaining bytes with a Range header from the next node on the ring, so
+    the browser sees one uninterrupted response.
+    """
+    headers = {"Accept-Encoding": "identity"}
+    for name in ("range", "if-range"):
+        if name in request.headers:
+            headers[name] = request.headers[name]
+
+    tried: List[str] = []
+    upstream = await open_relay(request.method, path, key, headers, tried)
+    if upstream is None:
+        raise HTTPException(status_code=502, detail="No streamer node available")
+
+    response_headers = {name: upstream.headers[name] for name in RELAY_HEADERS if name in upstream.headers}
+    response_headers["Access-Control-Allow-Origin"] = "*"
+    response_headers["Access-Control-Expose-Headers"] = "Content-Range, Content-Length, Accept-Ranges"
+
+    if request.method == "HEAD":
+        await upstream.aclose()
+        return Response(status_code=upstream.status_code, headers=response_headers)
+
+    span = parse_content_range(upstream)
+
+    async def relay_body():
+        current = upstream
+        sent = 0
+        try:
+            while True:
+                try:
+                    async for chunk in current.aiter_raw():
+                        sent += len(chunk)
+                        yield chunk
+                    return
+                except httpx.HTTPError as e:
+                    streamer_nodes[tried[-1]]["errors"] += 1
+                    logger.warning(f"Relay from {tried[-1]} broke after {sent} bytes: {e}")
+                    await current.aclose()
+
+                if span is None:
+                    logger.error("Cannot resume relay: upstream did not report a byte span")
+                    return
+
+                resume_from = span[0] + sent
+                if resume_from > span[1]:
+                    return
+
+                resume_headers = dict(headers, range=f"bytes={resume_from}-{span[1]}")
+                resume_headers.pop("if-range", None)
+                current = await open_relay("GET", path, key, resume_headers, tried)
+                if current is None or current.status_code != 206:
+                    logger.error(f"Relay failover exhausted at byte {resume_from}")
+                    return
+                logger.info(f"Relay resumed at byte {resume_from} on {tried[-1]}")
+        finally:
+            if current is not None:
+                await current.aclose()
+
+    return StreamingResponse(relay_body(), status_code=upstream.status_code, headers=response_headers)
+
+
+def b64url_encode(data: bytes) -> str:
+    """URL-safe base64 without padding"""
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def sign_stream_path(file_info: Dict, file_id: str) -> str:
+    """
+    Build a signed tg-streamer path for a file.
+
+    The token embeds the serialized file location (file_id carries DC,
+    access hash and file_reference) plus size, MIME and name, so the
+    streamer can go straight to GetFile.
+    """
+    claims = {
+        "c": file_info["channel_id"],
+        "m": file_info["message_id"],
+        "f": file_id,
+        "s": file_info["size_bytes"] or 0,
+        "t": file_info["type"],
+        "n": sanitize_filename(file_info["name"]),
+        "e": int(time.time()) + STREAM_LINK_TTL
+    }
+    body = b64url_encode(json.dumps(claims, separators=(",", ":")).encode())
+    signature = b64url_encode(hmac.new(STREAM_SECRET.encode(), body.encode(), hashlib.sha256).digest()[:16])
+    return f"/s/{body}.{signature}/{quote(claims['n'])}"
+
+
+def lookup_indexed_file(chat_id, message_id: int) -> Optional[Dict]:
+    """Find a file in the channel index without touching Telegram"""
+    entry = file_index.get(str(chat_id))
+    if entry:
+        for file_info in entry["files"]:
+            if file_info["message_id"] == message_id:
+                return file_info
+    return None
+
+
+def streamer_route(chat_id, message_id: int):
+    """
+    Return (upstream path, ring key) for relaying a file.
+    Indexed files use file_unique_id as key and, with STREAM_SECRET, a signed path.
+    """
+    file_info = lookup_indexed_file(chat_id, message_id)
+    if file_info and file_info.get("file_unique_id"):
+        path = file_info.get("signed_path") or f"/stream/{chat_id}/{message_id}"
+        return path, file_info["file_unique_id"]
+    return f"/stream/{chat_id}/{message_id}", f"{chat_id}:{message_id}"
+
+
+async def monitor_streamers():
+    """Periodically health-check every streamer node"""
+    async with httpx.AsyncClient(timeout=5) as http:
+        while True:
+            await asyncio.gather(*(check_streamer(http, url) for url in STREAMER_NODES))
+            await asyncio.sleep(STREAMER_HEALTH_INTERVAL)
+
+
+def get_channel_id():
+    """Return the configured channel id, as int when it is numeric"""
+    if not CHANNEL_ID:
+        return None
+    try:
+        return int(CHANNEL_ID)
+    except (ValueError, TypeError):
+        return CHANNEL_ID  # Keep as string if it's a username like @channel
+
+
+def get_media(message: Message):
+    """Return the downloadable media object of a message, if any"""
+    for kind in ("video", "audio", "document", "photo", "animation", "voice", "video_note"):
+        media = getattr(message, kind, None)
+        if media:
+            return media
+    return None
+
+
+async def get_media_session(dc_id: int, hedge: bool = False) -> Session:
+    """
+    Return a persistent media session for a DC, creating it on first use.
+
+    Pyrogram's get_file() opens and closes a fresh session (plus an auth
+    export for foreign DCs) on every call; keeping one per DC removes that
+    handshake from every stream and thumbnail request. hedge=True returns a
+    second, independent session to the DC for hedged requests.
+    """
+    sessions = hedge_sessions if hedge else client.media_sessions
+    async with client.media_sessions_lock:
+        session = sessions.get(dc_id)
+        if session:
+            return session
+
+        test_mode = await client.storage.test_mode()
+
+        if dc_id == await client.storage.dc_id():
+            session = Session(client, dc_id, await client.storage.auth_key(), test_mode, is_media=True)
+            await session.start()
+        else:
+            session = Session(client, dc_id, await Auth(client, dc_id, test_mode).create(), test_mode, is_media=True)
+            await session.start()
+
+            for _ in range(3):
+                exported_auth = await client.invoke(raw.functions.auth.ExportAuthorization(dc_id=dc_id))
+                try:
+                    await session.invoke(
+                        raw.functions.auth.ImportAuthorization(id=exported_auth.id, bytes=exported_auth.bytes)
+                    )
+                except AuthBytesInvalid:
+                    continue
+                else:
+                    break
+            else:
+                await session.stop()
+                raise AuthBytesInvalid
+
+        sessions[dc_id] = session
+        logger.info(f"{'Hedge' if hedge else 'Media'} session for DC {dc_id} ready")
+        return session
+
+
+async def stop_hedge_sessions():
+    """Stop the hedge sessions; the primary media sessions are stopped with the client"""
+    for session in list(hedge_sessions.values()):
+        try:
+            await session.stop()
+        except Exception as e:
+            logger.warning(f"Error stopping hedge session: {e}")
+    hedge_sessions.clear()
+
+
+async def warm_dc_session(dc_id: int):
+    """Open the media session for a DC wherever the Telegram session lives"""
+    if isinstance(client, GatewayClient):
+        return await client.call("warm_dc_session", dc_id)
+    await get_media_session(dc_id)
+
+
+async def get_home_dc() -> int:
+    """Return the DC the account lives on"""
+    if isinstance(client, GatewayClient):
+        return await client.call("get_home_dc")
+    return await client.storage.dc_id()
+
+
+def get_file_location(file_id: FileId):
+    """Build the GetFile input location for a decoded file id"""
+    if file_id.file_type == FileType.PHOTO:
+        return raw.types.InputPhotoFileLocation(
+            id=file_id.media_id,
+            access_hash=file_id.access_hash,
+            file_reference=file_id.file_reference,
+            thumb_size=file_id.thumbnail_size
+        )
+    return raw.types.InputDocumentFileLocation(
+        id=file_id.media_id,
+        access_hash=file_id.access_hash,
+        file_reference=file_id.file_reference,
+        thumb_size=file_id.thumbnail_size
+    )
+
+
+def part_class(limit: int) -> int:
+    """Size class of a GetFile part, so small and whole-chunk parts keep separate latency windows"""
+    return bisect.bisect_left(PART_CLASSES, limit)
+
+
+async def invoke_get_file(session: Session, slot: tuple, file_id: FileId, offset: int, limit: int) -> bytes:
+    """
+    One GetFile call, recording its latency for the session's slot and the
+    part's size class. A call cancelled because its hedge won is recorded
+    with the time it had taken so far, a lower bound that keeps the slow
+    tail in the window.
+    """
+    started = time.monotonic()
+    window = getfile_latencies.setdefault((*slot, part_class(limit)), deque(maxlen=LATENCY_WINDOW))
+    try:
+        r = await session.invoke(
+            raw.functions.upload.GetFile(
+                location=get_file_location(file_id),
+                offset=offset,
+                limit=limit
+            ),
+            sleep_threshold=30
+        )
+    except asyncio.CancelledError:
+        window.append(time.monotonic() - started)
+        raise
+    window.append(time.monotonic() - started)
+    return r.bytes
+
+
+def hedge_delay(dc_id: int, limit: int = CHUNK_SIZE) -> float:
+    """Seconds to wait for a part before hedging: the HEDGE_PERCENTILE latency of the DC's session for its size"""
+    window = sorted(getfile_latencies.get((dc_id, 0, part_class(limit)), ()))
+    if len(window) < 20:
+        # Not enough samples yet - only hedge the clearly stuck
+        return max(HEDGE_MIN_MS / 1000, 2.0)
+    return max(HEDGE_MIN_MS / 1000, window[int(HEDGE_PERCENTILE / 100 * (len(window) - 1))])
+
+
+async def fetch_file_part(file_id: FileId, offset: int, limit: int) -> bytes:
+    """
+    Fetch one GetFile part over the persistent media session of the file's DC.
+
+    A part that takes longer than the session's HEDGE_PERCENTILE latency is
+    requested again on a second session to the same DC, within HEDGE_BUDGET;
+    the first answer wins and the other request is cancelled.
+    """
+    if isinstance(client, GatewayClient):
+        return await client.call("fetch_file_part", file_id, offset, limit)
+
+    dc_id = file_id.dc_id
+    session = await get_media_session(dc_id)
+    if HEDGE_BUDGET <= 0:
+        return await invoke_get_file(session, (dc_id, 0), file_id, offset, limit)
+
+    hedge_stats["requests"] += 1
+    hedge_stats["tokens"] = min(hedge_stats["tokens"] + HEDGE_BUDGET, HEDGE_BURST)
+    primary = asyncio.ensure_future(invoke_get_file(session, (dc_id, 0), file_id, offset, limit))
+    tasks = {primary}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_delay(dc_id, limit))
+        if done or hedge_stats["tokens"] < 1:
+            return await primary
+
+        try:
+            hedge_session = await get_media_session(dc_id, hedge=True)
+        except Exception as e:
+            logger.warning(f"Hedge session for DC {dc_id} unavailable: {e}")
+            return await primary
+        hedge_stats["tokens"] -= 1
+        hedge_stats["hedged"] += 1
+        secondary = asyncio.ensure_future(invoke_get_file(hedge_session, (dc_id, 1), file_id, offset, limit))
+        tasks.add(secondary)
+
+        error = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is secondary:
+                        hedge_stats["won"] += 1
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+async def download_small_file(file_id_str: str) -> bytes:
+    """Download a small file (thumbnail, photo) completely into memory"""
+    file_id = FileId.decode(file_id_str)
+    part_size = 1024 * 1024
+    data = b""
+    offset = 0
+
+    while True:
+        part = await fetch_file_part(file_id, offset, part_size)
+        data += part
+        offset += len(part)
+        if len(part) < part_size:
+            return data
+
+
+def resolve_chat_id(chat_id: str):
+    """Convert a chat id from a URL path: @usernames stay strings, numeric ids become int"""
+    if chat_id.startswith('@'):
+        return chat_id
+    try:
+        return int(chat_id)
+    except ValueError:
+        return chat_id
+
+
+def media_ref_from_message(message: Message, chat_id) -> Optional[Dict]:
+    """Build a picklable reference to a message's media: location plus name, type and size"""
+    media = get_media(message)
+    file_info = extract_file_info(message, chat_id) if media else None
+    if not file_info:
+        return None
+    return {
+        "chat_id": chat_id,
+        "message_id": message.id,
+        "file_id": media.file_id,
+        "file_unique_id": media.file_unique_id,
+        "file_size": file_info["size_bytes"] or 0,
+        "mime_type": file_info["type"],
+        "file_name": file_info["name"],
+        "date": message.date.timestamp() if message.date else 0,
+        "dc_id": file_info.get("dc_id"),
+        "can_stream": file_info["can_stream"],
+        "stream_quality": file_info.get("stream_quality"),
+        "has_thumbnail": file_info["has_thumbnail"]
+    }
+
+
+async def get_media_ref(chat_id, message_id: int) -> Dict:
+    """Return the media reference of a message, calling get_messages only on a cache miss"""
+    key = f"{chat_id}:{message_id}"
+    if key in media_cache:
+        media_cache.move_to_end(key)
+        return media_cache[key]
+
+    try:
+        message = await client.get_messages(chat_id, message_id)
+    except Exception as e:
+        logger.error(f"Failed to get message {message_id} from {chat_id}: {e}")
+        raise HTTPException(status_code=404, detail=f"Could not fetch message: {str(e)}")
+
+    ref = media_ref_from_message(message, chat_id) if message else None
+    if not ref:
+        raise HTTPException(status_code=404, detail="Media not found")
+
+    cache_media_ref(ref)
+    return ref
+
+
+async def get_media_refs(chat_id, message_ids: List[int]) -> Dict[int, Dict]:
+    """Resolve many media references, fetching all cache misses with one get_messages call per 200 ids"""
+    refs = {}
+    missing = []
+    for message_id in message_ids:
+        key = f"{chat_id}:{message_id}"
+        if key in media_cache:
+            media_cache.move_to_end(key)
+            refs[message_id] = media_cache[key]
+        elif message_id not in missing:
+            missing.append(message_id)
+
+    for i in range(0, len(missing), 200):
+        messages = await client.get_messages(chat_id, missing[i:i + 200])
+        for message in messages:
+            ref = media_ref_from_message(message, chat_id) if message and not message.empty else None
+            if ref:
+                cache_media_ref(ref)
+                refs[message.id] = ref
+    return refs
+
+
+def cache_media_ref(ref: Dict):
+    """Remember a media reference, evicting the least recently used beyond MEDIA_CACHE_SIZE"""
+    media_cache[f"{ref['chat_id']}:{ref['message_id']}"] = ref
+    while len(media_cache) > MEDIA_CACHE_SIZE:
+        media_cache.popitem(last=False)
+
+
+async def read_chunk(ref: Dict, index: int) -> bytes:
+    """
+    Return chunk `index` (CHUNK_SIZE bytes, shorter at end of file) of a file.
+
+    Concurrent readers of the same chunk share one GetFile call, and chunks
+    stay in an LRU cache bounded by CHUNK_CACHE_MB. In worker mode the cache
+    lives in the gateway so every worker shares it.
+    """
+    mapped = local_map(ref)
+    if mapped is not None:
+        return await read_local(mapped, index * CHUNK_SIZE, (index + 1) * CHUNK_SIZE)
+    if isinstance(client, GatewayClient):
+        return await client.call("read_chunk", ref, index)
+
+    key = (ref["file_unique_id"], index)
+    if key in warm_chunks:
+        chunk_stats["hits"] += 1
+        return warm_chunks[key]
+    if key in chunk_cache:
+        chunk_cache.move_to_end(key)
+        chunk_stats["hits"] += 1
+        return chunk_cache[key]
+
+    task = chunk_inflight.get(key)
+    if task is None:
+        chunk_stats["misses"] += 1
+
+        async def load():
+            try:
+                data = await fetch_file_part(FileId.decode(ref["file_id"]), index * CHUNK_SIZE, CHUNK_SIZE)
+                chunk_cache[key] = data
+                chunk_stats["bytes"] += len(data)
+                while chunk_stats["bytes"] > CHUNK_CACHE_MB * 1024 * 1024 and len(chunk_cache) > 1:
+                    # Least popular file among the oldest few chunks - plain LRU when scores tie
+                    victim = min(islice(chunk_cache, EVICT_SAMPLE), key=lambda k: hot_score(k[0]))
+                    evicted = chunk_cache.pop(victim)
+                    chunk_stats["bytes"] -= len(evicted)
+                return data
+            finally:
+                chunk_inflight.pop(key, None)
+
+        task = chunk_inflight[key] = asyncio.ensure_future(load())
+
+    # A reader that gives up must not cancel the fetch other readers wait on
+    return await asyncio.shield(task)
+
+
+async def read_local(mapped: mmap.mmap, start: int, stop: int) -> bytes:
+    """Copy a slice of a materialized file in a thread, so a cold page cache never blocks the event loop"""
+    return await asyncio.get_running_loop().run_in_executor(None, lambda: mapped[start:stop])
+
+
+def cached_chunks(ref: Dict, first: int, last: int) -> Optional[List[bytes]]:
+    """Chunks first..last of a file when every one is already pinned or cached in this process, else None"""
+    chunks = []
+    for index in range(first, last + 1):
+        key = (ref["file_unique_id"], index)
+        chunk = warm_chunks.get(key)
+        if chunk is None:
+            chunk = chunk_cache.get(key)
+            if chunk is None:
+                return None
+            chunk_cache.move_to_end(key)
+        chunks.append(chunk)
+    chunk_stats["hits"] += len(chunks)
+    return chunks
+
+
+async def iter_range(ref: Dict, start: int, end: int) -> AsyncGenerator[bytes, None]:
+    """Yield bytes start..end (inclusive) of a file through the chunk cache, one chunk read ahead"""
+    mapped = local_map(ref)
+    if mapped is not None:
+        # Materialized file - large slices straight from the page cache, no chunk loop
+        for offset in range(start, end + 1, LOCAL_BLOCK_SIZE):
+            yield await read_local(mapped, offset, min(offset + LOCAL_BLOCK_SIZE, end + 1))
+        return
+
+    first, last = start // CHUNK_SIZE, end // CHUNK_SIZE
+    cached = cached_chunks(ref, first, last)
+    if cached is not None:
+        # Whole range already in memory - no fetch tasks or read-ahead
+        for index, chunk in enumerate(cached, first):
+            base = index * CHUNK_SIZE
+            piece = chunk[max(start - base, 0):end - base + 1]
+            if piece:
+                yield piece
+        return
+
+    pending = asyncio.ensure_future(read_chunk(ref, first))
+    try:
+        for index in range(first, last + 1):
+            chunk = await pending
+            pending = asyncio.ensure_future(read_chunk(ref, index + 1)) if index < last and len(chunk) == CHUNK_SIZE else None
+
+            base = index * CHUNK_SIZE
+            piece = chunk[max(start - base, 0):end - base + 1]
+            if piece:
+                yield piece
+            if pending is None:
+                return
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+
+def resume_delay(error: Exception, attempt: int) -> Optional[float]:
+    """
+    Seconds to wait before resuming a stream after an error, None when the
+    error is not transient. Matched on the message as well as the type, since
+    errors from the gateway may arrive as plain exceptions.
+    """
+    text = f"{type(error).__name__}: {error}"
+    flood = re.search(r"A wait of (\d+) seconds", text)
+    if flood:
+        seconds = int(flood.group(1))
+        return seconds if seconds <= STREAM_MAX_FLOOD_WAIT else None
+    if "FILE_REFERENCE_" in text:
+        return 0
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError, OSError)) or any(
+        marker in text for marker in ("Timeout", "Connection", "IncompleteRead", "[500 ", "RPC_CALL_FAIL")
+    ):
+        return min(0.5 * 2 ** attempt, 8)
+    return None
+
+
+def dc_link(dc_id: int) -> Dict[str, float]:
+    return dc_links.setdefault(dc_id, {"throughput": 4 * 1024 * 1024, "rtt": 0.15, "samples": 0})
+
+
+def record_part_timing(dc_id: int, size: int, elapsed: float):
+    """Fold one GetFile part into the DC's link estimate: small parts time the round trip, large ones the rate"""
+    link = dc_link(dc_id)
+    link["samples"] += 1
+    if size <= 64 * 1024 or elapsed < link["rtt"]:
+        link["rtt"] = 0.8 * link["rtt"] + 0.2 * elapsed
+    if size > 64 * 1024:
+        transfer = elapsed - min(link["rtt"], elapsed / 2)
+        link["throughput"] = 0.8 * link["throughput"] + 0.2 * size / transfer
+
+
+def plan_parts(start: int, end: int, dc_id: int, bulk: bool = False):
+    """
+    Yield (offset, limit) GetFile parts covering start..end. The first part is
+    about half a bandwidth-delay product of the DC (so it costs little over one
+    round trip), then each part doubles up to CHUNK_SIZE; bulk reads start at
+    CHUNK_SIZE. Parts are 4 KiB-aligned powers of two that never cross a 1 MiB
+    boundary.
+    """
+    link = dc_link(dc_id)
+    limit = CHUNK_SIZE
+    target = CHUNK_SIZE if bulk else max(link["throughput"] * link["rtt"] / 2, ADAPTIVE_MIN_KB * 1024)
+    while limit > 4096 and limit > target:
+        limit //= 2
+
+    offset = start - start % 4096
+    while offset <= end:
+        size = limit
+        while offset % CHUNK_SIZE + size > CHUNK_SIZE:
+            size //= 2
+        yield offset, size
+        offset += size
+        limit = min(limit * 2, CHUNK_SIZE)
+
+
+def inflight_parts(dc_id: int) -> int:
+    """Parts kept in flight: enough whole chunks to cover the DC's bandwidth-delay product"""
+    link = dc_link(dc_id)
+    return max(1, min(ADAPTIVE_MAX_INFLIGHT, int(link["throughput"] * link["rtt"] / CHUNK_SIZE) + 2))
+
+
+async def read_part(ref: Dict, offset: int, limit: int, fill: bool = True) -> Tuple[bytes, bool]:
+    """
+    Read one GetFile part without going through the chunk loop: sliced from the
+    pinned or cached chunk that holds it, else fetched directly. With fill, the
+    enclosing chunk is then pulled into the cache in the background, so the
+    next play or seek starting there is a hit. Returns (data, fetched from
+    Telegram). Runs in the gateway in worker mode, next to its cache.
+    """
+    if isinstance(client, GatewayClient):
+        return await client.call("read_part", ref, offset, limit, fill)
+
+    index = offset // CHUNK_SIZE
+    key = (ref["file_unique_id"], index)
+    chunk = warm_chunks.get(key)
+    if chunk is None:
+        chunk = chunk_cache.get(key)
+    if chunk is not None:
+        chunk_stats["hits"] += 1
+        base = offset - index * CHUNK_SIZE
+        return chunk[base:base + limit], False
+
+    data = await fetch_file_part(FileId.decode(ref["file_id"]), offset, limit)
+    if fill and key not in chunk_inflight:
+        schedule_prefetch(ref, [("src", index * CHUNK_SIZE, CHUNK_SIZE)])
+    return data, True
+
+
+async def iter_adaptive(ref: Dict, start: int, end: int, bulk: bool = False) -> AsyncGenerator[bytes, None]:
+    """
+    Yield bytes start..end of a file with adaptively sized GetFile parts (see
+    plan_parts), several in flight once the first has arrived. Whole aligned
+    chunks go through read_chunk, so they are shared and cached; the small
+    ramp-up parts, and every part of a bulk read, go through read_part.
+    """
+    if local_map(ref) is not None:
+        async for piece in iter_range(ref, start, end):
+            yield piece
+        return
+
+    file_id = FileId.decode(ref["file_id"])
+    dc_id = file_id.dc_id
+
+    async def fetch(offset: int, limit: int) -> bytes:
+        index = offset // CHUNK_SIZE
+        if limit == CHUNK_SIZE and not bulk:
+            return await read_chunk(ref, index)
+        started = time.monotonic()
+        # Bulk reads do not fill the cache
+        data, fetched = await read_part(ref, offset, limit, fill=not bulk)
+        if fetched:
+            record_part_timing(dc_id, limit, time.monotonic() - started)
+        return data
+
+    parts = plan_parts(start, end, dc_id, bulk)
+    pending = deque()
+    first = True
+    try:
+        while True:
+            depth = 1 if first else inflight_parts(dc_id)
+            while len(pending) < depth:
+                part = next(parts, None)
+                if part is None:
+                    break
+                pending.append((part[0], part[1], asyncio.ensure_future(fetch(*part))))
+            if not pending:
+                return
+
+            offset, limit, task = pending.popleft()
+            data = await task
+            first = False
+            piece = data[max(start - offset, 0):end - offset + 1]
+            if piece:
+                yield piece
+            if len(data) < limit:
+                # End of file
+                return
+    finally:
+        for _, _, task in pending:
+            if task.done() and not task.cancelled():
+                task.exception()
+            task.cancel()
+
+
+async def refresh_media_ref(ref: Dict) -> Dict:
+    """Re-fetch the message behind a reference for a fresh file_reference"""
+    message = await client.get_messages(ref["chat_id"], ref["message_id"])
+    fresh = media_ref_from_message(message, ref["chat_id"]) if message else None
+    if not fresh:
+        raise HTTPException(status_code=404, detail="Media not found")
+    cache_media_ref(fresh)
+    logger.info(f"Refreshed file reference for {ref['chat_id']}/{ref['message_id']}")
+    return fresh
+
+
+async def resumable_range(ref: Dict, start: int, end: int, label: str, bulk: bool = False) -> AsyncGenerator[bytes, None]:
+    """
+    Yield bytes start..end of a file with adaptively sized parts, resuming at the
+    exact byte offset after transient failures - timeouts, dropped connections,
+    Telegram 500s, an expired file reference (refreshed from the message) and
+    FloodWaits up to STREAM_MAX_FLOOD_WAIT seconds - so the client only sees a
+    pause. Gives up after STREAM_RETRIES consecutive failures. bulk=True
+    (whole-file downloads) uses full-size parts from the start.
+    """
+    position = start
+    failures = 0
+    retries = 0
+    stalled = 0.0
+    last_progress = time.monotonic()
+    stall_since = None
+    try:
+        while position <= end:
+            try:
+                async for piece in iter_adaptive(ref, position, end, bulk):
+                    now = time.monotonic()
+                    if stall_since is not None:
+                        stalled += now - stall_since
+                        stall_since = None
+                    position += len(piece)
+                    last_progress = now
+                    failures = 0
+                    yield piece
+                return
+            except Exception as e:
+                delay = resume_delay(e, failures)
+                if delay is None or failures >= STREAM_RETRIES:
+                    stream_stats["failed"] += 1
+                    raise
+                failures += 1
+                retries += 1
+                stream_stats["retries"] += 1
+                if stall_since is None:
+                    stall_since = last_progress
+                logger.warning(f"{label}: {e} at byte {position}, resuming in {delay:.1f}s (attempt {failures})")
+                await asyncio.sleep(delay)
+                if "FILE_REFERENCE_" in str(e):
+                    ref = await refresh_media_ref(ref)
+    finally:
+        if retries:
+            stream_stats["resumed"] += 1
+            stream_stats["stalled_seconds"] += stalled
+            recent_recoveries.append({
+                "stream": label, "retries": retries, "stalled_seconds": round(stalled, 2),
+                "position": position, "finished": position > end, "at": int(time.time())
+            })
+            logger.info(f"{label}: {retries} retries, {stalled:.1f}s stalled, stopped at byte {position}")
+
+
+async def read_span(ref: Dict, offset: int, length: int) -> bytes:
+    """
+    Read a small byte span with as few GetFile bytes as possible: cached chunks
+    are used as they are, otherwise the span is fetched with 4 KiB-aligned
+    power-of-two parts that never cross a 1 MiB boundary, bypassing the cache.
+    """
+    mapped = local_map(ref)
+    if mapped is not None:
+        return await read_local(mapped, offset, offset + length)
+
+    file_id = FileId.decode(ref["file_id"])
+    data = bytearray()
+    position, end = offset, offset + length
+    while position < end:
+        index = position // CHUNK_SIZE
+        window_end = min(end, (index + 1) * CHUNK_SIZE)
+        key = (ref["file_unique_id"], index)
+        chunk = warm_chunks.get(key) or chunk_cache.get(key)
+        if chunk is not None:
+            piece = chunk[position - index * CHUNK_SIZE:window_end - index * CHUNK_SIZE]
+        else:
+            part_offset = position - position % 4096
+            limit = 4096
+            while part_offset + limit < window_end and limit < CHUNK_SIZE:
+                limit *= 2
+            while part_offset // CHUNK_SIZE != (part_offset + limit - 1) // CHUNK_SIZE:
+                limit //= 2
+            part = await fetch_file_part(file_id, part_offset, limit)
+            piece = part[position - part_offset:window_end - part_offset]
+        if not piece:
+            break
+        data += piece
+        position += len(piece)
+    return bytes(data)
+
+
+async def read_bytes(ref: Dict, offset: int, length: int) -> bytes:
+    """Read a byte span of a file through the chunk cache"""
+    if length <= 0:
+        return b""
+    return b"".join([piece async for piece in iter_range(ref, offset, offset + length - 1)])
+
+
+async def get_mp4_index(ref: Dict) -> Optional[mp4index.Mp4Index]:
+    """Locate and parse a file's moov atom once per file_unique_id"""
+    key = ref["file_unique_id"]
+    if key in mp4_index_cache:
+        mp4_index_cache.move_to_end(key)
+        return mp4_index_cache[key]
+
+    lock = mp4_index_locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        if key in mp4_index_cache:
+            return mp4_index_cache[key]
+
+        try:
+            started = time.time()
+            index = await mp4index.load_index(lambda offset, length: read_bytes(ref, offset, length), ref["file_size"])
+        except Exception as e:
+            # Transient failures are not cached - the next request tries again
+            logger.error(f"Failed to index MP4 {key}: {e}")
+            return None
+        finally:
+            mp4_index_locks.pop(key, None)
+
+        if index:
+            logger.info(
+                f"Indexed MP4 {key}: moov {len(index.moov)} bytes at {index.moov_offset}, "
+                f"{'faststart' if index.is_faststart else 'moov at end'}, {time.time() - started:.2f}s"
+            )
+        mp4_index_cache[key] = index
+        while len(mp4_index_cache) > MP4_INDEX_CACHE_SIZE:
+            mp4_index_cache.popitem(last=False)
+        return index
+
+
+async def prefetch_layout(ref: Dict, segments: List):
+    """Pull the source chunks of a layout into the chunk cache"""
+    try:
+        for segment in segments:
+            if segment[0] == "src" and segment[2] > 0:
+                for index in range(segment[1] // CHUNK_SIZE, (segment[1] + segment[2] - 1) // CHUNK_SIZE + 1):
+                    await read_chunk(ref, index)
+    except Exception as e:
+        logger.warning(f"Prefetch failed for {ref['file_unique_id']}: {e}")
+
+
+def schedule_prefetch(ref: Dict, segments: List):
+    """Run prefetch_layout in the background"""
+    task = asyncio.create_task(prefetch_layout(ref, segments))
+    prefetch_tasks.add(task)
+    task.add_done_callback(prefetch_tasks.discard)
+
+
+def record_play(ref: Dict, request: Request = None):
+    """Record a playback start; often played files are promoted to disk"""
+    track_access(ref, request, plays=1)
+
+
+def maybe_promote(ref: Dict, plays: int):
+    """Materialize a file once it has been played PROMOTE_PLAYS times"""
+    uid = ref["file_unique_id"]
+    path = local_file_path(uid)
+    if os.path.exists(path):
+        # mtime orders eviction
+        os.utime(path)
+    elif (PROMOTE_PLAYS and plays >= PROMOTE_PLAYS and uid not in promoting
+            and 0 < ref["file_size"] <= min(PROMOTE_MAX_MB, FILE_CACHE_MB) * 1024 * 1024):
+        promoting.add(uid)
+        asyncio.ensure_future(promote_file(ref))
+
+
+def client_key(request: Optional[Request]) -> Optional[str]:
+    """
+    Anonymous client id: hash of the address and the user agent. The address
+    is the X-Forwarded-For entry added by the outermost of TRUSTED_PROXIES
+    proxies; entries before it are client-supplied and ignored.
+    """
+    if request is None:
+        return None
+    address = request.client.host if request.client else ""
+    if TRUSTED_PROXIES:
+        hops = [hop.strip() for hop in request.headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+        if hops:
+            address = hops[-min(TRUSTED_PROXIES, len(hops))]
+    return hashlib.sha1(f"{address}|{request.headers.get('user-agent', '')}".encode()).hexdigest()[:12]
+
+
+def decayed(score: float, since: float, now: float) -> float:
+    return score * 0.5 ** (max(now - since, 0) / (HOT_HALF_LIFE_HOURS * 3600))
+
+
+def hot_score(file_unique_id: str) -> float:
+    """Current decayed popularity of a file, 0 when it was never accessed"""
+    stats = access_stats.get(file_unique_id)
+    return decayed(stats["score"], stats["updated"], time.time()) if stats else 0.0
+
+
+def apply_access(event: Dict) -> Dict:
+    """Fold an access event, or a compacted snapshot line, into access_stats"""
+    stats = access_stats.get(event["u"])
+    if stats is None:
+        stats = access_stats[event["u"]] = {
+            "score": 0.0, "updated": event["t"], "plays": 0, "bytes": 0, "seeks": 0, "clients": []
+        }
+    stats.update(chat_id=event["c"], message_id=event["m"], name=event["n"], size=event["z"])
+    if "score" in event:
+        stats.update(score=event["score"], updated=event["t"], plays=event["p"], bytes=event["b"],
+                     seeks=event["s"], clients=event["k"])
+        return stats
+
+    plays, served, seeks = event.get("p", 0), event.get("b", 0), event.get("s", 0)
+    stats["plays"] += plays
+    stats["bytes"] += served
+    stats["seeks"] += seeks
+    gain = ACCESS_WEIGHTS["plays"] * plays + ACCESS_WEIGHTS["seeks"] * seeks
+    if event["z"]:
+        gain += ACCESS_WEIGHTS["bytes"] * served / event["z"]
+    client_id = event.get("k")
+    if client_id and client_id not in stats["clients"]:
+        stats["clients"].append(client_id)
+        del stats["clients"][:-ACCESS_MAX_CLIENTS]
+        gain += ACCESS_WEIGHTS["clients"]
+    stats["score"] = decayed(stats["score"], stats["updated"], event["t"]) + gain
+    stats["updated"] = max(stats["updated"], event["t"])
+    return stats
+
+
+async def record_access(ref: Dict, plays: int = 0, bytes_served: int = 0, seeks: int = 0,
+                        client_id: Optional[str] = None) -> Dict:
+    """Record one access event and return the file's updated stats; runs in the gateway in worker mode"""
+    if isinstance(client, GatewayClient):
+        return await client.call("record_access", ref, plays, bytes_served, seeks, client_id)
+
+    event = {
+        "t": round(time.time(), 1), "u": ref["file_unique_id"], "c": ref["chat_id"],
+        "m": ref["message_id"], "n": ref["file_name"], "z": ref["file_size"]
+    }
+    for key, value in (("p", plays), ("b", bytes_served), ("s", seeks), ("k", client_id)):
+        if value:
+            event[key] = value
+    stats = apply_access(event)
+    access_pending.append(event)
+    if len(access_pending) >= 100 or time.time() - access_state["flushed"] > 10:
+        flush_access_log()
+    return stats
+
+
+def track_access(ref: Dict, request: Request = None, plays: int = 0, bytes_served: int = 0, seeks: int = 0):
+    """Record an access event in the background; ffmpeg's loopback reads for a remux are not counted"""
+    if request is not None and request.headers.get("user-agent") == REMUX_USER_AGENT \
+            and request.client and request.client.host in ("127.0.0.1", "::1"):
+        return
+    client_id = client_key(request)
+
+    async def run():
+        try:
+            stats = await record_access(ref, plays, bytes_served, seeks, client_id)
+        except Exception as e:
+            logger.warning(f"Could not record access to {ref['file_unique_id']}: {e}")
+            return
+        if plays:
+            maybe_promote(ref, stats["plays"])
+
+    asyncio.ensure_future(run())
+
+
+async def count_served(ref: Dict, request: Request, body: AsyncGenerator) -> AsyncGenerator[bytes, None]:
+    """Pass a response body through, recording the bytes sent when it ends"""
+    sent = 0
+    try:
+        async for piece in body:
+            sent += len(piece)
+            yield piece
+    finally:
+        if sent:
+            track_access(ref, request, bytes_served=sent)
+
+
+def flush_access_log():
+    """Append pending access events to ACCESS_LOG, compacting it every ACCESS_COMPACT_INTERVAL"""
+    access_state["flushed"] = time.time()
+    if access_state["flushed"] - access_state["compacted"] > ACCESS_COMPACT_INTERVAL:
+        compact_access_log()
+        return
+    if not access_pending:
+        return
+    lines = "".join(json.dumps(event, separators=(",", ":")) + "\n" for event in access_pending)
+    access_pending.clear()
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(ACCESS_LOG, "a") as f:
+            f.write(lines)
+    except OSError as e:
+        logger.warning(f"Could not append to {ACCESS_LOG}: {e}")
+
+
+def compact_access_log():
+    """Rewrite ACCESS_LOG as one snapshot line per still-relevant file; pending events are already in the stats"""
+    now = time.time()
+    access_state["compacted"] = now
+    access_pending.clear()
+    for uid in [uid for uid, stats in access_stats.items() if decayed(stats["score"], stats["updated"], now) < 0.001]:
+        del access_stats[uid]
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(f"{ACCESS_LOG}.tmp", "w") as f:
+            for uid, stats in access_stats.items():
+                f.write(json.dumps({
+                    "t": stats["updated"], "u": uid, "c": stats["chat_id"], "m": stats["message_id"],
+                    "n": stats["name"], "z": stats["size"], "score": stats["score"], "p": stats["plays"],
+                    "b": stats["bytes"], "s": stats["seeks"], "k": stats["clients"]
+                }, separators=(",", ":")) + "\n")
+        os.replace(f"{ACCESS_LOG}.tmp", ACCESS_LOG)
+    except OSError as e:
+        logger.warning(f"Could not compact access log: {e}")
+
+
+def load_access_log():
+    """Replay ACCESS_LOG into access_stats, then compact it"""
+    try:
+        with open(ACCESS_LOG) as f:
+            for line in f:
+                try:
+                    apply_access(json.loads(line))
+                except (ValueError, KeyError):
+                    continue
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        logger.warning(f"Could not load access log: {e}")
+        return
+
+    compact_access_log()
+    logger.info(f"Loaded access stats for {len(access_stats)} files")
+
+
+async def hot_files(limit: int = 50) -> List[Dict]:
+    """Accessed files ranked by decayed popularity; runs in the gateway in worker mode"""
+    if isinstance(client, GatewayClient):
+        return await client.call("hot_files", limit)
+
+    now = time.time()
+    ranked = sorted(
+        ((decayed(stats["score"], stats["updated"], now), uid, stats) for uid, stats in access_stats.items()),
+        key=lambda item: item[0],
+        reverse=True
+    )[:limit]
+    return [
+        {
+            "file_unique_id": uid,
+            "chat_id": stats["chat_id"],
+            "message_id": stats["message_id"],
+            "name": stats["name"],
+            "score": round(score, 3),
+            "plays": stats["plays"],
+            "bytes": stats["bytes"],
+            "seeks": stats["seeks"],
+            "clients": len(stats["clients"])
+        }
+        for score, uid, stats in ranked
+    ]
+
+
+async def build_warm_plan() -> List:
+    """
+    Return the (ref, chunk index) pairs to keep pinned: the first WARM_HEAD_MB
+    of the hottest (by decayed access score), then the newest, indexed videos,
+    plus the moov region when it sits at the end of the file - within WARM_CACHE_MB.
+    """
+    videos = list(warm_videos)
+    scores = {hot["file_unique_id"]: hot["score"] for hot in await hot_files(500)}
+    played = sorted(
+        (ref for ref in videos if scores.get(ref["file_unique_id"])),
+        key=lambda ref: scores[ref["file_unique_id"]],
+        reverse=True
+    )[:WARM_VIDEOS]
+    newest = sorted(videos, key=lambda ref: ref["message_id"], reverse=True)[:WARM_VIDEOS]
+
+    plan = []
+    seen = set()
+    budget = WARM_CACHE_MB * 1024 * 1024
+    for ref in played + newest:
+        if ref["file_unique_id"] in seen:
+            continue
+        seen.add(ref["file_unique_id"])
+
+        size = ref["file_size"]
+        indexes = list(range(min(WARM_HEAD_MB, (size - 1) // CHUNK_SIZE + 1)))
+        if ref["mime_type"] in ("video/mp4", "video/quicktime"):
+            index = await get_mp4_index(ref)
+            if index and not index.is_faststart:
+                first = index.moov_offset // CHUNK_SIZE
+                last = (index.moov_offset + len(index.moov) - 1) // CHUNK_SIZE
+                indexes += [i for i in range(first, last + 1) if i not in indexes]
+
+        cost = sum(min(CHUNK_SIZE, size - i * CHUNK_SIZE) for i in indexes)
+        if cost > budget:
+            continue
+        budget -= cost
+        plan += [(ref, i) for i in indexes]
+    return plan
+
+
+async def offer_warm_videos(videos: List[Dict]):
+    """Replace the videos the warm set is chosen from and wake the warm cache loop; runs in the gateway in worker mode"""
+    if isinstance(client, GatewayClient):
+        return await client.call("offer_warm_videos", videos)
+
+    warm_videos[:] = videos
+    warm_refresh.set()
+
+
+def refresh_warm_set():
+    """Offer the indexed videos to the warm cache loop in the background after the channel index changed"""
+    if WARM_CACHE_MB <= 0:
+        return
+    videos = []
+    for entry in list(file_index.values()):
+        for file_info in entry["files"]:
+            ref = media_cache.get(f"{file_info['channel_id']}:{file_info['message_id']}")
+            if ref and ref["file_size"] and ref["mime_type"].startswith("video/"):
+                videos.append(ref)
+
+    async def run():
+        try:
+            await offer_warm_videos(videos)
+        except Exception as e:
+            logger.warning(f"Could not offer videos to the warm cache: {e}")
+
+    asyncio.ensure_future(run())
+
+
+async def apply_warm_plan(plan: List) -> int:
+    """Pin exactly the planned chunks, fetching missing ones; returns the pinned byte count"""
+    async with warm_lock:
+        wanted = {(ref["file_unique_id"], index): (ref, index) for ref, index in plan}
+        for key in [key for key in warm_chunks if key not in wanted]:
+            del warm_chunks[key]
+
+        for key, (ref, index) in wanted.items():
+            if key in warm_chunks:
+                continue
+            # Promote from the LRU when already there
+            data = chunk_cache.pop(key, None)
+            if data is not None:
+                chunk_stats["bytes"] -= len(data)
+            else:
+                try:
+                    data = await fetch_file_part(FileId.decode(ref["file_id"]), index * CHUNK_SIZE, CHUNK_SIZE)
+                except Exception as e:
+                    logger.warning(f"Warm cache fetch failed for {key}: {e}")
+                    continue
+            warm_chunks[key] = data
+
+        return sum(len(data) for data in warm_chunks.values())
+
+
+async def warm_cache_loop():
+    """Keep the warm set pinned, refreshing when the channel index changes or every WARM_INTERVAL seconds"""
+    while True:
+        try:
+            await asyncio.wait_for(warm_refresh.wait(), timeout=WARM_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        warm_refresh.clear()
+        if not warm_state["client"]:
+            continue
+
+        try:
+            started = time.time()
+            plan = await build_warm_plan()
+            pinned = await apply_warm_plan(plan)
+            logger.info(
+                f"Warm cache: {len({ref['file_unique_id'] for ref, _ in plan})} videos, "
+                f"{pinned // (1024*1024)}MB pinned in {time.time() - started:.1f}s"
+            )
+        except Exception as e:
+            logger.warning(f"Warm cache refresh failed: {e}")
+
+
+def local_file_path(file_unique_id: str) -> str:
+    return os.path.join(CACHE_DIR, "files", file_unique_id)
+
+
+def local_map(ref: Dict) -> Optional[mmap.mmap]:
+    """Memory map of a file materialized on disk, None when it is not there"""
+    uid = ref["file_unique_id"]
+    path = local_file_path(uid)
+    if not os.path.exists(path):
+        # Evicted - slices already handed out stay valid until the map is collected
+        local_maps.pop(uid, None)
+        return None
+
+    mapped = local_maps.get(uid)
+    if mapped is None:
+        try:
+            with open(path, "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not map {path}: {e}")
+            return None
+        local_maps[uid] = mapped
+    return mapped
+
+
+async def promote_file(ref: Dict):
+    """Materialize an often played file in the background"""
+    try:
+        await materialize_file(ref)
+    except Exception as e:
+        logger.warning(f"Promoting {ref['file_unique_id']} to disk failed: {e}")
+    finally:
+        promoting.discard(ref["file_unique_id"])
+
+
+async def materialize_file(ref: Dict) -> bool:
+    """
+    Copy a whole file to CACHE_DIR/files chunk by chunk (reusing cached chunks
+    without disturbing the LRU), then evict least recently played files beyond
+    FILE_CACHE_MB. Runs in the gateway in worker mode; concurrent requests for
+    the same file share one copy.
+    """
+    if isinstance(client, GatewayClient):
+        return await client.call("materialize_file", ref)
+
+    uid = ref["file_unique_id"]
+    path = local_file_path(uid)
+    if os.path.exists(path):
+        return True
+    job = materialize_jobs.get(uid)
+    if job is None:
+
+        async def copy():
+            part = f"{path}.part"
+            started = time.time()
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(part, "wb") as f:
+                    for index in range((ref["file_size"] + CHUNK_SIZE - 1) // CHUNK_SIZE):
+                        key = (uid, index)
+                        data = warm_chunks.get(key) or chunk_cache.get(key)
+                        if data is None:
+                            data = await fetch_file_part(FileId.decode(ref["file_id"]), index * CHUNK_SIZE, CHUNK_SIZE)
+                        f.write(data)
+                if os.path.getsize(part) != ref["file_size"]:
+                    raise ValueError(f"copied {os.path.getsize(part)} of {ref['file_size']} bytes")
+                os.replace(part, path)
+            except BaseException:
+                if os.path.exists(part):
+                    os.remove(part)
+                raise
+            finally:
+                materialize_jobs.pop(uid, None)
+
+            logger.info(f"Materialized {uid} ({ref['file_size'] // (1024*1024)}MB) in {time.time() - started:.1f}s")
+            trim_file_cache()
+            return True
+
+        job = materialize_jobs[uid] = asyncio.ensure_future(copy())
+    return await asyncio.shield(job)
+
+
+def trim_file_cache():
+    """Delete least recently played materialized files beyond FILE_CACHE_MB"""
+    directory = os.path.join(CACHE_DIR, "files")
+    entries = []
+    for name in os.listdir(directory):
+        if not name.endswith(".part"):
+            path = os.path.join(directory, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= FILE_CACHE_MB * 1024 * 1024:
+            break
+        os.remove(path)
+        total -= size
+        logger.info(f"Evicted materialized file {path}")
+
+
+def load_probe_results():
+    """Load persisted probe results"""
+    try:
+        with open(PROBE_FILE) as f:
+            results = json.load(f)
+        # HEIF/AVIF photos used to be sniffed as video/mp4; an MP4 without a duration is probed again
+        probe_results.update({
+            uid: result for uid, result in results.items()
+            if result.get("mime") != "video/mp4" or result.get("duration")
+        })
+        logger.info(f"Loaded {len(probe_results)} probe results")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Could not load probe results: {e}")
+
+
+def save_probe_results():
+    """Persist probe results, keeping entries written by other workers"""
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        try:
+            with open(PROBE_FILE) as f:
+                merged = json.load(f)
+        except (FileNotFoundError, ValueError):
+            merged = {}
+        merged.update(probe_results)
+        part_path = f"{PROBE_FILE}.{os.getpid()}.part"
+        with open(part_path, "w") as f:
+            json.dump(merged, f)
+        os.replace(part_path, PROBE_FILE)
+    except Exception as e:
+        logger.warning(f"Could not save probe results: {e}")
+
+
+async def probe_media(ref: Dict) -> Dict:
+    """
+    Sniff a file's real MIME type and read codecs, resolution, duration and
+    bitrate from its head - plus the moov for MP4/MOV, wherever it sits.
+    Reads bypass the chunk cache so probing does not evict playback data.
+    """
+    head = await read_span(ref, 0, min(PROBE_HEAD_KB * 1024, ref["file_size"]))
+    result = probe.probe_head(head)
+
+    if result["mime"] in ("video/mp4", "video/quicktime", "audio/mp4"):
+        index = mp4_index_cache.get(ref["file_unique_id"]) or await mp4index.load_index(
+            lambda offset, length: read_span(ref, offset, length), ref["file_size"]
+        )
+        if index:
+            if index.video:
+                result["video_codec"] = probe.MP4_CODECS.get(index.video.codec, index.video.codec)
+                result["width"], result["height"] = index.video.width, index.video.height
+            elif result["mime"] == "video/mp4":
+                result["mime"] = "audio/mp4"
+            if index.audio:
+                result["audio_codec"] = probe.MP4_CODECS.get(index.audio.codec, index.audio.codec)
+            result["duration"] = round(index.duration, 3)
+
+    if result.get("duration"):
+        result["bitrate"] = int(ref["file_size"] * 8 / result["duration"])
+    result["probed"] = int(time.time())
+    return result
+
+
+def apply_probe(file_info: Dict, result: Dict):
+    """Overlay probe results on a listing entry: real MIME, stream details and playability"""
+    if result.get("mime") and result["mime"] != file_info["type"]:
+        file_info["type"] = result["mime"]
+        file_info["icon"] = get_file_icon(result["mime"])
+    for field in ("duration", "width", "height", "video_codec", "audio_codec", "bitrate"):
+        if result.get(field):
+            file_info[field] = result[field]
+    if file_info.get("duration"):
+        file_info["duration_text"] = format_duration(file_info["duration"])
+
+    verdict = probe.playability(file_info["type"], result.get("video_codec"), result.get("audio_codec"))
+    if verdict:
+        file_info["can_stream"], file_info["stream_quality"] = verdict
+
+
+def publish_probe(uid: str):
+    """Apply a fresh probe result to the indexed listings and cached media references"""
+    result = probe_results[uid]
+    for key, entry in file_index.items():
+        for file_info in entry["files"]:
+            if file_info.get("file_unique_id") == uid:
+                declared = file_info["type"]
+                apply_probe(file_info, result)
+                if file_info.get("signed_path") and file_info["type"] != declared:
+                    # The token carries the type; re-sign it, or fall back to the unsigned path
+                    ref = media_cache.get(f"{file_info['channel_id']}:{file_info['message_id']}")
+                    if ref:
+                        file_info["signed_path"] = sign_stream_path(file_info, ref["file_id"])
+                    else:
+                        file_info.pop("signed_path")
+                set_file_urls(file_info)
+                bump_index_version(key)
+
+    for ref in media_cache.values():
+        if ref["file_unique_id"] == uid:
+            if result.get("mime"):
+                ref["mime_type"] = result["mime"]
+            verdict = probe.playability(ref["mime_type"], result.get("video_codec"), result.get("audio_codec"))
+            if verdict:
+                ref["can_stream"], ref["stream_quality"] = verdict
+
+
+def queue_probes(refs: List[Dict]):
+    """Queue background probes for indexed files that have none yet"""
+    if not PROBE_AUTO:
+        return
+    for ref in refs:
+        if ref["file_size"] and ref["file_unique_id"] not in probe_results:
+            probe_queue.put_nowait(ref)
+
+
+async def probe_worker():
+    """Probe queued files one at a time, saving results whenever the queue drains"""
+    dirty = False
+    while True:
+        ref = await probe_queue.get()
+        uid = ref["file_unique_id"]
+        if uid not in probe_results:
+            try:
+                probe_results[uid] = await probe_media(ref)
+                publish_probe(uid)
+                dirty = True
+            except Exception as e:
+                logger.warning(f"Probe failed for {uid}: {e}")
+
+        if dirty and probe_queue.empty():
+            save_probe_results()
+            dirty = False
+
+
+def parse_range_header(range_header: Optional[str], size: int):
+    """
+    Parse a single "bytes=" range against a file size.
+    Returns (start, end) inclusive, None when there is no usable Range header,
+    and raises 416 when the range is unsatisfiable.
+    """
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    try:
+        first, last = range_header[6:].strip().split("-", 1)
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        elif last:
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            return None
+    except ValueError:
+        return None
+
+    if start >= size or start > end:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, end
+
+
+def parse_byte_ranges(range_header: Optional[str], size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Parse a "bytes=" range set against a file size. Returns sorted (start, end)
+    pairs with overlapping and adjacent ranges merged, None when there is no
+    usable Range header (or more than DL_MAX_RANGES ranges), and raises 416
+    when no range is satisfiable.
+    """
+    if not range_header or not range_header.startswith("bytes="):
+        return None
+    ranges = []
+    for spec in range_header[6:].split(","):
+        try:
+            first, last = spec.strip().split("-", 1)
+            if first:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+            elif last:
+                start, end = max(size - int(last), 0), size - 1
+            else:
+                return None
+        except ValueError:
+            return None
+        if start < size and start <= end:
+            ranges.append((start, end))
+
+    if not ranges:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged if len(merged) <= DL_MAX_RANGES else None
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    """Handle application lifespan events"""
-    # Startup
-    try:
-        await client.start()
-        logger.info("Pyrogram client started successfully")
-        
-        # Cache all dialogs to resolve peers
+
+async def iter_layout(ref: Dict, segments: List, start: int, end: int) -> AsyncGenerator[bytes, None]:
+    """Yield bytes start..end of a virtual file made of ("src", offset, length) and ("mem", bytes) segments"""
+    position = 0
+    for segment in segments:
+        length = len(segment[1]) if segment[0] == "mem" else segment[2]
+        segment_start, segment_end = position, position + length - 1
+        position += length
+        if segment_end < start or segment_start > end:
+            continue
+
+        lo = max(start, segment_start) - segment_start
+        hi = min(end, segment_end) - segment_start
+        if segment[0] == "mem":
+            yield segment[1][lo:hi + 1]
+        else:
+            async for piece in iter_range(ref, segment[1] + lo, segment[1] + hi):
+                yield piece
+
+
+async def get_thumbnail_bytes(chat_id, message_id: int, message: Message = None) -> Optional[bytes]:
+    """Return thumbnail bytes for a message, from memory when already fetched"""
+    key = f"{chat_id}:{message_id}"
+    if key in thumbnail_cache:
+        thumbnail_cache.move_to_end(key)
+        return thumbnail_cache[key]
+
+    if message is None:
+        message = await client.get_messages(chat_id, message_id)
+
+    if not message or not message.media:
+        return None
+
+    thumb_data = None
+    if message.photo:
+        # For photos, the photo itself is the thumbnail
+        thumb_data = await download_small_file(message.photo.file_id)
+    else:
+        for media in (message.video, message.document, message.animation):
+            if media and media.thumbs:
+                thumb_data = await download_small_file(media.thumbs[0].file_id)
+                break
+
+    if thumb_data:
+        thumbnail_cache[key] = thumb_data
+        while len(thumbnail_cache) > THUMBNAIL_CACHE_SIZE:
+            thumbnail_cache.popitem(last=False)
+
+    return thumb_data
+
+
+def index_fresh(entry: Optional[Dict]) -> bool:
+    """
+    A listing is fresh while it was walked or polled within FILE_INDEX_TTL and
+    fully walked within FILE_INDEX_MAX_AGE - the walk re-signs streamer links
+    and re-picks their nodes, which polling does not.
+    """
+    now = time.time()
+    return bool(entry) and now - entry["synced"] < FILE_INDEX_TTL and now - entry["updated"] < FILE_INDEX_MAX_AGE
+
+
+async def get_channel_files(channel_id, force: bool = False) -> List[Dict]:
+    """Return the file listing of a channel, re-walking history once it is stale"""
+    key = str(channel_id)
+    entry = file_index.get(key)
+    if not force and index_fresh(entry):
+        return entry["files"]
+
+    async with file_index_lock:
+        # Another request may have refreshed the index while we waited
+        entry = file_index.get(key)
+        if not force and index_fresh(entry):
+            return entry["files"]
+
+        return [file_info async for file_info in walk_channel_history(channel_id)]
+
+
+async def iter_channel_files(channel_id) -> AsyncGenerator[Dict, None]:
+    """
+    Yield a channel's files as they become available: from the index when
+    fresh, else while history is walked. The walk runs in its own task and
+    hands files over through a queue, so a slow client never holds
+    file_index_lock.
+    """
+    key = str(channel_id)
+    async with file_index_lock:
+        entry = file_index.get(key)
+        files = list(entry["files"]) if index_fresh(entry) else None
+    if files is not None:
+        for file_info in files:
+            yield file_info
+        return
+
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def walk():
+        try:
+            async with file_index_lock:
+                entry = file_index.get(key)
+                if index_fresh(entry):
+                    # Another request walked it while we waited
+                    for file_info in entry["files"]:
+                        queue.put_nowait(file_info)
+                else:
+                    async for file_info in walk_channel_history(channel_id):
+                        queue.put_nowait(file_info)
+        except Exception as e:
+            queue.put_nowait(e)
+        finally:
+            queue.put_nowait(None)
+
+    asyncio.ensure_future(walk())
+    while True:
+        item = await queue.get()
+        if item is None:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+async def walk_channel_history(channel_id) -> AsyncGenerator[Dict, None]:
+    """
+    Walk the newest 100 messages, yielding each file as it is extracted, and
+    store the listing once the walk completes. Callers hold file_index_lock.
+    """
+    key = str(channel_id)
+    files = []
+    refs = []
+    walked = 0
+    oldest = None
+    async for message in client.get_chat_history(channel_id, limit=100):
+        walked += 1
+        oldest = message.id
+        if message.media:
+            file_info = extract_file_info(message, channel_id)
+            if file_info:
+                files.append(file_info)
+                ref = media_ref_from_message(message, channel_id)
+                cache_media_ref(ref)
+                refs.append(ref)
+                yield file_info
+
+    previous = file_index.get(key)
+    # history_end is None when the walk reached the start of the channel
+    now = time.time()
+    file_index[key] = {"files": files, "updated": now, "synced": now, "history_end": oldest if walked >= 100 else None}
+    bump_index_version(key)
+    queue_probes(refs)
+    queue_storyboards(refs)
+    refresh_warm_set()
+    if previous and [f["message_id"] for f in previous["files"]] != [f["message_id"] for f in files]:
+        notify_index_change(key)
+    logger.info(f"Indexed {len(files)} files in channel {channel_id}")
+
+
+async def get_files_page(channel_id, cursor: Optional[int], limit: int) -> Tuple[List[Dict], Optional[int]]:
+    """
+    One page of files older than cursor (a message id), newest first, and the
+    cursor of the next page (None at the start of the channel). Pages inside
+    the indexed window are sliced from the index; older ones walk the history
+    from the cursor, at most 5 batches of 100 messages per call.
+    """
+    files = await get_channel_files(channel_id)
+    history_end = file_index[str(channel_id)].get("history_end")
+    if cursor is None or history_end is None or cursor > history_end:
+        page = [f for f in files if cursor is None or f["message_id"] < cursor][:limit]
+        if len(page) == limit:
+            return page, page[-1]["message_id"]
+        return page, history_end
+
+    page = []
+    refs = []
+    offset_id = cursor
+    for _ in range(5):
+        walked = 0
+        async for message in client.get_chat_history(channel_id, limit=100, offset_id=offset_id):
+            walked += 1
+            offset_id = message.id
+            if message.media:
+                file_info = extract_file_info(message, channel_id)
+                if file_info:
+                    page.append(file_info)
+                    ref = media_ref_from_message(message, channel_id)
+                    cache_media_ref(ref)
+                    refs.append(ref)
+                    if len(page) == limit:
+                        break
+        if len(page) == limit or walked < 100:
+            break
+
+    queue_probes(refs)
+    if len(page) == limit:
+        return page, page[-1]["message_id"]
+    return page, None if walked < 100 else offset_id
+
+
+def bump_index_version(key: str):
+    """Mark a channel listing as changed, invalidating its rendered page"""
+    index_versions[key] = index_versions.get(key, 0) + 1
+
+
+def notify_index_change(key: str):
+    """Wake the SSE streams so they push the change"""
+    for queue in sync_listeners:
+        queue.put_nowait(key)
+
+
+async def sync_channel(channel_id) -> bool:
+    """
+    Fold new and deleted messages into an existing channel listing with one
+    history page plus one get_messages call for older indexed ids, instead of
+    re-walking the history. Returns True when the listing changed.
+    """
+    key = str(channel_id)
+    async with file_index_lock:
+        entry = file_index.get(key)
+        if not entry:
+            return False
+
+        known = {f["message_id"] for f in entry["files"]}
+        newest = max(known, default=0)
+        seen = set()
+        added = []
+        refs = []
+        async for message in client.get_chat_history(channel_id, limit=SYNC_PAGE):
+            seen.add(message.id)
+            if message.id > newest and message.media:
+                file_info = extract_file_info(message, channel_id)
+                if file_info:
+                    added.append(file_info)
+                    ref = media_ref_from_message(message, channel_id)
+                    cache_media_ref(ref)
+                    refs.append(ref)
+
+        # More new messages than one page - re-walk instead of leaving a gap
+        oldest_seen = min(seen, default=newest + 1)
+        gap = len(seen) >= SYNC_PAGE and oldest_seen > newest + 1
+        if not gap:
+            # Indexed ids inside the fetched window that history skipped are gone;
+            # older ones are checked in batches of 200
+            deleted = {message_id for message_id in known if message_id >= oldest_seen and message_id not in seen}
+            older = sorted(message_id for message_id in known if message_id < oldest_seen)
+            for i in range(0, len(older), 200):
+                messages = await client.get_messages(channel_id, older[i:i + 200])
+                deleted.update(message.id for message in messages if message.empty or not message.media)
+
+            entry["synced"] = time.time()
+            if not added and not deleted:
+                return False
+
+            entry["files"] = added + [f for f in entry["files"] if f["message_id"] not in deleted]
+            bump_index_version(key)
+            for message_id in deleted:
+                media_cache.pop(f"{channel_id}:{message_id}", None)
+
+    if gap:
+        await get_channel_files(channel_id, force=True)
+        return True
+
+    queue_probes(refs)
+    queue_storyboards(refs)
+    refresh_warm_set()
+    notify_index_change(key)
+    logger.info(f"Synced channel {channel_id}: {len(added)} new, {len(deleted)} deleted")
+    return True
+
+
+async def sync_loop():
+    """
+    Poll the default channel for new and deleted messages every SYNC_INTERVAL
+    seconds, re-walking it in the background once FILE_INDEX_MAX_AGE is reached.
+    """
+    while True:
+        await asyncio.sleep(SYNC_INTERVAL)
+        channel_id = get_channel_id()
+        if not channel_id or not warm_state["file_index"]:
+            continue
+        try:
+            entry = file_index.get(str(channel_id))
+            if entry and time.time() - entry["updated"] >= FILE_INDEX_MAX_AGE:
+                await get_channel_files(channel_id, force=True)
+            else:
+                await sync_channel(channel_id)
+        except Exception as e:
+            logger.warning(f"Channel sync failed for {channel_id}: {e}")
+
+
+def changes_since(files: List[Dict], since: int) -> Dict:
+    """
+    Listing delta for a client that has seen messages up to since: the newer
+    files, plus every current id so the client can drop deleted cards.
+    """
+    return {
+        "latest": max((f["message_id"] for f in files), default=since),
+        "added": [f for f in files if f["message_id"] > since],
+        "ids": [f["message_id"] for f in files]
+    }
+
+
+async def retry_warm_step(name: str, step: Callable[[], Awaitable]):
+    """Run a warm-up step until it succeeds, with backoff; /readyz stays 503 meanwhile"""
+    delay = 5
+    while True:
+        try:
+            result = await step()
+            warm_state[name] = True
+            warm_errors.pop(name, None)
+            return result
+        except Exception as e:
+            warm_errors[name] = str(e)
+            logger.warning(f"Warm-up step {name} failed: {e} (retrying in {delay}s)")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 300)
+
+
+async def start_client():
+    """Start the Telegram client, retrying with backoff instead of leaving a dead instance serving errors"""
+    delay = 5
+    while True:
         try:
-            logger.info("Caching dialogs...")
-            count = 0
-            async for dialog in client.get_dialogs(limit=100):
-                count += 1
-            logger.info(f"Cached {count} dialogs")
+            await client.start()
+            warm_state["client"] = True
+            warm_errors.pop("client", None)
+            logger.info("Pyrogram client started successfully")
+            return
         except Exception as e:
-            logger.warning(f"Could not cache dialogs: {e}")
+            warm_errors["client"] = str(e)
+            logger.error(f"Failed to start Pyrogram client: {e} (retrying in {delay}s)")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 300)
+
+
+async def cache_dialogs():
+    """Cache all dialogs so channel ids resolve"""
+    logger.info("Caching dialogs...")
+    count = 0
+    async for dialog in client.get_dialogs(limit=100):
+        count += 1
+    logger.info(f"Cached {count} dialogs")
+
+
+async def warm_up():
+    """Bring the client, peers, file index, DC sessions and first-page thumbnails up in the background"""
+    await start_client()
+    await retry_warm_step("peers", cache_dialogs)
+
+    # File index
+    files = []
+    channel_id = get_channel_id()
+    if channel_id:
+        files = await retry_warm_step("file_index", lambda: get_channel_files(channel_id, force=True))
+    else:
+        warm_state["file_index"] = True
+
+    # DC sessions - one per DC that holds indexed files, plus the home DC
+    dc_ids = {await get_home_dc()}
+    dc_ids.update(f["dc_id"] for f in files if f.get("dc_id"))
+    results = await asyncio.gather(*(warm_dc_session(dc_id) for dc_id in dc_ids), return_exceptions=True)
+    for dc_id, result in zip(dc_ids, results):
+        if isinstance(result, Exception):
+            warm_errors[f"dc_{dc_id}"] = str(result)
+            logger.warning(f"Could not open media session for DC {dc_id}: {result}")
+    warm_state["dc_sessions"] = True
+
+    # Thumbnails of the hottest files, then the newest
+    fetched = 0
+    try:
+        scores = {(hot["chat_id"], hot["message_id"]): hot["score"] for hot in await hot_files(500)}
     except Exception as e:
-        logger.error(f"Failed to start Pyrogram client: {e}")
-        # Don't raise here, let the app start anyway
-    
+        logger.warning(f"Could not rank thumbnails by popularity: {e}")
+        scores = {}
+    candidates = sorted(
+        (f for f in files if f["has_thumbnail"]),
+        key=lambda f: scores.get((f["channel_id"], f["message_id"]), 0),
+        reverse=True
+    )[:WARMUP_THUMBNAILS]
+    for file_info in candidates:
+        try:
+            await get_thumbnail_bytes(file_info["channel_id"], file_info["message_id"])
+            fetched += 1
+        except Exception as e:
+            logger.warning(f"Thumbnail prefetch failed for {file_info['message_id']}: {e}")
+    warm_state["thumbnails"] = True
+    logger.info(f"Warm-up complete ({fetched} thumbnails prefetched)")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Handle application lifespan events"""
+    # Startup - serve immediately, warm up in the background
+    global relay_http
+    load_probe_results()
+    if not isinstance(client, GatewayClient):
+        load_access_log()
+    background_tasks = [asyncio.create_task(warm_up())]
+    if PROBE_AUTO:
+        background_tasks.append(asyncio.create_task(probe_worker()))
+    if STREAMER_NODES:
+        background_tasks.append(asyncio.create_task(monitor_streamers()))
+    if FFMPEG_AVAILABLE and STORYBOARD_AUTO and not isinstance(client, GatewayClient):
+        background_tasks.append(asyncio.create_task(storyboard_worker()))
+    if WARM_CACHE_MB > 0 and not isinstance(client, GatewayClient):
+        background_tasks.append(asyncio.create_task(warm_cache_loop()))
+    if SYNC_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(sync_loop()))
+    if STREAMER_RELAY:
+        relay_http = httpx.AsyncClient(
+            timeout=httpx.Timeout(30, connect=5),
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=60)
+        )
+
     yield
-    
+
     # Shutdown
+    for task in background_tasks:
+        task.cancel()
+    for job in list(remux_jobs.values()):
+        job["task"].cancel()
+    flush_access_log()
+    if relay_http:
+        await relay_http.aclose()
     try:
-        await client.stop()
-        logger.info("Pyrogram client stopped")
+        if client.is_connected:
+            await stop_hedge_sessions()
+            await client.stop()
+            logger.info("Pyrogram client stopped")
     except Exception as e:
         logger.warning(f"Error stopping client: {e}")
 
@@ -102,6 +2335,40 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 # Setup templates
 templates = Jinja2Templates(directory="templates")
 
+# Content-hashed, pre-compressed static assets linked from the templates
+assets = AssetPipeline("static")
+templates.env.globals["asset_url"] = assets.url
+templates.env.globals["asset_version"] = assets.version
+logger.info(f"Asset pipeline: {len(assets.assets)} files, version {assets.version}")
+
+
+@app.get("/sw.js")
+async def service_worker():
+    """Service worker at the root scope; its cache names follow the asset version"""
+    script = assets.assets["sw.js"].variants["identity"].decode().replace("__ASSET_VERSION__", assets.version)
+    return Response(script, media_type="text/javascript", headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/assets/{name:path}")
+async def asset(name: str, request: Request):
+    """Fingerprinted static file - cached forever, served in the best encoding the client accepts"""
+    static_asset = assets.get(name)
+    if not static_asset:
+        raise HTTPException(status_code=404, detail="Asset not found")
+
+    headers = {
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "ETag": static_asset.etag,
+        "Vary": "Accept-Encoding"
+    }
+    if request.headers.get("if-none-match") == static_asset.etag:
+        return Response(status_code=304, headers=headers)
+
+    encoding, body = static_asset.negotiate(request.headers.get("accept-encoding", ""))
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type=static_asset.content_type, headers=headers)
+
 
 @app.get("/cache-test", response_class=HTMLResponse)
 async def cache_test(request: Request):
@@ -109,32 +2376,71 @@ async def cache_test(request: Request):
     return templates.TemplateResponse("cache_test.html", {"request": request})
 
 
+@app.get("/healthz")
+async def healthz():
+    """Liveness probe - the process is up and serving HTTP"""
+    return {"status": "alive", "uptime": int(time.time() - started_at)}
+
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness probe - only route media traffic here once the components are warm"""
+    ready = all(warm_state[name] for name in READY_COMPONENTS)
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "ready": ready,
+            "components": warm_state,
+            "errors": warm_errors,
+            # Relay mode keeps node URLs away from browsers - nodes are numbered in STREAMER_URL order
+            "streamers": {
+                str(number) if STREAMER_RELAY else url: node
+                for number, (url, node) in enumerate(streamer_nodes.items())
+            },
+            "cache": {
+                "chunks": len(chunk_cache),
+                "chunk_bytes": chunk_stats["bytes"],
+                "warm_chunks": len(warm_chunks),
+                "local_files": len(local_maps),
+                "hits": chunk_stats["hits"],
+                "misses": chunk_stats["misses"]
+            },
+            "streams": {**stream_stats, "recent": list(recent_recoveries)},
+            "links": {
+                str(dc_id): {"throughput_kbps": round(link["throughput"] / 1024), "rtt_ms": round(link["rtt"] * 1000)}
+                for dc_id, link in dc_links.items()
+            },
+            "hedging": {
+                "requests": hedge_stats["requests"],
+                "hedged": hedge_stats["hedged"],
+                "won": hedge_stats["won"],
+                "delay_ms": {
+                    f"{dc_id}/{PART_CLASSES[size_class] // 1024}k": round(hedge_delay(dc_id, PART_CLASSES[size_class]) * 1000)
+                    for dc_id, slot, size_class in getfile_latencies if slot == 0
+                }
+            },
+            "uptime": int(time.time() - started_at)
+        }
+    )
+
+
 @app.get("/", response_class=HTMLResponse)
 async def root(request: Request):
     """Main page - shows file list from channel"""
     try:
-        # Get channel ID from env or use default
-        channel_id = CHANNEL_ID if CHANNEL_ID else None
+        channel_id = get_channel_id()
         
         if not channel_id:
             return templates.TemplateResponse("setup.html", {"request": request})
         
-        # Convert channel_id to int if it's a string number
-        try:
-            channel_id = int(channel_id)
-        except (ValueError, TypeError):
-            pass  # Keep as string if it's a username like @channel
+        # Cold or stale index: send the shell now and the cards as history arrives
+        entry = file_index.get(str(channel_id))
+        if STREAM_RENDER and not index_fresh(entry):
+            return stream_index_page(request, channel_id)
         
-        # Fetch messages with media from the channel directly
-        # No need to resolve peer first, just iterate
-        files = []
+        # Serve the listing from the channel index, re-walking history only when it is stale
         try:
-            async for message in client.get_chat_history(channel_id, limit=100):
-                if message.media:
-                    file_info = extract_file_info(message, channel_id)
-                    if file_info:
-                        files.append(file_info)
-            
+            files = await get_channel_files(channel_id)
             logger.info(f"Found {len(files)} files in channel {channel_id}")
         except Exception as e:
             logger.error(f"Error fetching messages: {e}")
@@ -143,17 +2449,10 @@ async def root(request: Request):
                 "error": f"Cannot access channel/group. Make sure you're a member and have sent at least one message there. Error: {str(e)}"
             })
         
-        # Add timestamp for cache busting
-        import time
-        timestamp = str(int(time.time()))
-        
-        return templates.TemplateResponse("index.html", {
-            "request": request,
-            "files": files,
-            "channel_id": channel_id,
-            "total_files": len(files),
-            "timestamp": timestamp
-        })
+        page = render_index_page(request, channel_id, files)
+        if request.headers.get("if-none-match") == page["etag"]:
+            return Response(status_code=304, headers={"ETag": page["etag"]})
+        return HTMLResponse(page["html"], headers={"ETag": page["etag"], "Cache-Control": "no-cache"})
         
     except Exception as e:
         logger.error(f"Error loading files: {e}")
@@ -163,6 +2462,73 @@ async def root(request: Request):
         })
 
 
+def render_index_page(request: Request, channel_id, files: List[Dict]) -> Dict:
+    """Render the file browser once per listing version and keep it in memory"""
+    key = str(channel_id)
+    version = index_versions.get(key, 0)
+    page = page_cache.get(key)
+    if page and page["version"] == version:
+        return page
+
+    # Only the first page is rendered; the grid loads the rest from /api/files as it scrolls
+    first_page, next_cursor = index_first_page(channel_id, files)
+    html = templates.get_template("index.html").render({
+        "request": request,
+        "files": first_page,
+        "files_data": files_data_script(first_page, next_cursor),
+        "channel_id": channel_id,
+        "total_files": len(files)
+    }).encode()
+    page = {"version": version, "html": html, "etag": f'"{hashlib.sha1(html).hexdigest()[:16]}"'}
+    page_cache[key] = page
+    return page
+
+
+def files_data_script(page: List[Dict], next_cursor: Optional[int]) -> str:
+    """Embedded first-page records the virtualized grid starts from"""
+    data = json.dumps({"files": page, "next_cursor": next_cursor, "page_size": FILES_PAGE_SIZE}).replace("</", "<\\/")
+    return f'<script id="files-data" type="application/json">{data}</script>'
+
+
+def index_first_page(channel_id, files: List[Dict]):
+    """First page of an indexed listing and the cursor that continues it"""
+    page = files[:FILES_PAGE_SIZE]
+    if len(files) > FILES_PAGE_SIZE:
+        return page, page[-1]["message_id"]
+    return page, file_index.get(str(channel_id), {}).get("history_end")
+
+
+def stream_index_page(request: Request, channel_id) -> StreamingResponse:
+    """Send the page shell at once, then each file card as the history walk produces it"""
+    shell = templates.get_template("index.html").render({
+        "request": request,
+        "files": [],
+        "channel_id": channel_id,
+        "total_files": "…",
+        "stream_grid": True
+    })
+    head, tail = shell.split("<!--file-grid-->", 1)
+    card = templates.get_template("file_card.html")
+
+    async def body():
+        yield head
+        files = []
+        try:
+            async for file_info in iter_channel_files(channel_id):
+                if len(files) < FILES_PAGE_SIZE:
+                    yield card.render(file=file_info)
+                files.append(file_info)
+        except Exception as e:
+            logger.error(f"Error fetching messages: {e}")
+            yield f'<div class="file-name">Cannot access channel: {escape(str(e))}</div>'
+        page, next_cursor = index_first_page(channel_id, files)
+        yield f"<script>document.querySelector('.stat-value').textContent = {len(files)};</script>"
+        yield files_data_script(page, next_cursor)
+        yield tail
+
+    return StreamingResponse(body(), media_type="text/html", headers={"Cache-Control": "no-cache"})
+
+
 @app.get("/recent", response_class=HTMLResponse)
 async def recent(request: Request):
     """Recent downloads page"""
@@ -172,19 +2538,12 @@ async def recent(request: Request):
 @app.get("/settings", response_class=HTMLResponse)
 async def settings(request: Request):
     """Settings page"""
-    channel_id = CHANNEL_ID if CHANNEL_ID else None
+    channel_id = get_channel_id()
     total_files = 0
     
     if channel_id:
         try:
-            channel_id = int(channel_id)
-        except (ValueError, TypeError):
-            pass
-        
-        try:
-            async for message in client.get_chat_history(channel_id, limit=100):
-                if message.media:
-                    total_files += 1
+            total_files = len(await get_channel_files(channel_id))
         except:
             pass
     
@@ -273,8 +2632,11 @@ async def stream_options(chat_id: str, message_id: int):
     )
 
 @app.head("/stream/{chat_id}/{message_id}")
-async def stream_head(chat_id: str, message_id: int):
+async def stream_head(chat_id: str, message_id: int, request: Request):
     """Handle HEAD requests for streaming"""
+    if STREAMER_RELAY and STREAMER_NODES:
+        return await relay_stream(request, *streamer_route(chat_id, message_id))
+    
     try:
         # Convert chat_id
         if isinstance(chat_id, str) and chat_id.startswith('@'):
@@ -557,45 +2919,26 @@ async def direct_stream_media(chat_id: str, message_id: int):
             mime_type = message.audio.mime_type or "audio/mpeg"
             file_name = message.audio.file_name or f"audio_{message_id}.mp3"
         
-        # Use a different streaming approach with smaller chunks
+        ref = media_ref_from_message(message, actual_chat_id)
+        
+        # GetFile parts sized by the planner: small first, ramping to 1 MiB
         async def direct_stream():
             try:
-                # Use smaller chunk size for more reliable streaming
-                chunk_size = 64 * 1024  # 64KB chunks
                 offset = 0
                 chunk_count = 0
+                if ref and ref["file_size"]:
+                    source = resumable_range(ref, 0, ref["file_size"] - 1, f"Direct stream {chat_id}/{message_id}")
+                else:
+                    source = client.stream_media(message)
                 
-                while True:
-                    try:
-                        # Download chunk by chunk
-                        chunk_data = await client.download_media(
-                            message, 
-                            file_name=None,  # Don't save to file
-                            in_memory=True,
-                            progress=None,
-                            progress_args=(),
-                            offset=offset,
-                            limit=chunk_size
-                        )
-                        
-                        if not chunk_data or len(chunk_data) == 0:
-                            break
-                            
-                        chunk_count += 1
-                        offset += len(chunk_data)
-                        
-                        if chunk_count % 100 == 0:
-                            logger.info(f"Direct stream: {chunk_count} chunks, {offset // (1024*1024)}MB")
-                        
-                        yield chunk_data
-                        
-                        # If we got less than requested, we're at the end
-                        if len(chunk_data) < chunk_size:
-                            break
-                            
-                    except Exception as chunk_error:
-                        logger.error(f"Chunk download error: {chunk_error}")
-                        break
+                async for chunk_data in source:
+                    chunk_count += 1
+                    offset += len(chunk_data)
+                    
+                    if chunk_count % 100 == 0:
+                        logger.info(f"Direct stream: {chunk_count} chunks, {offset // (1024*1024)}MB")
+                    
+                    yield chunk_data
                         
                 logger.info(f"Direct stream completed: {chunk_count} chunks, {offset // (1024*1024)}MB")
                 
@@ -714,17 +3057,21 @@ async def raw_stream_media(chat_id: str, message_id: int, request: Request):
         # DISABLE range requests - they cause OFFSET_INVALID errors with Telegram API
         # Always stream the full file to avoid Telegram API offset issues
         logger.info(f"Streaming full file: {file_name} ({file_size} bytes)")
+        ref = media_ref_from_message(message, actual_chat_id)
         
-        # Optimized full file streaming with larger chunks
+        # Full file through the chunk cache, resumed in place after transient errors
         async def raw_stream():
             try:
                 chunk_count = 0
                 total_bytes = 0
-                # Use larger chunks for better performance (2MB)
-                async for chunk in client.stream_media(message, limit=2 * 1024 * 1024):
+                if ref and file_size:
+                    source = resumable_range(ref, 0, file_size - 1, f"Raw stream {chat_id}/{message_id}")
+                else:
+                    source = client.stream_media(message)
+                async for chunk in source:
                     chunk_count += 1
                     total_bytes += len(chunk)
-                    if chunk_count % 25 == 0:  # Log every 50MB
+                    if chunk_count % 50 == 0:  # Log every 50MB
                         logger.info(f"Raw stream: {chunk_count} chunks, {total_bytes // (1024*1024)}MB")
                     yield chunk
                 logger.info(f"Raw stream completed: {chunk_count} chunks, {total_bytes // (1024*1024)}MB")
@@ -808,7 +3155,7 @@ async def simple_stream_media(chat_id: str, message_id: int):
 
 
 @app.get("/proxy/{chat_id}/{message_id}")
-async def proxy_media(chat_id: str, message_id: int, request: Request):
+async def proxy_media(chat_id: str, message_id: int, request: Request, t: float = None):
     """Enhanced proxy with better range request support for external players"""
     try:
         logger.info(f"Proxy request: {chat_id}/{message_id}")
@@ -861,8 +3208,23 @@ async def proxy_media(chat_id: str, message_id: int, request: Request):
             mime_type = message.document.mime_type or "application/octet-stream"
             file_name = message.document.file_name or f"document_{message_id}"
         
+        ref = media_ref_from_message(message, actual_chat_id)
+        
         # Enhanced range request handling
         range_header = request.headers.get("range")
+        if ref and (not range_header or range_header.startswith("bytes=0-")):
+            record_play(ref, request)
+        elif ref:
+            track_access(ref, request, seeks=1)
+        
+        # ?t=seconds starts at the keyframe at or before t in a single request
+        seek_time = None
+        if t is not None and not range_header and ref:
+            try:
+                seek_time, offset = await resolve_seek(ref, t)
+                range_header = f"bytes={offset}-"
+            except HTTPException:
+                logger.info(f"Seek ignored for non-MP4 {chat_id}/{message_id}")
         
         if range_header and file_size > 0:
             # Parse range header
@@ -884,23 +3246,12 @@ async def proxy_media(chat_id: str, message_id: int, request: Request):
                     content_length = end - start + 1
                     logger.info(f"Limited range to: {start}-{end}/{file_size} ({content_length} bytes)")
                 
-                # Stream specific range with optimized chunk size
+                # Stream the exact byte range through the chunk cache
+                # (stream_media's offset/limit count 1 MiB chunks, not bytes)
                 async def stream_range():
                     try:
-                        bytes_sent = 0
-                        chunk_size = min(1024 * 1024, content_length)  # 1MB or remaining bytes
-                        
-                        async for chunk in client.stream_media(message, offset=start, limit=content_length):
-                            if bytes_sent + len(chunk) > content_length:
-                                # Trim last chunk to exact size
-                                chunk = chunk[:content_length - bytes_sent]
-                            
+                        async for chunk in resumable_range(ref, start, end, f"Proxy {chat_id}/{message_id}"):
                             yield chunk
-                            bytes_sent += len(chunk)
-                            
-                            if bytes_sent >= content_length:
-                                break
-                                
                     except Exception as e:
                         logger.error(f"Range stream error: {e}")
                         # Don't re-raise to avoid Content-Length mismatch
@@ -916,9 +3267,11 @@ async def proxy_media(chat_id: str, message_id: int, request: Request):
                     "Access-Control-Expose-Headers": "Content-Range, Content-Length",
                     "Cache-Control": "public, max-age=3600"
                 }
+                if seek_time is not None:
+                    headers["X-Seek-Time"] = f"{seek_time:.3f}"
                 
                 return StreamingResponse(
-                    stream_range(),
+                    count_served(ref, request, stream_range()),
                     status_code=206,
                     headers=headers,
                     media_type=mime_type
@@ -932,7 +3285,11 @@ async def proxy_media(chat_id: str, message_id: int, request: Request):
             try:
                 chunk_count = 0
                 total_bytes = 0
-                async for chunk in client.stream_media(message):
+                if ref and file_size > 0:
+                    source = resumable_range(ref, 0, file_size - 1, f"Proxy {chat_id}/{message_id}")
+                else:
+                    source = client.stream_media(message)
+                async for chunk in source:
                     chunk_count += 1
                     total_bytes += len(chunk)
                     
@@ -952,34 +3309,681 @@ async def proxy_media(chat_id: str, message_id: int, request: Request):
             "Content-Type": mime_type,
             "Content-Disposition": f'inline; filename="{sanitize_filename(file_name)}"',
             "Accept-Ranges": "bytes",
-            "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Methods": "GET, HEAD, OPTIONS",
-            "Access-Control-Allow-Headers": "Range, Content-Type",
-            "Access-Control-Expose-Headers": "Content-Range, Content-Length, Accept-Ranges",
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Methods": "GET, HEAD, OPTIONS",
+            "Access-Control-Allow-Headers": "Range, Content-Type",
+            "Access-Control-Expose-Headers": "Content-Range, Content-Length, Accept-Ranges",
+            "Cache-Control": "public, max-age=3600",
+            # Headers specifically for external players
+            "X-Content-Type-Options": "nosniff",
+            "Connection": "keep-alive"
+        }
+        
+        # Only add Content-Length for smaller files to avoid mismatch issues
+        if file_size > 0 and file_size < 50 * 1024 * 1024:  # Only for files < 50MB
+            headers["Content-Length"] = str(file_size)
+        
+        return StreamingResponse(
+            count_served(ref, request, stream_full()) if ref else stream_full(),
+            headers=headers,
+            media_type=mime_type
+        )
+        
+    except Exception as e:
+        logger.error(f"Proxy error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.head("/faststart/{chat_id}/{message_id}")
+@app.get("/faststart/{chat_id}/{message_id}")
+async def faststart_media(chat_id: str, message_id: int, request: Request, t: float = None):
+    """
+    Serve a file with Range support; MP4s with moov at the end are served as a
+    virtual faststart file (moov moved to the front, chunk offsets rewritten),
+    so players start without first fetching the tail.
+    ?t=seconds without a Range header answers from the keyframe at or before t.
+    """
+    ref = await get_media_ref(resolve_chat_id(chat_id), message_id)
+    file_size = ref["file_size"]
+    if not file_size:
+        raise HTTPException(status_code=404, detail="File size unknown")
+
+    index = None
+    segments = None
+    if ref["mime_type"] in ("video/mp4", "audio/mp4", "video/quicktime"):
+        index = await get_mp4_index(ref)
+        segments = index.faststart_layout() if index else None
+    layout = "relocated" if segments else "original"
+    if not segments:
+        segments = [("src", 0, file_size)]
+    total_size = sum(len(seg[1]) if seg[0] == "mem" else seg[2] for seg in segments)
+
+    range_header = request.headers.get("range")
+    seek_time = None
+    if t is not None and not range_header:
+        seek_time, offset = await resolve_seek(ref, t, index)
+        # Files outside the MP4 types (resolve_seek loaded their index) are served as stored
+        range_header = f"bytes={index.faststart_offset(offset) if layout == 'relocated' else offset}-"
+
+    byte_range = parse_range_header(range_header, total_size)
+    start, end = byte_range or (0, total_size - 1)
+
+    headers = {
+        "Content-Type": ref["mime_type"],
+        "Content-Length": str(end - start + 1),
+        "Content-Disposition": f'inline; filename="{sanitize_filename(ref["file_name"])}"',
+        "Accept-Ranges": "bytes",
+        "Access-Control-Allow-Origin": "*",
+        "Access-Control-Allow-Headers": "Range, Content-Type",
+        "Access-Control-Expose-Headers": "Content-Range, Content-Length, Accept-Ranges",
+        "Cache-Control": "public, max-age=3600",
+        "X-Faststart": layout
+    }
+    if seek_time is not None:
+        headers["X-Seek-Time"] = f"{seek_time:.3f}"
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{total_size}"
+    status_code = 206 if byte_range else 200
+
+    if request.method == "HEAD":
+        return Response(status_code=status_code, headers=headers)
+    if start == 0:
+        record_play(ref, request)
+    else:
+        track_access(ref, request, seeks=1)
+
+    async def body():
+        try:
+            async for piece in iter_layout(ref, segments, start, end):
+                yield piece
+        except Exception as e:
+            logger.error(f"Faststart stream error for {chat_id}/{message_id}: {e}")
+
+    return StreamingResponse(count_served(ref, request, body()), status_code=status_code, headers=headers, media_type=ref["mime_type"])
+
+
+async def resolve_seek(ref: Dict, t: float, index: mp4index.Mp4Index = None):
+    """Return (keyframe time, source byte offset) of the keyframe at or before t seconds"""
+    if index is None and ref["file_size"]:
+        index = await get_mp4_index(ref)
+    keyframe = index.seek(max(t, 0.0)) if index else None
+    if keyframe is None:
+        raise HTTPException(status_code=415, detail="Seeking by time is only available for MP4/MOV files")
+    return keyframe
+
+
+@app.get("/seek/{chat_id}/{message_id}")
+async def seek_media(chat_id: str, message_id: int, t: float, request: Request):
+    """
+    Resolve a time to the byte offset of the keyframe at or before it, so
+    clients of any byte-range endpoint (including tg-streamer /stream) seek
+    with a single Range request.
+    """
+    ref = await get_media_ref(resolve_chat_id(chat_id), message_id)
+    index = await get_mp4_index(ref) if ref["file_size"] else None
+    keyframe_time, offset = await resolve_seek(ref, t, index)
+    track_access(ref, request, seeks=1)
+    return {
+        "requested": t,
+        "time": round(keyframe_time, 3),
+        "offset": offset,
+        "range": f"bytes={offset}-",
+        "faststart_offset": index.faststart_offset(offset),
+        "duration": round(index.duration, 3),
+        "keyframes": len(index.keyframe_index())
+    }
+
+
+async def get_hls_source(chat_id: str, message_id: int):
+    """Return (media ref, MP4 index) of a file that can be segmented for HLS"""
+    ref = await get_media_ref(resolve_chat_id(chat_id), message_id)
+    index = await get_mp4_index(ref) if ref["file_size"] else None
+    if not index or not index.hls_tracks:
+        raise HTTPException(status_code=415, detail="HLS is only available for MP4/MOV files")
+    return ref, index
+
+
+HLS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Cache-Control": "public, max-age=3600"
+}
+
+
+@app.get("/hls/{chat_id}/{message_id}/index.m3u8")
+async def hls_playlist(chat_id: str, message_id: int, request: Request):
+    """
+    HLS VOD playlist over fMP4 segments cut at the file's keyframes.
+    Segments are generated from the cached sample tables without transcoding;
+    their media bytes come straight from the source file.
+    """
+    ref, index = await get_hls_source(chat_id, message_id)
+    segments = index.hls_segments(HLS_SEGMENT_SECONDS)
+
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:7",
+        f"#EXT-X-TARGETDURATION:{max(int(end - start + 0.999) for start, end in segments)}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD",
+        "#EXT-X-INDEPENDENT-SEGMENTS",
+        '#EXT-X-MAP:URI="init.mp4"'
+    ]
+    for number, (start, end) in enumerate(segments):
+        lines.append(f"#EXTINF:{end - start:.3f},")
+        lines.append(f"seg{number}.m4s")
+    lines.append("#EXT-X-ENDLIST")
+
+    # The player asks for the first segment next
+    schedule_prefetch(ref, index.hls_fragment(0, HLS_SEGMENT_SECONDS))
+    record_play(ref, request)
+
+    return Response("\n".join(lines) + "\n", media_type="application/vnd.apple.mpegurl", headers=HLS_HEADERS)
+
+
+@app.get("/hls/{chat_id}/{message_id}/init.mp4")
+async def hls_init_segment(chat_id: str, message_id: int):
+    """fMP4 initialization segment for the HLS playlist"""
+    _, index = await get_hls_source(chat_id, message_id)
+    return Response(index.hls_init(), media_type="video/mp4", headers=HLS_HEADERS)
+
+
+@app.get("/hls/{chat_id}/{message_id}/seg{number:int}.m4s")
+async def hls_media_segment(chat_id: str, message_id: int, number: int):
+    """One fMP4 media segment; the next segment is prefetched into the chunk cache"""
+    ref, index = await get_hls_source(chat_id, message_id)
+    count = len(index.hls_segments(HLS_SEGMENT_SECONDS))
+    if number >= count:
+        raise HTTPException(status_code=404, detail="Segment not found")
+
+    layout = index.hls_fragment(number, HLS_SEGMENT_SECONDS)
+    if number + 1 < count:
+        schedule_prefetch(ref, index.hls_fragment(number + 1, HLS_SEGMENT_SECONDS))
+    size = sum(len(seg[1]) if seg[0] == "mem" else seg[2] for seg in layout)
+
+    async def body():
+        try:
+            async for piece in iter_layout(ref, layout, 0, size - 1):
+                yield piece
+        except Exception as e:
+            logger.error(f"HLS segment {number} error for {chat_id}/{message_id}: {e}")
+
+    headers = {**HLS_HEADERS, "Content-Length": str(size)}
+    return StreamingResponse(body(), headers=headers, media_type="video/iso.segment")
+
+
+def remux_cache_path(file_unique_id: str) -> str:
+    return os.path.join(CACHE_DIR, "remux", f"{file_unique_id}.mp4")
+
+
+def trim_remux_cache():
+    """Delete least recently used remuxed files beyond REMUX_CACHE_MB"""
+    directory = os.path.join(CACHE_DIR, "remux")
+    entries = []
+    for name in os.listdir(directory):
+        if name.endswith(".mp4"):
+            path = os.path.join(directory, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= REMUX_CACHE_MB * 1024 * 1024:
+            break
+        os.remove(path)
+        total -= size
+        logger.info(f"Evicted remux cache file {path}")
+
+
+async def run_remux(job: Dict, source_url: str):
+    """Run ffmpeg in copy mode and append its fragmented MP4 output to the job's part file"""
+    process = None
+    try:
+        process = await asyncio.create_subprocess_exec(
+            FFMPEG_PATH, "-hide_banner", "-loglevel", "error",
+            "-user_agent", REMUX_USER_AGENT, "-i", source_url,
+            "-map", "0:v:0?", "-map", "0:a:0?", "-c", "copy",
+            "-f", "mp4", "-movflags", "frag_keyframe+empty_moov+default_base_moof",
+            "pipe:1",
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+
+        # Reading the pipe in fixed blocks keeps memory bounded; ffmpeg blocks when we fall behind
+        while True:
+            block = await process.stdout.read(REMUX_BLOCK_SIZE)
+            if not block:
+                break
+            job["file"].write(block)
+            job["file"].flush()
+            job["size"] += len(block)
+            async with job["changed"]:
+                job["changed"].notify_all()
+
+        stderr = await process.stderr.read()
+        if await process.wait() != 0:
+            job["error"] = stderr.decode(errors="replace").strip()[-500:] or f"ffmpeg exited with {process.returncode}"
+            logger.error(f"Remux failed for {job['key']}: {job['error']}")
+        else:
+            os.replace(job["part"], job["path"])
+            logger.info(f"Remuxed {job['key']}: {job['size'] // (1024*1024)}MB cached")
+            trim_remux_cache()
+    except asyncio.CancelledError:
+        logger.info(f"Remux of {job['key']} cancelled - no viewers left")
+        raise
+    except Exception as e:
+        job["error"] = str(e)
+        logger.error(f"Remux error for {job['key']}: {e}")
+    finally:
+        if process and process.returncode is None:
+            process.kill()
+            await process.wait()
+        job["file"].close()
+        if os.path.exists(job["part"]):
+            os.remove(job["part"])
+        job["done"] = True
+        remux_jobs.pop(job["key"], None)
+        async with job["changed"]:
+            job["changed"].notify_all()
+
+
+def start_remux(ref: Dict) -> Dict:
+    """Start a remux job reading the source through the loopback /faststart endpoint (seekable, chunk-cached)"""
+    key = ref["file_unique_id"]
+    path = remux_cache_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    part = f"{path}.{os.getpid()}.part"
+
+    job = {
+        "key": key, "path": path, "part": part, "file": open(part, "wb"),
+        "size": 0, "done": False, "error": None, "viewers": 0,
+        "changed": asyncio.Condition()
+    }
+    source_url = f"http://127.0.0.1:{PORT}/faststart/{ref['chat_id']}/{ref['message_id']}"
+    job["task"] = asyncio.create_task(run_remux(job, source_url))
+    remux_jobs[key] = job
+    return job
+
+
+def release_remux_viewer(job: Dict):
+    """Drop a viewer; the last one leaving an unfinished job stops ffmpeg"""
+    job["viewers"] -= 1
+    if job["viewers"] == 0 and not job["done"]:
+        job["task"].cancel()
+
+
+async def follow_remux(job: Dict, f) -> AsyncGenerator[bytes, None]:
+    """Yield a remux job's output from an already open file as it is written, from the start"""
+    try:
+        with f:
+            position = 0
+            while True:
+                async with job["changed"]:
+                    await job["changed"].wait_for(lambda: job["size"] > position or job["done"])
+                if job["size"] > position:
+                    # Off the event loop, like read_local - other viewers must not wait on this disk read
+                    block = await asyncio.get_running_loop().run_in_executor(
+                        None, f.read, min(job["size"] - position, 4 * REMUX_BLOCK_SIZE)
+                    )
+                    position += len(block)
+                    yield block
+                elif job["done"]:
+                    break
+    finally:
+        release_remux_viewer(job)
+
+
+def iter_file_range(path: str, start: int, end: int, block_size: int = REMUX_BLOCK_SIZE):
+    """Yield bytes start..end (inclusive) of a file on disk"""
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            block = f.read(min(block_size, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+
+@app.get("/remux/{chat_id}/{message_id}")
+async def remux_media(chat_id: str, message_id: int, request: Request):
+    """
+    Remux MKV/MOV/AVI to fragmented MP4 with ffmpeg in copy mode (no re-encode).
+    The first viewer starts ffmpeg and later viewers follow the same output;
+    finished files are served from the disk cache with Range support.
+    """
+    if not FFMPEG_AVAILABLE:
+        raise HTTPException(status_code=501, detail="ffmpeg is not installed on this server")
+
+    ref = await get_media_ref(resolve_chat_id(chat_id), message_id)
+    record_play(ref, request)
+    headers = {
+        "Content-Type": "video/mp4",
+        "Content-Disposition": f'inline; filename="{sanitize_filename(os.path.splitext(ref["file_name"])[0])}.mp4"',
+        "Access-Control-Allow-Origin": "*",
+        "Access-Control-Expose-Headers": "Content-Range, Content-Length, Accept-Ranges"
+    }
+
+    path = remux_cache_path(ref["file_unique_id"])
+    if os.path.exists(path):
+        os.utime(path)
+        size = os.path.getsize(path)
+        byte_range = parse_range_header(request.headers.get("range"), size)
+        start, end = byte_range or (0, size - 1)
+        headers.update({
+            "Content-Length": str(end - start + 1),
+            "Accept-Ranges": "bytes",
             "Cache-Control": "public, max-age=3600",
-            # Headers specifically for external players
-            "X-Content-Type-Options": "nosniff",
-            "Connection": "keep-alive"
-        }
-        
-        # Only add Content-Length for smaller files to avoid mismatch issues
-        if file_size > 0 and file_size < 50 * 1024 * 1024:  # Only for files < 50MB
-            headers["Content-Length"] = str(file_size)
-        
+            "X-Remux": "cached"
+        })
+        if byte_range:
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
         return StreamingResponse(
-            stream_full(),
+            iter_file_range(path, start, end),
+            status_code=206 if byte_range else 200,
             headers=headers,
-            media_type=mime_type
+            media_type="video/mp4"
         )
-        
+
+    job = remux_jobs.get(ref["file_unique_id"])
+    if job is None:
+        if len(remux_jobs) >= REMUX_MAX_JOBS:
+            raise HTTPException(status_code=503, detail="Too many remux jobs running", headers={"Retry-After": "30"})
+        job = start_remux(ref)
+
+    # Hold the request until ffmpeg produced output, so failures surface as errors instead of empty bodies
+    job["viewers"] += 1
+    try:
+        async with job["changed"]:
+            await job["changed"].wait_for(lambda: job["size"] > 0 or job["done"])
+    except BaseException:
+        release_remux_viewer(job)
+        raise
+    if job["size"] == 0 or job["error"]:
+        release_remux_viewer(job)
+        raise HTTPException(status_code=502, detail=f"Remux failed: {job['error']}")
+
+    # Open now: once ffmpeg finishes the part file is renamed to the cache path
+    try:
+        f = open(job["path"] if job["done"] else job["part"], "rb")
+    except OSError:
+        # Finished and already evicted from the remux cache
+        release_remux_viewer(job)
+        raise HTTPException(status_code=503, detail="Remux output no longer available", headers={"Retry-After": "1"})
+    headers.update({"Cache-Control": "no-store", "X-Remux": "live"})
+    return StreamingResponse(follow_remux(job, f), headers=headers, media_type="video/mp4")
+
+
+def storyboard_cache_path(file_unique_id: str, extension: str) -> str:
+    return os.path.join(CACHE_DIR, "storyboard", f"{file_unique_id}.{extension}")
+
+
+def format_vtt_time(seconds: float) -> str:
+    hours, rest = divmod(seconds, 3600)
+    minutes, rest = divmod(rest, 60)
+    return f"{int(hours):02d}:{int(minutes):02d}:{rest:06.3f}"
+
+
+async def render_storyboard(ref: Dict) -> bool:
+    """
+    Render the storyboard sprite and WebVTT track of an MP4 into the disk cache.
+
+    Only the chosen keyframes are read from Telegram; they are wrapped in a
+    video-only fragmented MP4 and decoded by one ffmpeg process straight into
+    a tiled sprite. Returns False for files that cannot have a storyboard.
+    Runs in the gateway in worker mode, so each file is rendered once.
+    """
+    if isinstance(client, GatewayClient):
+        return await client.call("render_storyboard", ref)
+
+    key = ref["file_unique_id"]
+    index = await get_mp4_index(ref) if ref["file_size"] else None
+    video = index.video if index else None
+    if not video or not video.width or not video.height:
+        return False
+
+    samples = index.storyboard_samples(STORYBOARD_TILES, min_interval=2.0)
+    if not samples:
+        return False
+
+    async with storyboard_semaphore:
+        started = time.time()
+        layout = index.keyframe_layout([sample for _, sample in samples])
+        source = b"".join([
+            segment[1] if segment[0] == "mem" else await read_span(ref, segment[1], segment[2])
+            for segment in layout
+        ])
+
+        tile_width = STORYBOARD_TILE_WIDTH
+        tile_height = max(2, round(tile_width * video.height / video.width / 2) * 2)
+        columns = min(STORYBOARD_COLUMNS, len(samples))
+        rows = (len(samples) + columns - 1) // columns
+
+        process = await asyncio.create_subprocess_exec(
+            FFMPEG_PATH, "-hide_banner", "-loglevel", "error",
+            "-f", "mp4", "-i", "pipe:0",
+            "-vf", f"scale={tile_width}:{tile_height},tile={columns}x{rows}",
+            "-frames:v", "1", "-q:v", "5", "-f", "image2", "-c:v", "mjpeg", "pipe:1",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            sprite, stderr = await asyncio.wait_for(process.communicate(source), timeout=120)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise RuntimeError("ffmpeg timed out")
+        if process.returncode != 0 or not sprite:
+            raise RuntimeError(stderr.decode(errors="replace").strip()[-500:] or f"ffmpeg exited with {process.returncode}")
+
+    cues = ["WEBVTT", ""]
+    for number, (start, _) in enumerate(samples):
+        end = samples[number + 1][0] if number + 1 < len(samples) else max(index.duration, start + 1)
+        x, y = (number % columns) * tile_width, (number // columns) * tile_height
+        cues += [f"{format_vtt_time(start)} --> {format_vtt_time(end)}", f"sprite.jpg#xywh={x},{y},{tile_width},{tile_height}", ""]
+
+    # Write-then-rename so other workers never see half-written files; the VTT lands last
+    for extension, content in (("jpg", sprite), ("vtt", "\n".join(cues).encode())):
+        path = storyboard_cache_path(key, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.{os.getpid()}.part", "wb") as f:
+            f.write(content)
+        os.replace(f"{path}.{os.getpid()}.part", path)
+
+    logger.info(f"Storyboard for {key}: {len(samples)} tiles from {len(source) // 1024}KB in {time.time() - started:.1f}s")
+    return True
+
+
+def ensure_storyboard(ref: Dict) -> asyncio.Task:
+    """Return the render task of a file's storyboard, starting it once per file_unique_id"""
+    key = ref["file_unique_id"]
+    task = storyboard_jobs.get(key)
+    if task is None:
+        task = storyboard_jobs[key] = asyncio.create_task(render_storyboard(ref))
+
+        def finished(task: asyncio.Task):
+            # Keep successes and "not possible" results; failed renders are retried on the next request only
+            if task.cancelled() or task.exception():
+                storyboard_jobs.pop(key, None)
+                storyboard_failures[key] = time.time()
+
+        task.add_done_callback(finished)
+    return task
+
+
+def queue_storyboards(refs: List[Dict]):
+    """Queue background storyboard renders for indexed MP4s that have none yet"""
+    if not (FFMPEG_AVAILABLE and STORYBOARD_AUTO):
+        return
+    refs = [
+        ref for ref in refs
+        if ref["mime_type"] == "video/mp4" and not os.path.exists(storyboard_cache_path(ref["file_unique_id"], "vtt"))
+    ]
+    if isinstance(client, GatewayClient):
+        if refs:
+            async def forward():
+                try:
+                    await client.call("queue_storyboards", refs)
+                except Exception as e:
+                    logger.warning(f"Could not queue storyboards in the gateway: {e}")
+
+            asyncio.ensure_future(forward())
+        return
+
+    now = time.time()
+    for ref in refs:
+        key = ref["file_unique_id"]
+        if key not in storyboard_jobs and key not in storyboard_queued \
+                and now - storyboard_failures.get(key, 0) > STORYBOARD_RETRY_AFTER:
+            storyboard_queued.add(key)
+            storyboard_queue.put_nowait(ref)
+
+
+async def storyboard_worker():
+    """Render queued storyboards one at a time in the background"""
+    while True:
+        ref = await storyboard_queue.get()
+        storyboard_queued.discard(ref["file_unique_id"])
+        if os.path.exists(storyboard_cache_path(ref["file_unique_id"], "vtt")):
+            continue
+        try:
+            await ensure_storyboard(ref)
+        except Exception as e:
+            logger.warning(f"Background storyboard for {ref['file_unique_id']} failed: {e}")
+
+
+async def get_storyboard_file(chat_id: str, message_id: int, extension: str) -> str:
+    """Return the cached storyboard file, rendering it first when needed"""
+    if not FFMPEG_AVAILABLE:
+        raise HTTPException(status_code=501, detail="ffmpeg is not installed on this server")
+
+    ref = await get_media_ref(resolve_chat_id(chat_id), message_id)
+    path = storyboard_cache_path(ref["file_unique_id"], extension)
+    if os.path.exists(path):
+        return path
+
+    try:
+        rendered = await asyncio.wait_for(asyncio.shield(ensure_storyboard(ref)), timeout=60)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="Storyboard is still rendering", headers={"Retry-After": "10"})
     except Exception as e:
-        logger.error(f"Proxy error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        logger.error(f"Storyboard render failed for {chat_id}/{message_id}: {e}")
+        raise HTTPException(status_code=502, detail=f"Storyboard render failed: {str(e)}")
+    if not rendered:
+        raise HTTPException(status_code=415, detail="Storyboards are only available for MP4/MOV video")
+    return path
+
+
+@app.get("/storyboard/{chat_id}/{message_id}/thumbs.vtt")
+async def storyboard_vtt(chat_id: str, message_id: int):
+    """WebVTT track mapping time ranges to tiles of sprite.jpg, for Plyr previewThumbnails"""
+    path = await get_storyboard_file(chat_id, message_id, "vtt")
+    with open(path) as f:
+        vtt = f.read()
+    return Response(vtt, media_type="text/vtt", headers={"Cache-Control": "public, max-age=86400"})
+
+
+@app.get("/storyboard/{chat_id}/{message_id}/sprite.jpg")
+async def storyboard_sprite(chat_id: str, message_id: int):
+    """Storyboard sprite sheet"""
+    path = await get_storyboard_file(chat_id, message_id, "jpg")
+    with open(path, "rb") as f:
+        sprite = f.read()
+    return Response(sprite, media_type="image/jpeg", headers={"Cache-Control": "public, max-age=86400"})
+
+
+@app.get("/zip/{chat_id}")
+async def zip_download(chat_id: str, ids: str, request: Request, name: str = None):
+    """
+    Stream several files as one stored ZIP64 archive: /zip/{chat_id}?ids=12,15,18
+
+    The archive length is known upfront, so the response has a Content-Length
+    and honours Range for resuming. Member data streams through the chunk cache
+    while the next member's first chunks are prefetched.
+    """
+    try:
+        message_ids = [int(i) for i in ids.split(",") if i.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be a comma-separated list of message ids")
+    if not message_ids or len(message_ids) > ZIP_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"Between 1 and {ZIP_MAX_FILES} message ids are required")
+
+    actual_chat_id = resolve_chat_id(chat_id)
+    try:
+        found = await get_media_refs(actual_chat_id, message_ids)
+    except Exception as e:
+        logger.error(f"Failed to resolve ZIP members in {chat_id}: {e}")
+        raise HTTPException(status_code=404, detail=f"Could not fetch messages: {str(e)}")
+
+    refs = [found[message_id] for message_id in message_ids if message_id in found]
+    if not refs:
+        raise HTTPException(status_code=404, detail="None of the messages contain media")
+
+    plan = zipstream.ZipPlan([{"name": ref["file_name"], "size": ref["file_size"], "date": ref.get("date", 0)} for ref in refs])
+    etag = '"' + hashlib.sha256(
+        "|".join(f"{ref['file_unique_id']}:{name}" for ref, name in zip(refs, plan.names)).encode()
+    ).hexdigest()[:32] + '"'
+
+    range_header = request.headers.get("range")
+    if request.headers.get("if-range") not in (None, etag):
+        range_header = None
+    byte_range = parse_range_header(range_header, plan.total_size)
+    start, end = byte_range or (0, plan.total_size - 1)
+
+    def read_data(i: int, lo: int, hi: int):
+        return iter_range(refs[i], lo, hi)
+
+    async def get_crc(i: int) -> int:
+        key = refs[i]["file_unique_id"]
+        if key not in crc_cache:
+            # Only ranged requests that skip a member's data get here
+            logger.info(f"Computing CRC of {key} for a resumed ZIP")
+            crc = 0
+            async for piece in iter_range(refs[i], 0, refs[i]["file_size"] - 1):
+                crc = zlib.crc32(piece, crc)
+            on_crc(i, crc)
+        return crc_cache[key]
+
+    def on_crc(i: int, crc: int):
+        crc_cache[refs[i]["file_unique_id"]] = crc
+        while len(crc_cache) > CRC_CACHE_SIZE:
+            crc_cache.popitem(last=False)
+
+    def on_member(i: int):
+        if i + 1 < len(refs) and refs[i + 1]["file_size"]:
+            schedule_prefetch(refs[i + 1], [("src", 0, min(refs[i + 1]["file_size"], 2 * CHUNK_SIZE))])
+
+    async def body():
+        try:
+            async for piece in zipstream.iter_zip(plan, start, end, read_data, get_crc, on_crc, on_member):
+                yield piece
+        except Exception as e:
+            logger.error(f"ZIP stream error for {chat_id}: {e}")
+
+    archive_name = sanitize_filename(name or f"telegram_{len(refs)}_files") + ("" if (name or "").endswith(".zip") else ".zip")
+    headers = {
+        "Content-Type": "application/zip",
+        "Content-Length": str(end - start + 1),
+        "Content-Disposition": f'attachment; filename="{archive_name}"',
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Access-Control-Allow-Origin": "*",
+        "Access-Control-Expose-Headers": "Content-Range, Content-Length, Accept-Ranges, ETag"
+    }
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{plan.total_size}"
+
+    return StreamingResponse(body(), status_code=206 if byte_range else 200, headers=headers, media_type="application/zip")
 
 
 @app.get("/stream/{chat_id}/{message_id}")
 async def stream_media(chat_id: str, message_id: int, request: Request):
     """Stream media with enhanced error handling and debugging"""
+    if STREAMER_RELAY and STREAMER_NODES:
+        return await relay_stream(request, *streamer_route(chat_id, message_id))
+    
     try:
         logger.info(f"Stream request: chat_id={chat_id}, message_id={message_id}")
         
@@ -1093,43 +4097,25 @@ async def stream_media(chat_id: str, message_id: int, request: Request):
 
 
 @app.get("/thumbnail/{chat_id}/{message_id}")
-async def get_thumbnail(chat_id: int, message_id: int):
-    """Get thumbnail for a message"""
+async def get_thumbnail(chat_id: int, message_id: int, request: Request, v: str = None):
+    """Get thumbnail for a message; ?v= (the thumbnail's unique id) makes the response immutable"""
     try:
-        # Convert chat_id to int if needed
-        try:
-            chat_id = int(chat_id)
-        except (ValueError, TypeError):
-            pass
-        
-        # Fetch the message
-        message = await client.get_messages(chat_id, message_id)
+        # A versioned URL names one exact thumbnail - revalidate without asking Telegram
+        etag = f'"{v}"' if v else None
+        if etag and request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
         
-        if not message or not message.media:
-            raise HTTPException(status_code=404, detail="Message or media not found")
-        
-        # Get thumbnail based on media type
-        thumb_data = None
-        mime_type = "image/jpeg"
-        
-        if message.photo:
-            # For photos, download the smallest size (thumbnail)
-            thumb_data = await client.download_media(message, in_memory=True)
-        elif message.video and message.video.thumbs:
-            # For videos, get the thumbnail
-            thumb_data = await client.download_media(message.video.thumbs[0].file_id, in_memory=True)
-        elif message.document and message.document.thumbs:
-            # For documents with thumbnails
-            thumb_data = await client.download_media(message.document.thumbs[0].file_id, in_memory=True)
-        elif message.animation and message.animation.thumbs:
-            # For animations/GIFs
-            thumb_data = await client.download_media(message.animation.thumbs[0].file_id, in_memory=True)
+        thumb_data = await get_thumbnail_bytes(chat_id, message_id)
         
         if thumb_data:
-            return StreamingResponse(
-                iter([thumb_data.getvalue()]),
-                media_type=mime_type,
-                headers={"Cache-Control": "public, max-age=86400"}
+            if etag:
+                headers = {"Cache-Control": "public, max-age=31536000, immutable", "ETag": etag}
+            else:
+                headers = {"Cache-Control": "public, max-age=86400", "ETag": f'"{hashlib.sha1(thumb_data).hexdigest()[:16]}"'}
+            return Response(
+                content=thumb_data,
+                media_type="image/jpeg",
+                headers=headers
             )
         else:
             raise HTTPException(status_code=404, detail="No thumbnail available")
@@ -1142,8 +4128,11 @@ async def get_thumbnail(chat_id: int, message_id: int):
 
 
 @app.get("/api/files")
-async def list_files(channel: str = None):
-    """API endpoint to list files from a channel"""
+async def list_files(channel: str = None, cursor: int = None, limit: int = None):
+    """
+    API endpoint to list files from a channel. With cursor and/or limit, one
+    page of files older than cursor plus next_cursor (null at the channel start).
+    """
     try:
         channel_id = channel if channel else CHANNEL_ID
         if not channel_id:
@@ -1155,12 +4144,11 @@ async def list_files(channel: str = None):
         except (ValueError, TypeError):
             pass
         
-        files = []
-        async for message in client.get_chat_history(channel_id, limit=100):
-            if message.media:
-                file_info = extract_file_info(message, channel_id)
-                if file_info:
-                    files.append(file_info)
+        if cursor is not None or limit is not None:
+            page, next_cursor = await get_files_page(channel_id, cursor, min(limit or FILES_PAGE_SIZE, 200))
+            return {"files": page, "next_cursor": next_cursor}
+        
+        files = await get_channel_files(channel_id)
         
         return {"files": files, "total": len(files)}
         
@@ -1169,6 +4157,128 @@ async def list_files(channel: str = None):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/api/hot")
+async def api_hot(limit: int = 50):
+    """Files ranked by decayed popularity, with plays, bytes served, seeks and distinct clients"""
+    return {
+        "files": await hot_files(max(1, min(limit, 500))),
+        "half_life_hours": HOT_HALF_LIFE_HOURS
+    }
+
+
+@app.get("/api/files/changes")
+async def file_changes(since: int = 0, channel: str = None):
+    """Files added after message id since, plus the current ids so deletions can be applied"""
+    channel_id = channel or CHANNEL_ID
+    if not channel_id:
+        raise HTTPException(status_code=400, detail="Channel ID not provided")
+    try:
+        files = await get_channel_files(resolve_chat_id(str(channel_id)))
+    except Exception as e:
+        logger.error(f"Error listing changes: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    return changes_since(files, since)
+
+
+@app.get("/api/files/events")
+async def file_events(request: Request, since: int = None, channel: str = None):
+    """
+    Server-Sent Events stream of listing changes. Each "files" event carries
+    the changes_since payload and its latest message id as the event id, so a
+    reconnecting EventSource resumes from Last-Event-ID.
+    """
+    channel_id = channel or CHANNEL_ID
+    if not channel_id:
+        raise HTTPException(status_code=400, detail="Channel ID not provided")
+    channel_id = resolve_chat_id(str(channel_id))
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id and last_event_id.isdigit():
+        since = int(last_event_id)
+
+    queue: asyncio.Queue = asyncio.Queue()
+    sync_listeners.add(queue)
+
+    async def events():
+        cursor = since
+        try:
+            files = await get_channel_files(channel_id)
+            if cursor is None:
+                cursor = max((f["message_id"] for f in files), default=0)
+            else:
+                # Catch up on whatever happened while the client was away
+                payload = changes_since(files, cursor)
+                cursor = payload["latest"]
+                yield f"id: {cursor}\nevent: files\ndata: {json.dumps(payload)}\n\n"
+
+            while True:
+                try:
+                    key = await asyncio.wait_for(queue.get(), timeout=25)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if key != str(channel_id):
+                    continue
+                payload = changes_since(file_index[key]["files"], cursor)
+                cursor = payload["latest"]
+                yield f"id: {cursor}\nevent: files\ndata: {json.dumps(payload)}\n\n"
+        finally:
+            sync_listeners.discard(queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+
+class MetaRequest(BaseModel):
+    ids: List[int]
+    channel: Optional[str] = None
+
+
+@app.post("/api/meta")
+async def api_meta(payload: MetaRequest):
+    """
+    Metadata for up to 200 messages of a channel. Cache misses are resolved
+    with a single get_messages call; results fill the media reference cache
+    used by the streaming endpoints.
+    """
+    channel_id = payload.channel or CHANNEL_ID
+    if not channel_id:
+        raise HTTPException(status_code=400, detail="Channel ID not provided")
+    if not payload.ids or len(payload.ids) > 200:
+        raise HTTPException(status_code=400, detail="Between 1 and 200 message ids are required")
+
+    channel_id = resolve_chat_id(str(channel_id))
+    cached = sum(1 for message_id in set(payload.ids) if f"{channel_id}:{message_id}" in media_cache)
+    try:
+        refs = await get_media_refs(channel_id, payload.ids)
+    except Exception as e:
+        logger.error(f"Batch metadata error for {channel_id}: {e}")
+        raise HTTPException(status_code=502, detail=f"Could not fetch messages: {str(e)}")
+
+    files = []
+    for message_id in payload.ids:
+        ref = refs.get(message_id)
+        if not ref:
+            files.append({"message_id": message_id, "found": False})
+            continue
+        files.append({
+            "message_id": message_id,
+            "found": True,
+            "name": ref["file_name"],
+            "size": ref["file_size"],
+            "mime_type": ref["mime_type"],
+            "can_stream": ref["can_stream"],
+            "stream_quality": ref["stream_quality"],
+            "dc_id": ref["dc_id"],
+            "has_thumbnail": ref["has_thumbnail"],
+            "thumbnail_url": f"/thumbnail/{channel_id}/{message_id}" if ref["has_thumbnail"] else None,
+            "probe": probe_results.get(ref["file_unique_id"])
+        })
+
+    return {"files": files, "cached": cached, "fetched": len(set(payload.ids)) - cached}
+
+
 def extract_file_info(message: Message, channel_id: str) -> Dict:
     """Extract file information from a message"""
     file_info = {
@@ -1180,6 +4290,11 @@ def extract_file_info(message: Message, channel_id: str) -> Dict:
         "can_stream": False,
     }
     
+    media = get_media(message)
+    if media:
+        file_info["file_unique_id"] = media.file_unique_id
+        file_info["dc_id"] = FileId.decode(media.file_id).dc_id
+    
     # H.264 MP4 is the gold standard for web streaming
     excellent_streaming_formats = [
         "video/mp4",  # H.264 MP4 - best for web
@@ -1295,23 +4410,68 @@ def extract_file_info(message: Message, channel_id: str) -> Dict:
     else:
         return None
     
+    # The thumbnail's own unique id versions its URL, so browsers may cache it as immutable
+    if file_info["has_thumbnail"] and media:
+        thumbs = None if message.photo else getattr(media, "thumbs", None)
+        file_info["thumbnail_version"] = thumbs[0].file_unique_id if thumbs else media.file_unique_id
+    
+    # Probed type and codecs beat the declared MIME
+    if file_info.get("file_unique_id") in probe_results:
+        apply_probe(file_info, probe_results[file_info["file_unique_id"]])
+    
+    # Signed streamer path - tg-streamer serves it without a metadata RPC
+    if STREAM_SECRET and media:
+        file_info["signed_path"] = sign_stream_path(file_info, media.file_id)
+    
+    set_file_urls(file_info)
+    return file_info
+
+
+def set_file_urls(file_info: Dict):
+    """Fill in the download, stream and player URLs of a listing entry from its type"""
+    channel_id = file_info["channel_id"]
+    message_id = file_info["message_id"]
+    # Type-specific URLs are rebuilt when a probe changes the type
+    for key in ("hls_url", "storyboard_url", "remux_url"):
+        file_info.pop(key, None)
+    
     # Generate URLs - use external streamer if available for better performance
-    if STREAMER_URL:
-        file_info["download_url"] = f"{STREAMER_URL}/stream/{channel_id}/{message.id}"
-        file_info["stream_url"] = f"{STREAMER_URL}/stream/{channel_id}/{message.id}"
+    if STREAMER_NODES and STREAMER_RELAY:
+        # Browsers only ever see this app; the relay picks the node per request
+        file_info["download_url"] = f"/stream/{channel_id}/{message_id}"
+        file_info["stream_url"] = f"/stream/{channel_id}/{message_id}"
+        file_info["external_streamer"] = False
+        file_info["performance"] = "relayed"
+    elif STREAMER_NODES:
+        streamer = pick_streamer(file_info.get("file_unique_id") or f"{channel_id}:{message_id}")
+        path = file_info.get("signed_path") or f"/stream/{channel_id}/{message_id}"
+        file_info["download_url"] = f"{streamer}{path}"
+        file_info["stream_url"] = f"{streamer}{path}"
         file_info["external_streamer"] = True
         file_info["performance"] = "optimized"
     else:
-        file_info["download_url"] = f"/dl/{channel_id}/{message.id}"
-        file_info["stream_url"] = f"/raw-stream/{channel_id}/{message.id}"
+        file_info["download_url"] = f"/dl/{channel_id}/{message_id}"
+        file_info["stream_url"] = f"/raw-stream/{channel_id}/{message_id}"
         file_info["external_streamer"] = False
         file_info["performance"] = "basic"
+        if file_info["type"] == "video/mp4":
+            # Seekable, and moov-at-end files start without fetching the tail
+            file_info["stream_url"] = f"/faststart/{channel_id}/{message_id}"
+            file_info["hls_url"] = f"/hls/{channel_id}/{message_id}/index.m3u8"
+    
+    # Scrub previews for the built-in player
+    if FFMPEG_AVAILABLE and file_info["type"] == "video/mp4":
+        file_info["storyboard_url"] = f"/storyboard/{channel_id}/{message_id}/thumbs.vtt"
+    
+    # Containers browsers cannot play get a remuxed fragmented MP4 stream
+    if FFMPEG_AVAILABLE and file_info["type"] in REMUX_TYPES:
+        file_info["remux_url"] = f"/remux/{channel_id}/{message_id}"
     
     # Generate thumbnail URL if available
     if file_info["has_thumbnail"]:
-        file_info["thumbnail_url"] = f"/thumbnail/{channel_id}/{message.id}"
-    
-    return file_info
+        file_info["thumbnail_url"] = f"/thumbnail/{channel_id}/{message_id}"
+        if file_info.get("thumbnail_version"):
+            file_info["thumbnail_url"] += f"?v={file_info['thumbnail_version']}"
 
 
 def format_size(bytes: int) -> str:
@@ -1323,6 +4483,13 @@ def format_size(bytes: int) -> str:
     return f"{bytes:.2f} PB"
 
 
+def format_duration(seconds: float) -> str:
+    """Format a duration as H:MM:SS or M:SS"""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+
 def get_file_icon(mime_type: str) -> str:
     """Get emoji icon based on file type"""
     if not mime_type:
@@ -1358,19 +4525,16 @@ async def stream_file(chat_id: int, message_id: int) -> AsyncGenerator[bytes, No
         bytes: File chunks
     """
     try:
-        # Fetch the message
-        message = await client.get_messages(chat_id, message_id)
-        
-        if not message:
-            raise HTTPException(status_code=404, detail="Message not found")
+        ref = await get_media_ref(chat_id, message_id)
         
-        # Check if message contains media
-        if not message.media:
-            raise HTTPException(status_code=400, detail="Message does not contain any media")
+        # Bulk download: full 1 MiB parts from the start, several in flight, resumed after transient errors
+        if ref["file_size"]:
+            async for chunk in resumable_range(ref, 0, ref["file_size"] - 1, f"Download {chat_id}/{message_id}", bulk=True):
+                yield chunk
+            return
         
-        # Stream the file in chunks (1MB chunks for better performance on large files)
-        chunk_size = 1024 * 1024  # 1MB chunks
-        async for chunk in client.stream_media(message, limit=chunk_size):
+        message = await client.get_messages(chat_id, message_id)
+        async for chunk in client.stream_media(message):
             yield chunk
             
     except RPCError as e:
@@ -1381,11 +4545,16 @@ async def stream_file(chat_id: int, message_id: int) -> AsyncGenerator[bytes, No
         raise HTTPException(status_code=500, detail=f"Streaming error: {str(e)}")
 
 
+@app.head("/dl/{chat_id}/{message_id}")
 @app.get("/dl/{chat_id}/{message_id}")
-async def download_file(chat_id: int, message_id: int):
+async def download_file(chat_id: str, message_id: int, request: Request):
     """
     Stream a file from Telegram as HTTP download
     
+    Single and multiple byte ranges are served (206, multipart/byteranges for
+    several), validated by an ETag of the file's unique id and If-Range, so
+    browsers can resume and segmented downloaders can split the file.
+    
     Args:
         chat_id: Telegram chat/channel ID (can be username or numeric ID)
         message_id: Message ID containing the file
@@ -1393,88 +4562,169 @@ async def download_file(chat_id: int, message_id: int):
     Returns:
         StreamingResponse: File stream with appropriate headers
     """
-    try:
-        # Fetch message metadata first
-        message = await client.get_messages(chat_id, message_id)
-        
-        if not message:
-            raise HTTPException(status_code=404, detail="Message not found")
-        
-        if not message.media:
-            raise HTTPException(status_code=400, detail="Message does not contain any media")
-        
-        # Extract file metadata
-        file_name = "file"
-        file_size = 0
-        mime_type = "application/octet-stream"
-        
-        if message.document:
-            file_name = message.document.file_name or f"document_{message_id}"
-            file_size = message.document.file_size
-            mime_type = message.document.mime_type or mime_type
-        elif message.video:
-            file_name = message.video.file_name or f"video_{message_id}.mp4"
-            file_size = message.video.file_size
-            mime_type = message.video.mime_type or "video/mp4"
-        elif message.audio:
-            file_name = message.audio.file_name or f"audio_{message_id}.mp3"
-            file_size = message.audio.file_size
-            mime_type = message.audio.mime_type or "audio/mpeg"
-        elif message.photo:
-            file_name = f"photo_{message_id}.jpg"
-            file_size = message.photo.file_size
-            mime_type = "image/jpeg"
-        elif message.voice:
-            file_name = f"voice_{message_id}.ogg"
-            file_size = message.voice.file_size
-            mime_type = message.voice.mime_type or "audio/ogg"
-        elif message.video_note:
-            file_name = f"video_note_{message_id}.mp4"
-            file_size = message.video_note.file_size
-            mime_type = "video/mp4"
-        elif message.animation:
-            file_name = message.animation.file_name or f"animation_{message_id}.mp4"
-            file_size = message.animation.file_size
-            mime_type = message.animation.mime_type or "video/mp4"
-        
-        # Guess mime type from filename if not available
-        if mime_type == "application/octet-stream":
-            guessed_type = mimetypes.guess_type(file_name)[0]
-            if guessed_type:
-                mime_type = guessed_type
-        
+    ref = await get_media_ref(resolve_chat_id(chat_id), message_id)
+    file_name = sanitize_filename(ref["file_name"])
+    file_size = ref["file_size"]
+    mime_type = ref["mime_type"]
+
+    # Telegram files never change, so the unique id is a strong validator
+    etag = f'"{ref["file_unique_id"]}"'
+    headers = {
+        "Content-Disposition": f'attachment; filename="{file_name}"',
+        "Content-Type": mime_type,
+        "Accept-Ranges": "bytes" if file_size else "none",
+        "ETag": etag,
+        "Access-Control-Allow-Origin": "*",
+        "Access-Control-Allow-Headers": "Range, If-Range",
+        "Access-Control-Expose-Headers": "Content-Range, Content-Length, Accept-Ranges, ETag"
+    }
+    if ref.get("date"):
+        headers["Last-Modified"] = formatdate(ref["date"], usegmt=True)
+
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if if_range is not None and if_range not in (etag, headers.get("Last-Modified")):
+        range_header = None
+    ranges = parse_byte_ranges(range_header, file_size) if file_size else None
+
+    if not ranges:
         logger.info(f"Streaming file: {file_name} ({file_size} bytes) from chat {chat_id}, message {message_id}")
-        
-        # Prepare headers
-        headers = {
-            "Content-Disposition": f'attachment; filename="{file_name}"',
-            "Content-Type": mime_type,
-            "Accept-Ranges": "none"
-        }
-        
-        # Add Content-Length if available
         if file_size > 0:
             headers["Content-Length"] = str(file_size)
-        
-        # Return streaming response
-        return StreamingResponse(
-            stream_file(chat_id, message_id),
-            headers=headers,
-            media_type=mime_type
+        if request.method == "HEAD":
+            return Response(headers=headers)
+        body = iter_range(ref, 0, file_size - 1) if local_map(ref) is not None else stream_file(ref["chat_id"], message_id)
+        return StreamingResponse(count_served(ref, request, body), headers=headers, media_type=mime_type)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+        headers["Content-Length"] = str(end - start + 1)
+        parts = [(b"", start, end)]
+        closing = b""
+    else:
+        boundary = os.urandom(12).hex()
+        headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+        parts = [
+            (f"\r\n--{boundary}\r\nContent-Type: {mime_type}\r\nContent-Range: bytes {start}-{end}/{file_size}\r\n\r\n".encode(), start, end)
+            for start, end in ranges
+        ]
+        closing = f"\r\n--{boundary}--\r\n".encode()
+        headers["Content-Length"] = str(sum(len(head) + end - start + 1 for head, start, end in parts) + len(closing))
+    logger.info(f"Streaming ranges {ranges} of {file_name} from chat {chat_id}, message {message_id}")
+
+    if request.method == "HEAD":
+        return Response(status_code=206, headers=headers)
+
+    async def body():
+        try:
+            for head, start, end in parts:
+                if head:
+                    yield head
+                async for piece in iter_range(ref, start, end):
+                    yield piece
+            if closing:
+                yield closing
+        except Exception as e:
+            logger.error(f"Download range error for {chat_id}/{message_id}: {e}")
+
+    return StreamingResponse(count_served(ref, request, body()), status_code=206, headers=headers, media_type=headers["Content-Type"])
+
+
+async def gateway_download_media(message: Message) -> bytes:
+    """Download a whole file into memory on behalf of a worker"""
+    data = await client.download_media(message, in_memory=True)
+    return data.getvalue()
+
+
+async def gateway_queue_storyboards(refs: List[Dict]):
+    """Queue background storyboard renders on behalf of a worker"""
+    queue_storyboards(refs)
+
+
+async def gateway_render_storyboard(ref: Dict) -> bool:
+    """Render a storyboard on behalf of a worker, once per file_unique_id across all workers"""
+    return await ensure_storyboard(ref)
+
+
+async def run_gateway(path: str):
+    """Own the Telegram session and serve HTTP workers over a Unix socket"""
+    global client
+    client = create_telegram_client()
+    load_access_log()
+
+    # A transient error at boot must not kill the gateway - every worker depends on it
+    await start_client()
+    await retry_warm_step("peers", cache_dialogs)
+    background_tasks = []
+    if WARM_CACHE_MB > 0:
+        background_tasks.append(asyncio.create_task(warm_cache_loop()))
+    if FFMPEG_AVAILABLE and STORYBOARD_AUTO:
+        background_tasks.append(asyncio.create_task(storyboard_worker()))
+
+    async def ping():
+        return True
+
+    try:
+        await gateway.serve(
+            path,
+            handlers={
+                "ping": ping,
+                "get_messages": client.get_messages,
+                "download_media": gateway_download_media,
+                "fetch_file_part": fetch_file_part,
+                "read_chunk": read_chunk,
+                "read_part": read_part,
+                "offer_warm_videos": offer_warm_videos,
+                "materialize_file": materialize_file,
+                "record_access": record_access,
+                "hot_files": hot_files,
+                "warm_dc_session": warm_dc_session,
+                "get_home_dc": get_home_dc,
+                "queue_storyboards": gateway_queue_storyboards,
+                "render_storyboard": gateway_render_storyboard
+            },
+            streams={
+                "get_chat_history": client.get_chat_history,
+                "get_dialogs": client.get_dialogs,
+                "stream_media": client.stream_media
+            }
         )
-        
-    except HTTPException:
-        raise
-    except RPCError as e:
-        logger.error(f"Telegram API error: {e}")
-        raise HTTPException(status_code=403, detail=f"Access denied or invalid chat/message: {str(e)}")
-    except Exception as e:
-        logger.error(f"Error processing request: {e}")
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        flush_access_log()
+        await stop_hedge_sessions()
+        await client.stop()
+
+
+def run_gateway_process(path: str):
+    """Entry point of the gateway child process"""
+    asyncio.run(run_gateway(path))
 
 
 if __name__ == "__main__":
     import uvicorn
+    import multiprocessing
     # Render provides PORT env variable, default to 8000 for local dev
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    
+    if len(sys.argv) > 1 and sys.argv[1] == "gateway":
+        # Standalone gateway: run workers separately with GATEWAY_SOCKET pointing here
+        run_gateway_process(GATEWAY_SOCKET or "/tmp/tg-gateway.sock")
+    elif HTTP_WORKERS > 1:
+        socket_path = GATEWAY_SOCKET or "/tmp/tg-gateway.sock"
+        gateway_process = multiprocessing.Process(target=run_gateway_process, args=(socket_path,), daemon=True)
+        gateway_process.start()
+        
+        # Workers are fresh interpreters importing main; this makes them gateway clients
+        os.environ["GATEWAY_SOCKET"] = socket_path
+        try:
+            uvicorn.run("main:app", host="0.0.0.0", port=port, workers=HTTP_WORKERS, timeout_keep_alive=KEEP_ALIVE_TIMEOUT)
+        finally:
+            gateway_process.terminate()
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=port, timeout_keep_alive=KEEP_ALIVE_TIMEOUT)
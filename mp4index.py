@@ -0,0 +1,568 @@
+"""
+MP4 (ISO BMFF) Index
+Locates and parses the moov atom of an MP4 once, keeps its sample tables, and
+builds a virtual "faststart" layout with moov moved in front of the media data
+without downloading the file.
+"""
+
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+# Boxes whose payload is just child boxes, on the path to the sample tables
+CONTAINER_BOXES = {b"moov", b"trak", b"mdia", b"minf", b"stbl", b"edts", b"dinf", b"mvex"}
+
+# Largest moov we are willing to load (sample tables of very long files)
+MAX_MOOV_SIZE = 64 * 1024 * 1024
+
+# trun sample flags: sync samples depend on nothing, others are non-sync and depend on earlier samples
+SYNC_SAMPLE_FLAGS = 0x02000000
+NON_SYNC_SAMPLE_FLAGS = 0x01010000
+
+# Async reader: (offset, length) -> bytes
+Reader = Callable[[int, int], Awaitable[bytes]]
+
+
+def read_box_header(data: bytes, pos: int, end: int = None) -> Optional[Tuple[bytes, int, int]]:
+    """Return (type, size, header size) of the box at pos, or None if it does not fit"""
+    end = len(data) if end is None else end
+    if pos + 8 > end:
+        return None
+
+    size, box_type = struct.unpack_from(">I4s", data, pos)
+    header_size = 8
+    if size == 1:
+        if pos + 16 > end:
+            return None
+        (size,) = struct.unpack_from(">Q", data, pos + 8)
+        header_size = 16
+    elif size == 0:
+        size = end - pos
+
+    if size < header_size:
+        return None
+    return box_type, size, header_size
+
+
+def iter_boxes(data: bytes, start: int = 0, end: int = None):
+    """Yield (type, position, size, header size) for the boxes in data[start:end]"""
+    end = len(data) if end is None else end
+    pos = start
+    while pos < end:
+        header = read_box_header(data, pos, end)
+        if header is None:
+            return
+        box_type, size, header_size = header
+        yield box_type, pos, size, header_size
+        pos += size
+
+
+def find_box(data: bytes, path: List[bytes], start: int = 0, end: int = None) -> Optional[Tuple[int, int]]:
+    """Return the payload span (start, end) of the first box at a nested path"""
+    end = len(data) if end is None else end
+    for box_type, pos, size, header_size in iter_boxes(data, start, end):
+        if box_type == path[0]:
+            if len(path) == 1:
+                return pos + header_size, pos + size
+            return find_box(data, path[1:], pos + header_size, pos + size)
+    return None
+
+
+def make_box(box_type: bytes, body: bytes) -> bytes:
+    """Serialize a box"""
+    return struct.pack(">I4s", 8 + len(body), box_type) + body
+
+
+def make_full_box(box_type: bytes, version: int, flags: int, body: bytes) -> bytes:
+    """Serialize a box with a version/flags header"""
+    return make_box(box_type, struct.pack(">I", (version << 24) | flags) + body)
+
+
+def fragment_header(number: int, runs: List[Tuple], payload: int) -> bytes:
+    """
+    moof + mdat header of fragment `number` for runs of (track, first sample,
+    last sample, offset of the run in the mdat payload).
+    """
+    def moof(data_start: int) -> bytes:
+        mfhd = make_full_box(b"mfhd", 0, 0, struct.pack(">I", number + 1))
+        trafs = b"".join(track.fragment(first, last, data_start + offset) for track, first, last, offset in runs)
+        return make_box(b"moof", mfhd + trafs)
+
+    # moof size does not depend on the offsets it carries
+    return moof(len(moof(0)) + 8) + struct.pack(">I4s", 8 + payload, b"mdat")
+
+
+class Track:
+    """One trak of a moov, with its sample tables decoded lazily"""
+
+    def __init__(self, moov: bytes, start: int, end: int):
+        self.moov = moov
+        self.span = (start, end)
+        self.track_id = 0
+        self.handler = ""
+        self.timescale = 1
+        self.duration = 0
+        self.codec = ""
+        self.width = 0
+        self.height = 0
+        self._samples = None
+
+        tkhd = find_box(moov, [b"tkhd"], start, end)
+        if tkhd:
+            version = moov[tkhd[0]]
+            if version == 1:
+                (self.track_id,) = struct.unpack_from(">I", moov, tkhd[0] + 20)
+                dims = tkhd[0] + 4 + 32 + 52
+            else:
+                (self.track_id,) = struct.unpack_from(">I", moov, tkhd[0] + 12)
+                dims = tkhd[0] + 4 + 20 + 52
+            if dims + 8 <= tkhd[1]:
+                width, height = struct.unpack_from(">II", moov, dims)
+                self.width, self.height = width >> 16, height >> 16
+
+        mdhd = find_box(moov, [b"mdia", b"mdhd"], start, end)
+        if mdhd:
+            if moov[mdhd[0]] == 1:
+                self.timescale, self.duration = struct.unpack_from(">IQ", moov, mdhd[0] + 20)
+            else:
+                self.timescale, self.duration = struct.unpack_from(">II", moov, mdhd[0] + 12)
+            self.timescale = self.timescale or 1
+
+        hdlr = find_box(moov, [b"mdia", b"hdlr"], start, end)
+        if hdlr:
+            self.handler = moov[hdlr[0] + 8:hdlr[0] + 12].decode("latin-1")
+
+        stsd = self.stbl_box(b"stsd")
+        if stsd and stsd[0] + 16 <= stsd[1]:
+            self.codec = moov[stsd[0] + 12:stsd[0] + 16].decode("latin-1")
+            if self.handler == "vide" and stsd[0] + 8 + 36 <= stsd[1]:
+                # Visual sample entry: width/height after 24 bytes of reserved/predefined fields
+                width, height = struct.unpack_from(">HH", moov, stsd[0] + 8 + 32)
+                self.width, self.height = self.width or width, self.height or height
+
+    def stbl_box(self, box_type: bytes) -> Optional[Tuple[int, int]]:
+        return find_box(self.moov, [b"mdia", b"minf", b"stbl", box_type], *self.span)
+
+    @property
+    def duration_seconds(self) -> float:
+        return self.duration / self.timescale
+
+    def samples(self) -> Dict[str, array]:
+        """
+        Decode the sample tables into flat per-sample arrays:
+        offset (absolute file position), size, dts and cts (timescale units),
+        plus the 0-based indices of sync samples (None means every sample is sync).
+        """
+        if self._samples is not None:
+            return self._samples
+
+        moov = self.moov
+        sizes = array("I")
+        stsz = self.stbl_box(b"stsz")
+        if stsz:
+            sample_size, count = struct.unpack_from(">II", moov, stsz[0] + 4)
+            if sample_size:
+                sizes = array("I", [sample_size]) * count
+            else:
+                sizes = array("I", struct.unpack_from(f">{count}I", moov, stsz[0] + 12))
+
+        chunk_offsets = array("Q")
+        stco = self.stbl_box(b"stco")
+        co64 = self.stbl_box(b"co64")
+        if stco:
+            (count,) = struct.unpack_from(">I", moov, stco[0] + 4)
+            chunk_offsets = array("Q", struct.unpack_from(f">{count}I", moov, stco[0] + 8))
+        elif co64:
+            (count,) = struct.unpack_from(">I", moov, co64[0] + 4)
+            chunk_offsets = array("Q", struct.unpack_from(f">{count}Q", moov, co64[0] + 8))
+
+        # Expand sample-to-chunk runs into per-sample file offsets
+        offsets = array("Q")
+        stsc = self.stbl_box(b"stsc")
+        if stsc:
+            (count,) = struct.unpack_from(">I", moov, stsc[0] + 4)
+            runs = [struct.unpack_from(">III", moov, stsc[0] + 8 + 12 * i) for i in range(count)]
+            sample = 0
+            for i, (first_chunk, per_chunk, _) in enumerate(runs):
+                last_chunk = runs[i + 1][0] - 1 if i + 1 < len(runs) else len(chunk_offsets)
+                for chunk in range(first_chunk - 1, last_chunk):
+                    position = chunk_offsets[chunk]
+                    for _ in range(per_chunk):
+                        if sample >= len(sizes):
+                            break
+                        offsets.append(position)
+                        position += sizes[sample]
+                        sample += 1
+
+        dts = array("Q")
+        stts = self.stbl_box(b"stts")
+        if stts:
+            (count,) = struct.unpack_from(">I", moov, stts[0] + 4)
+            entries = struct.unpack_from(f">{count * 2}I", moov, stts[0] + 8)
+            time = 0
+            for i in range(0, len(entries), 2):
+                for _ in range(entries[i]):
+                    dts.append(time)
+                    time += entries[i + 1]
+
+        cts = array("q", dts)
+        ctts = self.stbl_box(b"ctts")
+        if ctts:
+            (count,) = struct.unpack_from(">I", moov, ctts[0] + 4)
+            # Read as signed even for version 0 - some muxers write negative offsets there
+            entries = struct.unpack_from(f">{count * 2}i", moov, ctts[0] + 8)
+            sample = 0
+            for i in range(0, len(entries), 2):
+                for _ in range(entries[i]):
+                    if sample < len(cts):
+                        cts[sample] += entries[i + 1]
+                    sample += 1
+
+        sync = None
+        stss = self.stbl_box(b"stss")
+        if stss:
+            (count,) = struct.unpack_from(">I", moov, stss[0] + 4)
+            sync = array("I", (n - 1 for n in struct.unpack_from(f">{count}I", moov, stss[0] + 8)))
+
+        count = min(len(offsets), len(sizes), len(dts))
+        self._samples = {
+            "offset": offsets[:count],
+            "size": sizes[:count],
+            "dts": dts[:count],
+            "cts": cts[:count],
+            "sync": sync,
+            "sync_set": set(sync) if sync is not None else None
+        }
+        return self._samples
+
+    def fragment(self, first: int, last: int, data_offset: int) -> bytes:
+        """traf box carrying samples first..last-1, their data at data_offset from the start of moof"""
+        s = self.samples()
+        dts, cts, sizes, sync_set = s["dts"], s["cts"], s["size"], s["sync_set"]
+
+        entries = bytearray()
+        for i in range(first, last):
+            if i + 1 < len(dts):
+                duration = dts[i + 1] - dts[i]
+            else:
+                duration = max(self.duration - dts[i], 0) or (dts[i] - dts[i - 1] if i else 0)
+            flags = SYNC_SAMPLE_FLAGS if sync_set is None or i in sync_set else NON_SYNC_SAMPLE_FLAGS
+            entries += struct.pack(">IIIi", duration, sizes[i], flags, cts[i] - dts[i])
+
+        # tfhd: default-base-is-moof; trun: data offset, duration, size, flags, composition offset
+        tfhd = make_full_box(b"tfhd", 0, 0x020000, struct.pack(">I", self.track_id))
+        tfdt = make_full_box(b"tfdt", 1, 0, struct.pack(">Q", dts[first]))
+        trun = make_full_box(b"trun", 1, 0x000F01, struct.pack(">Ii", last - first, data_offset) + bytes(entries))
+        return make_box(b"traf", tfhd + tfdt + trun)
+
+
+def relocate_moov(moov: bytes, delta: int) -> bytes:
+    """
+    Rewrite every chunk offset (stco/co64) in a moov box by delta.
+    stco tables whose shifted offsets no longer fit 32 bits are upgraded to co64.
+    """
+    def rebuild(start: int, end: int) -> bytes:
+        out = bytearray()
+        for box_type, pos, size, header_size in iter_boxes(moov, start, end):
+            body_start = pos + header_size
+            if box_type in CONTAINER_BOXES:
+                out += make_box(box_type, rebuild(body_start, pos + size))
+            elif box_type in (b"stco", b"co64"):
+                (count,) = struct.unpack_from(">I", moov, body_start + 4)
+                fmt = "I" if box_type == b"stco" else "Q"
+                shifted = [o + delta for o in struct.unpack_from(f">{count}{fmt}", moov, body_start + 8)]
+                if box_type == b"stco" and shifted and max(shifted) > 0xFFFFFFFF:
+                    box_type, fmt = b"co64", "Q"
+                body = moov[body_start:body_start + 4] + struct.pack(f">I{count}{fmt}", count, *shifted)
+                out += make_box(box_type, body)
+            else:
+                out += moov[pos:pos + size]
+        return bytes(out)
+
+    return rebuild(0, len(moov))
+
+
+class Mp4Index:
+    """Parsed moov of one file plus its top-level box layout"""
+
+    def __init__(self, boxes: List[Tuple[bytes, int, int]], moov_offset: int, moov: bytes, file_size: int):
+        self.boxes = boxes
+        self.moov_offset = moov_offset
+        self.moov = moov
+        self.file_size = file_size
+
+        moov_body = find_box(moov, [b"moov"])
+        self.tracks = [
+            Track(moov, pos + header_size, pos + size)
+            for box_type, pos, size, header_size in iter_boxes(moov, *moov_body)
+            if box_type == b"trak"
+        ] if moov_body else []
+
+        self._faststart = None
+        self._hls = None
+        self._keyframes = None
+
+    @property
+    def video(self) -> Optional[Track]:
+        return next((t for t in self.tracks if t.handler == "vide"), None)
+
+    @property
+    def audio(self) -> Optional[Track]:
+        return next((t for t in self.tracks if t.handler == "soun"), None)
+
+    @property
+    def duration(self) -> float:
+        return max((t.duration_seconds for t in self.tracks), default=0.0)
+
+    @property
+    def is_faststart(self) -> bool:
+        """True when moov already precedes the media data"""
+        mdats = [pos for box_type, pos, _ in self.boxes if box_type == b"mdat"]
+        return not mdats or self.moov_offset < min(mdats)
+
+    def keyframe_index(self) -> List[Tuple[float, int]]:
+        """
+        (time in seconds, byte offset) of every keyframe of the primary track.
+        The offset is where the interleaved data of all tracks from that time on
+        begins, so a read from there does not miss the first audio samples.
+        """
+        if self._keyframes is not None:
+            return self._keyframes
+
+        self._keyframes = []
+        primary = self.video or self.audio
+        if not primary:
+            return self._keyframes
+
+        s = primary.samples()
+        others = [(track, track.samples()) for track in self.tracks if track is not primary]
+        for i in (s["sync"] if s["sync"] is not None else range(len(s["dts"]))):
+            if i >= len(s["dts"]):
+                continue
+            time = s["dts"][i] / primary.timescale
+            offset = s["offset"][i]
+            for track, samples in others:
+                j = bisect_left(samples["dts"], round(time * track.timescale))
+                if j < len(samples["offset"]):
+                    offset = min(offset, samples["offset"][j])
+            self._keyframes.append((time, offset))
+        return self._keyframes
+
+    def seek(self, time: float) -> Optional[Tuple[float, int]]:
+        """Return (keyframe time, byte offset) of the last keyframe at or before `time`"""
+        keyframes = self.keyframe_index()
+        if not keyframes:
+            return None
+        position = bisect_right(keyframes, (time, float("inf"))) - 1
+        return keyframes[max(position, 0)]
+
+    def faststart_offset(self, offset: int) -> int:
+        """Map a byte offset of the source file to the same byte in the faststart layout"""
+        position = 0
+        for segment in self.faststart_layout() or []:
+            if segment[0] == "mem":
+                position += len(segment[1])
+                continue
+            if segment[1] <= offset < segment[1] + segment[2]:
+                return position + offset - segment[1]
+            position += segment[2]
+        return offset
+
+    def faststart_layout(self) -> Optional[List[Tuple]]:
+        """
+        Return the virtual faststart file as a list of segments, each either
+        ("src", source offset, length) or ("mem", bytes). None when the file is
+        already faststart or cannot be relocated safely.
+        """
+        if self._faststart is not None:
+            return self._faststart or None
+        self._faststart = False
+
+        if self.is_faststart:
+            return None
+
+        first_mdat = min(pos for box_type, pos, _ in self.boxes if box_type == b"mdat")
+        # Every mdat must sit before moov so they all shift by the same amount
+        if any(box_type == b"mdat" and pos > self.moov_offset for box_type, pos, _ in self.boxes):
+            return None
+
+        # The relocated moov can grow (stco -> co64), which shifts the data again
+        new_moov = self.moov
+        for _ in range(3):
+            candidate = relocate_moov(self.moov, len(new_moov))
+            if len(candidate) == len(new_moov):
+                new_moov = candidate
+                break
+            new_moov = candidate
+        else:
+            return None
+
+        segments: List[Tuple] = []
+        for box_type, pos, size in self.boxes:
+            if pos < first_mdat and box_type != b"moov":
+                segments.append(("src", pos, size))
+        segments.append(("mem", new_moov))
+        for box_type, pos, size in self.boxes:
+            if pos >= first_mdat and box_type != b"moov":
+                if segments[-1][0] == "src" and segments[-1][1] + segments[-1][2] == pos:
+                    segments[-1] = ("src", segments[-1][1], segments[-1][2] + size)
+                else:
+                    segments.append(("src", pos, size))
+
+        self._faststart = segments
+        return segments
+
+
+    @property
+    def hls_tracks(self) -> List[Track]:
+        """Tracks carried in HLS segments: the first video and the first audio track"""
+        return [track for track in (self.video, self.audio) if track]
+
+    def hls_segments(self, target: float) -> List[Tuple[float, float]]:
+        """(start, end) seconds of each HLS segment, cut at the first keyframe after `target` seconds"""
+        if self._hls is not None:
+            return self._hls
+
+        cuts = [0.0]
+        video = self.video
+        if video:
+            s = video.samples()
+            dts = s["dts"]
+            for i in (s["sync"] if s["sync"] is not None else range(len(dts))):
+                start = dts[i] / video.timescale
+                if start - cuts[-1] >= target:
+                    cuts.append(start)
+        else:
+            while cuts[-1] + target < self.duration:
+                cuts.append(cuts[-1] + target)
+
+        self._hls = list(zip(cuts, cuts[1:] + [max(self.duration, cuts[-1])]))
+        return self._hls
+
+    def hls_init(self, tracks: List[Track] = None) -> bytes:
+        """fMP4 init segment: ftyp plus moov with the HLS tracks, empty sample tables and mvex"""
+        tracks = tracks or self.hls_tracks
+        keep = {track.span for track in tracks}
+        empty_tables = (
+            make_full_box(b"stts", 0, 0, struct.pack(">I", 0)) +
+            make_full_box(b"stsc", 0, 0, struct.pack(">I", 0)) +
+            make_full_box(b"stsz", 0, 0, struct.pack(">II", 0, 0)) +
+            make_full_box(b"stco", 0, 0, struct.pack(">I", 0))
+        )
+
+        def rebuild(start: int, end: int) -> bytes:
+            out = bytearray()
+            for box_type, pos, size, header_size in iter_boxes(self.moov, start, end):
+                body_start = pos + header_size
+                if box_type == b"trak" and (body_start, pos + size) not in keep:
+                    continue
+                if box_type == b"stbl":
+                    stsd = find_box(self.moov, [b"stsd"], body_start, pos + size)
+                    out += make_box(b"stbl", self.moov[stsd[0] - 8:stsd[1]] + empty_tables)
+                elif box_type in CONTAINER_BOXES:
+                    out += make_box(box_type, rebuild(body_start, pos + size))
+                elif box_type in (b"mvhd", b"tkhd", b"mdhd", b"hdlr", b"vmhd", b"smhd", b"elst", b"dref"):
+                    out += self.moov[pos:pos + size]
+            return bytes(out)
+
+        moov_body = find_box(self.moov, [b"moov"])
+        trex = b"".join(
+            make_full_box(b"trex", 0, 0, struct.pack(">IIIII", track.track_id, 1, 0, 0, 0))
+            for track in tracks
+        )
+        ftyp = make_box(b"ftyp", b"iso6" + struct.pack(">I", 0) + b"iso6mp41")
+        return ftyp + make_box(b"moov", rebuild(*moov_body) + make_box(b"mvex", trex))
+
+    def hls_fragment(self, number: int, target: float) -> List[Tuple]:
+        """
+        HLS segment `number` as an fMP4 fragment, returned as layout segments:
+        ("mem", moof + mdat header) followed by ("src", offset, length) spans of
+        sample data, adjacent samples coalesced.
+        """
+        segments = self.hls_segments(target)
+        start, end = segments[number]
+        is_last = number == len(segments) - 1
+
+        runs = []
+        spans: List[List[int]] = []
+        payload = 0
+        for track in self.hls_tracks:
+            s = track.samples()
+            first = bisect_left(s["dts"], round(start * track.timescale))
+            last = len(s["dts"]) if is_last else bisect_left(s["dts"], round(end * track.timescale))
+            if first >= last:
+                continue
+            runs.append((track, first, last, payload))
+            for i in range(first, last):
+                offset, size = s["offset"][i], s["size"][i]
+                if spans and spans[-1][0] + spans[-1][1] == offset:
+                    spans[-1][1] += size
+                else:
+                    spans.append([offset, size])
+                payload += size
+
+        header = fragment_header(number, runs, payload)
+        return [("mem", header)] + [("src", offset, length) for offset, length in spans]
+
+    def storyboard_samples(self, count: int, min_interval: float) -> List[Tuple[float, int]]:
+        """(time, video sample index) of up to `count` keyframes spread evenly over the video"""
+        video = self.video
+        s = video.samples()
+        sync = list(s["sync"]) if s["sync"] is not None else list(range(len(s["dts"])))
+        sync = [i for i in sync if i < len(s["dts"])]
+        if not sync:
+            return []
+        times = [s["dts"][i] / video.timescale for i in sync]
+
+        interval = max(video.duration_seconds / count, min_interval)
+        picked = []
+        time = 0.0
+        while time < video.duration_seconds and len(picked) < count:
+            position = max(bisect_right(times, time) - 1, 0)
+            if not picked or picked[-1][1] != sync[position]:
+                picked.append((times[position], sync[position]))
+            time += interval
+        return picked
+
+    def keyframe_layout(self, samples: List[int]) -> List[Tuple]:
+        """A video-only fMP4 holding just the listed video samples, one fragment each, as layout segments"""
+        video = self.video
+        s = video.samples()
+        segments = [("mem", self.hls_init([video]))]
+        for number, i in enumerate(samples):
+            segments.append(("mem", fragment_header(number, [(video, i, i + 1, 0)], s["size"][i])))
+            segments.append(("src", s["offset"][i], s["size"][i]))
+        return segments
+
+
+async def scan_boxes(read: Reader, file_size: int) -> List[Tuple[bytes, int, int]]:
+    """Walk the top-level boxes by reading only their headers"""
+    boxes = []
+    pos = 0
+    while pos < file_size and len(boxes) < 1000:
+        data = await read(pos, 16)
+        # Bound by the file, not the 16 bytes read, so size 0 ("to end of file") covers the rest of it
+        header = read_box_header(data, 0, file_size - pos) if len(data) >= 16 or len(data) == file_size - pos else None
+        if header is None:
+            break
+        box_type, size, _ = header
+        boxes.append((box_type, pos, size))
+        pos += size
+    return boxes
+
+
+async def load_index(read: Reader, file_size: int) -> Optional[Mp4Index]:
+    """Locate and parse the moov atom of an MP4; None if the file is not a usable MP4"""
+    boxes = await scan_boxes(read, file_size)
+    if not boxes or boxes[0][0] not in (b"ftyp", b"styp", b"free", b"skip", b"wide"):
+        return None
+
+    moov = next(((pos, size) for box_type, pos, size in boxes if box_type == b"moov"), None)
+    if moov is None or moov[1] > MAX_MOOV_SIZE:
+        return None
+
+    data = await read(moov[0], moov[1])
+    if len(data) != moov[1]:
+        return None
+    return Mp4Index(boxes, moov[0], data, file_size)
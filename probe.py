@@ -0,0 +1,250 @@
+"""
+Media Probe
+Sniffs the real format of a file from its first bytes and reads codec,
+resolution and duration from Matroska/WebM and AVI headers. MP4/MOV are
+handled by mp4index, whose track list carries the same details.
+"""
+
+import struct
+from typing import Dict, Optional, Tuple
+
+# Codecs browsers decode natively in <video>/<audio>
+BROWSER_VIDEO_CODECS = {"h264", "vp8", "vp9", "av1"}
+BROWSER_AUDIO_CODECS = {"aac", "mp3", "opus", "vorbis", "flac", "pcm"}
+
+# Containers browsers play directly
+BROWSER_CONTAINERS = {
+    "video/mp4", "video/webm", "audio/mp4", "audio/mpeg", "audio/ogg",
+    "audio/wav", "audio/flac", "audio/aac", "audio/webm"
+}
+
+# ISO-BMFF brands of still images (HEIF/AVIF), which share the ftyp box with MP4
+IMAGE_BRANDS = {
+    b"heic": "image/heic", b"heix": "image/heic", b"heim": "image/heic", b"heis": "image/heic",
+    b"hevc": "image/heic", b"hevx": "image/heic", b"mif1": "image/heic", b"msf1": "image/heic",
+    b"avif": "image/avif", b"avis": "image/avif"
+}
+
+MP4_CODECS = {
+    "avc1": "h264", "avc3": "h264", "hvc1": "hevc", "hev1": "hevc", "vp08": "vp8",
+    "vp09": "vp9", "av01": "av1", "mp4v": "mpeg4", "mp4a": "aac", ".mp3": "mp3",
+    "ac-3": "ac3", "ec-3": "eac3", "Opus": "opus", "fLaC": "flac"
+}
+
+MATROSKA_CODECS = {
+    "V_MPEG4/ISO/AVC": "h264", "V_MPEGH/ISO/HEVC": "hevc", "V_VP8": "vp8", "V_VP9": "vp9",
+    "V_AV1": "av1", "V_MPEG4/ISO/ASP": "mpeg4", "V_MPEG2": "mpeg2", "A_MPEG/L3": "mp3",
+    "A_OPUS": "opus", "A_VORBIS": "vorbis", "A_FLAC": "flac", "A_AC3": "ac3",
+    "A_EAC3": "eac3", "A_DTS": "dts", "A_TRUEHD": "truehd"
+}
+
+AVI_VIDEO_CODECS = {
+    "H264": "h264", "X264": "h264", "AVC1": "h264", "HEVC": "hevc", "H265": "hevc",
+    "XVID": "mpeg4", "DIVX": "mpeg4", "DX50": "mpeg4", "FMP4": "mpeg4", "MJPG": "mjpeg"
+}
+AVI_AUDIO_CODECS = {0x0001: "pcm", 0x0055: "mp3", 0x00FF: "aac", 0x1610: "aac", 0x2000: "ac3", 0x2001: "dts"}
+
+# Matroska element ids
+EBML_HEADER, DOC_TYPE = 0x1A45DFA3, 0x4282
+SEGMENT, CLUSTER = 0x18538067, 0x1F43B675
+INFO, TIMESTAMP_SCALE, DURATION = 0x1549A966, 0x2AD7B1, 0x4489
+TRACKS, TRACK_ENTRY, TRACK_TYPE, CODEC_ID = 0x1654AE6B, 0xAE, 0x83, 0x86
+VIDEO, PIXEL_WIDTH, PIXEL_HEIGHT = 0xE0, 0xB0, 0xBA
+MATROSKA_MASTERS = {EBML_HEADER, SEGMENT, INFO, TRACKS, TRACK_ENTRY, VIDEO}
+
+
+def sniff_mime(head: bytes) -> Optional[str]:
+    """Identify a file from its magic bytes, None when unknown"""
+    if len(head) >= 12 and head[4:8] == b"ftyp":
+        brand = head[8:12]
+        if brand == b"qt  ":
+            return "video/quicktime"
+        if brand in (b"M4A ", b"M4B "):
+            return "audio/mp4"
+        if brand in IMAGE_BRANDS:
+            # mif1/msf1 are generic; a more specific brand may follow among the compatible ones
+            if brand in (b"mif1", b"msf1"):
+                size = int.from_bytes(head[0:4], "big")
+                compatible = [head[i:i + 4] for i in range(16, min(size, len(head)) - 3, 4)]
+                if b"avif" in compatible or b"avis" in compatible:
+                    return "image/avif"
+            return IMAGE_BRANDS[brand]
+        return "video/mp4"
+    if head.startswith(b"\x1a\x45\xdf\xa3"):
+        return "video/webm" if b"webm" in head[:64] else "video/x-matroska"
+    if head.startswith(b"RIFF") and len(head) >= 12:
+        return {b"AVI ": "video/x-msvideo", b"WAVE": "audio/wav", b"WEBP": "image/webp"}.get(head[8:12])
+    if len(head) > 376 and head[0] == 0x47 and head[188] == 0x47 and head[376] == 0x47:
+        return "video/mp2t"
+
+    for magic, mime in (
+        (b"ID3", "audio/mpeg"), (b"OggS", "audio/ogg"), (b"fLaC", "audio/flac"),
+        (b"%PDF", "application/pdf"), (b"PK\x03\x04", "application/zip"),
+        (b"Rar!", "application/x-rar-compressed"), (b"7z\xbc\xaf\x27\x1c", "application/x-7z-compressed"),
+        (b"\x1f\x8b", "application/gzip"), (b"\x89PNG", "image/png"), (b"\xff\xd8\xff", "image/jpeg"),
+        (b"GIF8", "image/gif")
+    ):
+        if head.startswith(magic):
+            return mime
+
+    if len(head) >= 2 and head[0] == 0xFF:
+        if head[1] & 0xF6 == 0xF0:
+            return "audio/aac"  # ADTS
+        if head[1] & 0xE0 == 0xE0:
+            return "audio/mpeg"  # MPEG audio frame sync
+    return None
+
+
+def read_vint(data: bytes, pos: int, keep_marker: bool) -> Tuple[Optional[int], int]:
+    """Read an EBML variable-length integer, returning (value, length); value is None for unknown sizes"""
+    first = data[pos]
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8 or pos + length > len(data):
+        raise ValueError("Bad EBML varint")
+    value = first if keep_marker else first & (0xFF >> length)
+    for byte in data[pos + 1:pos + length]:
+        value = (value << 8) | byte
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        return None, length
+    return value, length
+
+
+def parse_matroska(head: bytes) -> Dict:
+    """Read doc type, duration and the first video/audio tracks from the start of a Matroska file"""
+    result = {}
+    scale = 1000000
+    duration = None
+    track = {}
+
+    def finish_track():
+        if track.get("type") == 1 and "video_codec" not in result:
+            result["video_codec"] = MATROSKA_CODECS.get(track.get("codec", ""), track.get("codec", "").lower())
+            result["width"] = track.get("width", 0)
+            result["height"] = track.get("height", 0)
+        elif track.get("type") == 2 and "audio_codec" not in result:
+            codec = track.get("codec", "")
+            result["audio_codec"] = "aac" if codec.startswith("A_AAC") else "pcm" if codec.startswith("A_PCM") \
+                else MATROSKA_CODECS.get(codec, codec.lower())
+        track.clear()
+
+    pos = 0
+    track_end = None
+    try:
+        while pos < len(head):
+            if track_end is not None and pos >= track_end:
+                finish_track()
+                track_end = None
+            element, id_length = read_vint(head, pos, keep_marker=True)
+            size, size_length = read_vint(head, pos + id_length, keep_marker=False)
+            body = pos + id_length + size_length
+            if element == CLUSTER:
+                break
+            if element in MATROSKA_MASTERS:
+                if element == TRACK_ENTRY:
+                    if track_end is not None:
+                        finish_track()
+                    track_end = body + size if size is not None else None
+                pos = body
+                continue
+
+            if size is None or body + size > len(head):
+                break
+            value = head[body:body + size]
+            if element == DOC_TYPE:
+                result["doc_type"] = value.decode("ascii", "replace")
+            elif element == TIMESTAMP_SCALE:
+                scale = int.from_bytes(value, "big")
+            elif element == DURATION and size in (4, 8):
+                (duration,) = struct.unpack(">f" if size == 4 else ">d", value)
+            elif element == TRACK_TYPE:
+                track["type"] = int.from_bytes(value, "big")
+            elif element == CODEC_ID:
+                track["codec"] = value.rstrip(b"\x00").decode("ascii", "replace")
+            elif element == PIXEL_WIDTH:
+                track["width"] = int.from_bytes(value, "big")
+            elif element == PIXEL_HEIGHT:
+                track["height"] = int.from_bytes(value, "big")
+            pos = body + size
+    except (ValueError, IndexError, struct.error):
+        pass
+
+    if track:
+        finish_track()
+    if duration:
+        result["duration"] = duration * scale / 1e9
+    return result
+
+
+def parse_avi(head: bytes) -> Dict:
+    """Read duration, resolution and stream codecs from an AVI hdrl list"""
+    result = {}
+    stream_type = None
+    pos = 12
+    try:
+        while pos + 8 <= len(head):
+            fourcc, size = head[pos:pos + 4], struct.unpack_from("<I", head, pos + 4)[0]
+            if fourcc == b"LIST":
+                list_type = head[pos + 8:pos + 12]
+                if list_type == b"movi":
+                    break
+                # Descend into hdrl/strl lists
+                pos += 12
+                continue
+
+            body = pos + 8
+            if fourcc == b"avih" and size >= 40:
+                micro_per_frame, = struct.unpack_from("<I", head, body)
+                total_frames, = struct.unpack_from("<I", head, body + 16)
+                result["width"], result["height"] = struct.unpack_from("<II", head, body + 32)
+                if micro_per_frame and total_frames:
+                    result["duration"] = micro_per_frame * total_frames / 1e6
+            elif fourcc == b"strh" and size >= 8:
+                stream_type = head[body:body + 4]
+                if stream_type == b"vids" and "video_codec" not in result:
+                    handler = head[body + 4:body + 8].decode("latin-1").upper()
+                    if handler.strip("\x00 "):
+                        result["video_codec"] = AVI_VIDEO_CODECS.get(handler, handler.strip().lower())
+            elif fourcc == b"strf":
+                if stream_type == b"vids" and size >= 20:
+                    compression = head[body + 16:body + 20].decode("latin-1").upper()
+                    if compression in AVI_VIDEO_CODECS:
+                        result["video_codec"] = AVI_VIDEO_CODECS[compression]
+                elif stream_type == b"auds" and size >= 2 and "audio_codec" not in result:
+                    tag, = struct.unpack_from("<H", head, body)
+                    result["audio_codec"] = AVI_AUDIO_CODECS.get(tag, f"0x{tag:04x}")
+            pos = body + size + (size & 1)
+    except struct.error:
+        pass
+    return result
+
+
+def probe_head(head: bytes) -> Dict:
+    """Sniff the MIME type and read whatever stream details the container header carries"""
+    mime = sniff_mime(head)
+    result = {"mime": mime}
+    if mime in ("video/webm", "video/x-matroska"):
+        result.update(parse_matroska(head))
+        result.pop("doc_type", None)
+    elif mime == "video/x-msvideo":
+        result.update(parse_avi(head))
+    return result
+
+
+def playability(mime: str, video_codec: Optional[str], audio_codec: Optional[str]) -> Optional[Tuple[bool, str]]:
+    """
+    Return (can_stream, stream_quality) from the probed codecs, or None when
+    the codecs say nothing beyond what the container type already does.
+    """
+    if not (video_codec or audio_codec):
+        return None
+    if video_codec and video_codec not in BROWSER_VIDEO_CODECS:
+        return False, "poor"
+    if mime not in BROWSER_CONTAINERS and mime != "video/quicktime":
+        # Playable codecs in a container browsers do not open - remux territory
+        return False, "poor"
+    if audio_codec and audio_codec not in BROWSER_AUDIO_CODECS:
+        # Plays, but silently in most browsers
+        return (True, "okay") if video_codec else (False, "poor")
+    return True, "excellent" if mime in BROWSER_CONTAINERS else "okay"
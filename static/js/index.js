@@ -0,0 +1,1274 @@
+// ========================================
+// NUCLEAR CACHE BUST VERSION CHECK
+// ========================================
+
+const VERSION = '2.4-NUCLEAR-CACHE-BUST-INCOGNITO-' + Date.now();
+console.log('🚀 Telegram File Browser', VERSION);
+console.log('✅ NUCLEAR CACHE BUST - INCOGNITO MODE ACTIVE');
+console.log('🔄 Cache-busting timestamp:', Date.now());
+console.log('🚫 WILL NEVER USE /proxy/ ENDPOINT');
+console.log('✅ FORCED TO USE /raw-stream/ ENDPOINT ONLY');
+console.log('🎯 This should work in incognito mode!');
+
+// ========================================
+// Global Functions (Must be first for onclick handlers)
+// ========================================
+
+let currentPlayer = null;
+
+// Per-file metadata from one batched /api/meta call, keyed by message id
+const CHANNEL_ID = document.body.dataset.channelId;
+const fileMeta = {};
+
+async function loadFileMeta(ids) {
+    const response = await fetch('/api/meta', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ channel: CHANNEL_ID, ids: ids.slice(0, 200) })
+    });
+    if (!response.ok) {
+        throw new Error(`Metadata request failed: ${response.status}`);
+    }
+    const data = await response.json();
+    data.files.forEach(file => { fileMeta[file.message_id] = file; });
+    return data;
+}
+
+function messageIdFromUrl(url) {
+    // /faststart/{chat}/{id}, /proxy/{chat}/{id}, /stream/{chat}/{id}, ...
+    const match = url.match(/\/(?:-?\d+|@\w+)\/(\d+)(?:[/?]|$)/);
+    return match ? parseInt(match[1]) : null;
+}
+
+// ========================================
+// Live listing updates (Server-Sent Events)
+// ========================================
+
+function escapeHtml(text) {
+    const div = document.createElement('div');
+    div.textContent = text == null ? '' : String(text);
+    return div.innerHTML;
+}
+
+// Same markup as the server-rendered cards
+function renderFileCard(file) {
+    const card = document.createElement('div');
+    card.className = 'file-card';
+    card.dataset.fileId = file.message_id;
+
+    let probeLine = '';
+    if (file.video_codec || file.duration_text) {
+        const codecs = [file.video_codec, file.audio_codec].filter(Boolean).join('/');
+        const parts = [file.width ? `${file.width}×${file.height}` : '', codecs, file.duration_text || '']
+            .filter(Boolean);
+        if (!file.can_stream) parts.push('needs remux/download');
+        probeLine = `<div class="file-probe${file.can_stream ? '' : ' file-probe-warn'}">${escapeHtml(parts.join(' · '))}</div>`;
+    }
+
+    card.innerHTML = `
+        <div class="file-thumbnail">
+            ${file.has_thumbnail
+                ? `<img data-src="${escapeHtml(file.thumbnail_url)}" alt="${escapeHtml(file.name)}">`
+                : `<div class="icon-3d">${escapeHtml(file.icon)}</div>`}
+        </div>
+        <div class="file-content">
+            <div class="file-name">${escapeHtml(file.name)}</div>
+            <div class="file-meta">
+                <span class="file-size">${escapeHtml(file.size)}</span>
+                <span class="file-date">${escapeHtml(file.date)}</span>
+            </div>
+            ${probeLine}
+            <div class="file-actions">
+                <button class="btn btn-stream">
+                    <span>▶️</span>
+                    <span>Stream</span>
+                </button>
+                <a href="${escapeHtml(file.download_url)}" class="btn btn-download" download>
+                    <span>⬇️</span>
+                    <span>Download</span>
+                </a>
+            </div>
+        </div>`;
+    card.querySelector('.btn-stream').addEventListener('click', () => {
+        openStream(file.stream_url, file.name, file.type, file.remux_url || '', file.storyboard_url || '');
+    });
+    attachCardEffects(card);
+    return card;
+}
+
+function applyFileChanges(change) {
+    // Loaded pages older than the server's index window are not covered by ids
+    const current = new Set(change.ids);
+    const oldestIndexed = change.ids.length ? Math.min(...change.ids) : Infinity;
+    listState.files = listState.files.filter(file => file.message_id < oldestIndexed || current.has(file.message_id));
+
+    const known = new Set(listState.files.map(file => file.message_id));
+    const added = change.added.filter(file => !known.has(file.message_id));
+    listState.files = added.concat(listState.files).sort((a, b) => b.message_id - a.message_id);
+    listState.total = change.ids.length;
+    listState.offsets = null;
+
+    // Keep the cards in view where they are when files land above them
+    const list = document.querySelector('.files-list');
+    const listTop = list.getBoundingClientRect().top + window.scrollY;
+    if (window.scrollY > listTop) {
+        window.scrollBy(0, added.reduce((sum, file) => sum + cardHeight(file), 0));
+    }
+    renderWindow();
+
+    const newCards = added.map(file => listState.rendered.get(file.message_id)).filter(Boolean);
+    if (newCards.length) {
+        gsap.from(newCards, { y: -40, opacity: 0, duration: 0.6, stagger: 0.1, ease: 'back.out(1.7)' });
+    }
+    if (added.length) {
+        loadFileMeta(added.map(file => file.message_id)).catch(error => console.warn('Metadata load failed:', error));
+    }
+    updateFileCount();
+}
+
+function watchFileChanges(since) {
+    if (!window.EventSource) return;
+    // EventSource reconnects on its own and resumes from Last-Event-ID
+    const source = new EventSource(
+        `/api/files/events?channel=${encodeURIComponent(CHANNEL_ID)}&since=${since}`
+    );
+    source.addEventListener('files', event => applyFileChanges(JSON.parse(event.data)));
+}
+
+// ========================================
+// Virtualized file list
+// ========================================
+
+// Every loaded record stays in memory; only the cards near the viewport are in the DOM
+const listState = {
+    files: [],             // newest first
+    nextCursor: null,      // older page to fetch from /api/files, null at the channel start
+    pageSize: 50,
+    total: 0,
+    loading: false,
+    heights: new Map(),    // measured card height plus gap, by message id
+    estimate: 360,         // height assumed for cards never rendered
+    offsets: null,         // prefix sums of heights, rebuilt when files or heights change
+    rendered: new Map()    // message id -> card element in the DOM
+};
+const LIST_GAP = 20;            // .files-list gap
+const OVERSCAN_PX = 1200;       // rendered margin above and below the viewport
+const LOAD_AHEAD_CARDS = 10;    // fetch the next page when this close to the end
+
+const thumbObserver = 'IntersectionObserver' in window
+    ? new IntersectionObserver(entries => {
+        entries.filter(entry => entry.isIntersecting).forEach(entry => {
+            entry.target.src = entry.target.dataset.src;
+            thumbObserver.unobserve(entry.target);
+        });
+    }, { rootMargin: '400px 0px' })
+    : null;
+
+function observeThumbnails(card) {
+    card.querySelectorAll('img[data-src]:not([src])').forEach(img => {
+        if (thumbObserver) {
+            thumbObserver.observe(img);
+        } else {
+            img.src = img.dataset.src;
+        }
+    });
+}
+
+function cardHeight(file) {
+    return listState.heights.get(file.message_id) || listState.estimate;
+}
+
+function rebuildOffsets() {
+    const offsets = new Float64Array(listState.files.length + 1);
+    listState.files.forEach((file, i) => { offsets[i + 1] = offsets[i] + cardHeight(file); });
+    listState.offsets = offsets;
+}
+
+// Index of the card covering pixel y of the list
+function indexAt(y) {
+    const offsets = listState.offsets;
+    let low = 0;
+    let high = listState.files.length - 1;
+    while (low < high) {
+        const mid = (low + high + 1) >> 1;
+        if (offsets[mid] <= y) low = mid; else high = mid - 1;
+    }
+    return low;
+}
+
+function setListPadding(first, last) {
+    const list = document.querySelector('.files-list');
+    const offsets = listState.offsets;
+    const count = listState.files.length;
+    list.style.paddingTop = `${count ? offsets[first] : 0}px`;
+    list.style.paddingBottom = `${count ? offsets[count] - offsets[last + 1] : 0}px`;
+}
+
+function renderWindow() {
+    const list = document.querySelector('.files-list');
+    if (!listState.offsets) rebuildOffsets();
+    const count = listState.files.length;
+    const listTop = list.getBoundingClientRect().top + window.scrollY;
+    const first = count ? indexAt(window.scrollY - listTop - OVERSCAN_PX) : 0;
+    const last = count ? indexAt(window.scrollY + window.innerHeight - listTop + OVERSCAN_PX) : -1;
+
+    const wanted = new Set();
+    for (let i = first; i <= last; i++) wanted.add(listState.files[i].message_id);
+    listState.rendered.forEach((card, id) => {
+        if (!wanted.has(id)) {
+            if (thumbObserver) card.querySelectorAll('img[data-src]').forEach(img => thumbObserver.unobserve(img));
+            card.remove();
+            listState.rendered.delete(id);
+        }
+    });
+
+    // Insert missing cards and fix the order in one pass
+    let previous = null;
+    for (let i = first; i <= last; i++) {
+        const file = listState.files[i];
+        let card = listState.rendered.get(file.message_id);
+        if (!card) {
+            card = renderFileCard(file);
+            listState.rendered.set(file.message_id, card);
+        }
+        const expected = previous ? previous.nextElementSibling : list.firstElementChild;
+        if (card !== expected) list.insertBefore(card, expected);
+        observeThumbnails(card);
+        previous = card;
+    }
+    setListPadding(first, last);
+
+    // Measure what is in the DOM; later estimates follow the average measured height
+    let changed = false;
+    for (let i = first; i <= last; i++) {
+        const id = listState.files[i].message_id;
+        const height = listState.rendered.get(id).offsetHeight + LIST_GAP;
+        if (listState.heights.get(id) !== height) {
+            listState.heights.set(id, height);
+            changed = true;
+        }
+    }
+    if (changed) {
+        let sum = 0;
+        listState.heights.forEach(height => { sum += height; });
+        listState.estimate = sum / listState.heights.size;
+        rebuildOffsets();
+        setListPadding(first, last);
+    }
+
+    if (listState.nextCursor !== null && last >= count - LOAD_AHEAD_CARDS) {
+        loadMoreFiles();
+    }
+}
+
+let renderQueued = false;
+function scheduleRender() {
+    if (renderQueued) return;
+    renderQueued = true;
+    requestAnimationFrame(() => {
+        renderQueued = false;
+        renderWindow();
+    });
+}
+
+async function loadMoreFiles() {
+    if (listState.loading || listState.nextCursor === null) return;
+    listState.loading = true;
+    try {
+        const response = await fetch(
+            `/api/files?channel=${encodeURIComponent(CHANNEL_ID)}&cursor=${listState.nextCursor}&limit=${listState.pageSize}`
+        );
+        if (!response.ok) {
+            throw new Error(`Listing request failed: ${response.status}`);
+        }
+        const data = await response.json();
+        const known = new Set(listState.files.map(file => file.message_id));
+        const added = data.files.filter(file => !known.has(file.message_id));
+        listState.files.push(...added);
+        listState.nextCursor = data.next_cursor;
+        listState.offsets = null;
+        updateFileCount();
+        if (added.length) {
+            loadFileMeta(added.map(file => file.message_id)).catch(error => console.warn('Metadata load failed:', error));
+        }
+    } catch (error) {
+        console.warn('Loading more files failed:', error);
+        return;
+    } finally {
+        listState.loading = false;
+    }
+    scheduleRender();
+}
+
+function updateFileCount() {
+    const count = Math.max(listState.total, listState.files.length);
+    document.querySelector('.stat-value').textContent =
+        listState.nextCursor !== null && listState.files.length >= count ? `${count}+` : count;
+}
+
+// Adopt the server-rendered first page and take over rendering
+function initFileList() {
+    const list = document.querySelector('.files-list');
+    const dataElement = document.getElementById('files-data');
+    const data = dataElement ? JSON.parse(dataElement.textContent) : { files: [], next_cursor: null };
+    listState.files = data.files;
+    listState.nextCursor = data.next_cursor;
+    listState.pageSize = data.page_size || listState.pageSize;
+    listState.total = parseInt(document.querySelector('.stat-value').textContent) || data.files.length;
+    list.querySelectorAll(':scope > script').forEach(script => script.remove());
+    list.style.overflowAnchor = 'none';
+
+    list.querySelectorAll('.file-card[data-file-id]').forEach(card => {
+        attachCardEffects(card);
+        listState.rendered.set(parseInt(card.dataset.fileId), card);
+    });
+    renderWindow();
+    window.addEventListener('scroll', scheduleRender, { passive: true });
+    window.addEventListener('resize', () => {
+        // Widths changed, so do the heights
+        listState.heights.clear();
+        listState.offsets = null;
+        scheduleRender();
+    });
+}
+
+let ffmpeg = null;
+
+// Initialize FFmpeg WebAssembly
+async function initFFmpeg() {
+    if (!ffmpeg) {
+        try {
+            // Check if FFmpeg is available
+            if (typeof FFmpeg === 'undefined') {
+                throw new Error('FFmpeg WebAssembly library not loaded');
+            }
+
+            const { FFmpeg } = FFmpeg;
+            const { fetchFile, toBlobURL } = FFmpegUtil;
+
+            ffmpeg = new FFmpeg();
+
+            // Set up logging
+            ffmpeg.on('log', ({ message }) => {
+                console.log('FFmpeg:', message);
+            });
+
+            ffmpeg.on('progress', ({ progress }) => {
+                const progressBar = document.getElementById('conversion-progress');
+                if (progressBar) {
+                    progressBar.style.width = `${40 + (progress * 40)}%`;
+                }
+            });
+
+            // Load FFmpeg with correct URLs
+            const baseURL = 'https://unpkg.com/@ffmpeg/core@0.12.6/dist/umd';
+            await ffmpeg.load({
+                coreURL: await toBlobURL(`${baseURL}/ffmpeg-core.js`, 'text/javascript'),
+                wasmURL: await toBlobURL(`${baseURL}/ffmpeg-core.wasm`, 'application/wasm'),
+                workerURL: await toBlobURL(`${baseURL}/ffmpeg-core.worker.js`, 'text/javascript'),
+            });
+
+            console.log('FFmpeg loaded successfully');
+        } catch (error) {
+            console.error('FFmpeg load failed:', error);
+            ffmpeg = null;
+            throw error;
+        }
+    }
+    return ffmpeg;
+}
+
+function openStream(url, name, type, remuxUrl, storyboardUrl) {
+    console.log('🚀 Opening stream with NUCLEAR CACHE BUST:', url, name, type);
+
+    // Check if using external streamer
+    const isExternalStreamer = url.includes('://') && !url.includes('localhost');
+
+    if (isExternalStreamer) {
+        console.log('⚡ Using EXTERNAL TG FILE STREAMER for optimal performance!');
+        console.log('🎯 External streamer URL:', url);
+
+        // Add visual indicator for external streamer
+        const indicator = document.createElement('div');
+        indicator.style.cssText = 'position: fixed; top: 10px; right: 10px; background: #FF6B35; color: white; padding: 8px 12px; border-radius: 4px; font-size: 12px; z-index: 9999; font-family: monospace;';
+        indicator.textContent = '⚡ External Streamer';
+        document.body.appendChild(indicator);
+        setTimeout(() => indicator.remove(), 4000);
+    } else {
+        console.log('🏠 Using LOCAL streaming');
+
+        // Add visual indicator for local streaming
+        const indicator = document.createElement('div');
+        indicator.style.cssText = 'position: fixed; top: 10px; right: 10px; background: #4CAF50; color: white; padding: 8px 12px; border-radius: 4px; font-size: 12px; z-index: 9999; font-family: monospace;';
+        indicator.textContent = '🏠 Local Stream';
+        document.body.appendChild(indicator);
+        setTimeout(() => indicator.remove(), 3000);
+    }
+
+    const modal = document.getElementById('streamModal');
+    const player = document.getElementById('mediaPlayer');
+    const title = document.getElementById('modalTitle');
+
+    title.textContent = name;
+    modal.classList.add('active');
+
+    // Destroy existing player
+    if (currentPlayer) {
+        currentPlayer.destroy();
+        currentPlayer = null;
+    }
+
+    // Check if it's a streamable format
+    const isH264 = type.includes('mp4') && !type.includes('matroska');
+    const isWebM = type.includes('webm');
+    const isStreamable = isH264 || isWebM || type.startsWith('audio/') || type.startsWith('image/');
+    const isMKV = type.includes('matroska') || type.includes('mkv') || name.toLowerCase().endsWith('.mkv');
+
+    if (isMKV || !isStreamable) {
+        // Show advanced options for non-streamable formats
+        const streamUrl = url.replace('/stream/', '/proxy/');
+        player.innerHTML = `
+            <div style="text-align: center; padding: 40px;">
+                <div style="font-size: 60px; margin-bottom: 20px;">🎬</div>
+                <h3 style="margin-bottom: 15px; color: #667eea;">${name}</h3>
+                <p style="margin-bottom: 20px; opacity: 0.7;">This video format requires special handling for web playback.</p>
+
+                <div style="display: flex; flex-direction: column; gap: 15px; max-width: 400px; margin: 0 auto;">
+                    ${remuxUrl ? `
+                    <!-- Server-side Remux Option -->
+                    <div style="background: rgba(255,255,255,0.05); padding: 20px; border-radius: 16px; border: 1px solid rgba(255,255,255,0.1);">
+                        <h4 style="margin-bottom: 10px; color: #4CAF50;">▶️ Play in Browser</h4>
+                        <p style="font-size: 14px; opacity: 0.7; margin-bottom: 15px;">Repackaged to MP4 on the server without re-encoding</p>
+                        <button onclick="openStream('${remuxUrl}', '${name}', 'video/mp4')" class="btn btn-stream" style="width: 100%;">
+                            ▶️ Play Remuxed
+                        </button>
+                    </div>
+                    ` : ''}
+
+                    <!-- External Player Option -->
+                    <div style="background: rgba(255,255,255,0.05); padding: 20px; border-radius: 16px; border: 1px solid rgba(255,255,255,0.1);">
+                        <h4 style="margin-bottom: 10px; color: #667eea;">🚀 External Player (Recommended)</h4>
+                        <p style="font-size: 14px; opacity: 0.7; margin-bottom: 15px;">Open in VLC, MX Player, or your default video player</p>
+                        <div style="display: flex; gap: 10px; flex-wrap: wrap; justify-content: center;">
+                            <button onclick="openInVLC('${streamUrl}', '${name}')" class="btn btn-stream" style="flex: none; padding: 12px 16px;">
+                                🎯 VLC Player
+                            </button>
+                            <button onclick="openInMXPlayer('${streamUrl}', '${name}')" class="btn btn-stream" style="flex: none; padding: 12px 16px;">
+                                📱 MX Player
+                            </button>
+                            <button onclick="openInDefaultPlayer('${streamUrl}', '${name}')" class="btn btn-stream" style="flex: none; padding: 12px 16px;">
+                                🎮 Default Player
+                            </button>
+                        </div>
+                    </div>
+
+                    <!-- Browser Conversion Option -->
+                    <div style="background: rgba(255,255,255,0.05); padding: 20px; border-radius: 16px; border: 1px solid rgba(255,255,255,0.1);">
+                        <h4 style="margin-bottom: 10px; color: #764ba2;">🔮 Convert & Play in Browser</h4>
+                        <p style="font-size: 14px; opacity: 0.7; margin-bottom: 15px;">Convert to web-compatible format using WebAssembly</p>
+                        <button onclick="convertAndPlay('${streamUrl}', '${name}', '${type}')" class="btn btn-download" style="width: 100%;">
+                            ⚡ Convert & Stream
+                        </button>
+                        <p style="font-size: 12px; opacity: 0.5; margin-top: 10px;">Note: May take time for large files</p>
+                    </div>
+
+                    <!-- Download Option -->
+                    <div style="background: rgba(255,255,255,0.05); padding: 20px; border-radius: 16px; border: 1px solid rgba(255,255,255,0.1);">
+                        <h4 style="margin-bottom: 10px; color: #ff6b6b;">💾 Download</h4>
+                        <p style="font-size: 14px; opacity: 0.7; margin-bottom: 15px;">Download to watch later</p>
+                        <a href="${url.replace('/stream/', '/dl/')}" download class="btn btn-download" style="width: 100%;">
+                            ⬇️ Download Video
+                        </a>
+                    </div>
+                </div>
+            </div>
+        `;
+    } else {
+        // Use Plyr.js for streamable content - FORCE RAW-STREAM ONLY
+        console.log('🎬 Using Plyr.js with FORCED raw-stream for:', type);
+
+        // FORCE raw-stream endpoint - NEVER use proxy
+        let rawStreamUrl = url;
+        if (url.includes('/stream/')) {
+            rawStreamUrl = url.replace('/stream/', '/raw-stream/');
+        } else if (url.includes('/proxy/')) {
+            rawStreamUrl = url.replace('/proxy/', '/raw-stream/');
+        }
+
+        console.log('🚀 FORCED Stream URL being used:', rawStreamUrl);
+        console.log('🚫 NEVER using /proxy/ endpoint');
+
+        // Add visual indicator
+        const indicator = document.createElement('div');
+        indicator.style.cssText = 'position: fixed; top: 10px; right: 10px; background: #4CAF50; color: white; padding: 8px 12px; border-radius: 4px; font-size: 12px; z-index: 9999; font-family: monospace;';
+        indicator.textContent = '✅ Using /raw-stream/';
+        document.body.appendChild(indicator);
+        setTimeout(() => indicator.remove(), 3000);
+
+        if (type.startsWith('video/')) {
+            player.innerHTML = `
+                <video 
+                    id="plyr-video" 
+                    class="plyr-video" 
+                    controls 
+                    crossorigin 
+                    playsinline
+                    style="width: 100%; max-height: 70vh;"
+                >
+                    <source src="${url}" type="${type}">
+                    <p>Your browser doesn't support video playback.</p>
+                </video>
+            `;
+
+            // Initialize Plyr with optimized options for faster loading
+            const videoElement = document.getElementById('plyr-video');
+            currentPlayer = new Plyr(videoElement, {
+                controls: [
+                    'play-large',
+                    'play',
+                    'progress', 
+                    'current-time',
+                    'duration',
+                    'mute',
+                    'volume',
+                    'settings',
+                    'fullscreen'
+                ],
+                settings: ['quality', 'speed'],
+                quality: {
+                    default: 720,
+                    options: [1080, 720, 480, 360]
+                },
+                speed: {
+                    selected: 1,
+                    options: [0.5, 0.75, 1, 1.25, 1.5, 2]
+                },
+                tooltips: { controls: true, seek: true },
+                keyboard: { focused: true, global: true },
+                fullscreen: { enabled: true, fallback: true, iosNative: true },
+                storage: { enabled: true, key: 'plyr' },
+                // Scrub previews from the server-rendered storyboard - no media range requests
+                previewThumbnails: { enabled: !!storyboardUrl, src: storyboardUrl || '' },
+                // Optimizations for faster loading
+                preload: 'metadata', // Load metadata first, then buffer as needed
+                autopause: false,
+                resetOnEnd: false
+            });
+
+            // Optimize video element for streaming
+            videoElement.preload = 'metadata';
+            videoElement.crossOrigin = 'anonymous';
+
+            // Add loading optimization
+            videoElement.addEventListener('loadstart', () => {
+                console.log('🚀 Video loading started');
+                title.textContent = `Loading ${name}...`;
+            });
+
+            videoElement.addEventListener('loadedmetadata', () => {
+                console.log('✅ Video metadata loaded');
+                title.textContent = `Ready: ${name}`;
+            });
+
+            videoElement.addEventListener('canplay', () => {
+                console.log('✅ Video can start playing');
+                title.textContent = name;
+            });
+
+            // Add event listeners
+            currentPlayer.on('ready', () => {
+                console.log('Plyr ready');
+                title.textContent = name;
+            });
+
+            currentPlayer.on('loadstart', () => {
+                console.log('Loading started');
+                title.textContent = `Loading ${name}...`;
+            });
+
+            currentPlayer.on('error', (event) => {
+                console.error('Plyr error:', event);
+                player.innerHTML = `
+                    <div style="text-align: center; padding: 40px; color: #ff6b6b;">
+                        <p style="margin-bottom: 20px;">⚠️ Video playback failed</p>
+                        <p style="margin-bottom: 20px; font-size: 14px; opacity: 0.7;">
+                            The video might be corrupted, too large, or in an incompatible format.
+                        </p>
+                        <a href="${url.replace('/stream/', '/dl/')}" download class="btn btn-download" style="display: inline-flex;">
+                            <span>⬇️</span>
+                            <span>Download Instead</span>
+                        </a>
+                    </div>
+                `;
+            });
+
+        } else if (type.startsWith('audio/')) {
+            player.innerHTML = `
+                <audio 
+                    id="plyr-audio" 
+                    class="plyr-audio" 
+                    controls 
+                    crossorigin
+                    style="width: 100%;"
+                >
+                    <source src="${url}" type="${type}">
+                    <p>Your browser doesn't support audio playback.</p>
+                </audio>
+            `;
+
+            // Initialize Plyr for audio
+            const audioElement = document.getElementById('plyr-audio');
+            currentPlayer = new Plyr(audioElement, {
+                controls: [
+                    'play',
+                    'progress',
+                    'current-time',
+                    'duration',
+                    'mute',
+                    'volume',
+                    'settings'
+                ],
+                settings: ['speed'],
+                speed: {
+                    selected: 1,
+                    options: [0.5, 0.75, 1, 1.25, 1.5, 2]
+                }
+            });
+
+            currentPlayer.on('ready', () => {
+                console.log('Audio Plyr ready');
+                title.textContent = name;
+            });
+
+        } else if (type.startsWith('image/')) {
+            player.innerHTML = `
+                <div style="text-align: center;">
+                    <img src="${url}" alt="${name}" style="width: 100%; max-height: 70vh; object-fit: contain; border-radius: 8px;">
+                </div>
+            `;
+        }
+    }
+
+    // Animate modal
+    gsap.from('.modal-content', {
+        scale: 0.8,
+        opacity: 0,
+        duration: 0.3,
+        ease: 'back.out'
+    });
+}
+
+// Deep Link Functions for External Players
+function openInVLC(url, name) {
+    // Use current server's proxy endpoint for better performance
+    const streamUrl = url.replace('/stream/', '/proxy/');
+    const vlcUrl = `vlc://${window.location.origin}${streamUrl}`;
+
+    // Try to open VLC directly
+    window.location.href = vlcUrl;
+
+    // Fallback: show instructions
+    setTimeout(() => {
+        const fullUrl = `${window.location.origin}${streamUrl}`;
+        alert(`If VLC didn't open automatically:\n\n1. Copy this URL: ${fullUrl}\n2. Open VLC Media Player\n3. Go to Media > Open Network Stream\n4. Paste the URL and click Play\n\n🚀 This URL supports range requests for fast seeking!`);
+    }, 2000);
+}
+
+function openInMXPlayer(url, name) {
+    // Use current server's proxy endpoint
+    const streamUrl = url.replace('/stream/', '/proxy/');
+    const fullUrl = `${window.location.origin}${streamUrl}`;
+    const mxUrl = `intent:${fullUrl}#Intent;package=com.mxtech.videoplayer.ad;end`;
+
+    // Try to open MX Player
+    window.location.href = mxUrl;
+
+    // Fallback
+    setTimeout(() => {
+        alert(`If MX Player didn't open:\n\n1. Install MX Player from Play Store\n2. Copy this URL: ${fullUrl}\n3. Open MX Player > Network > Add URL\n\n⚡ This URL supports fast seeking and buffering!`);
+    }, 2000);
+}
+
+function openInDefaultPlayer(url, name) {
+    // Use current server's proxy endpoint
+    const streamUrl = url.replace('/stream/', '/proxy/');
+    const fullUrl = `${window.location.origin}${streamUrl}`;
+    const link = document.createElement('a');
+    link.href = fullUrl;
+    link.target = '_blank';
+    link.download = name;
+    link.click();
+
+    alert(`Opening in default player...\n\nURL: ${fullUrl}\n\nIf it doesn't work:\n1. Right-click the link\n2. Choose "Open with..." \n3. Select your preferred video player\n\n🎯 This URL is optimized for external players!`);
+}
+
+// WebAssembly Conversion Function
+async function convertAndPlay(url, name, type) {
+    const player = document.getElementById('mediaPlayer');
+    const title = document.getElementById('modalTitle');
+
+    try {
+        title.textContent = `Converting ${name}...`;
+        player.innerHTML = `
+            <div style="text-align: center; padding: 40px;">
+                <div style="font-size: 40px; margin-bottom: 20px;">⚡</div>
+                <h3 style="margin-bottom: 15px;">Converting Video...</h3>
+                <div style="width: 100%; background: rgba(255,255,255,0.1); border-radius: 10px; overflow: hidden; margin-bottom: 20px;">
+                    <div id="conversion-progress" style="width: 0%; height: 20px; background: linear-gradient(135deg, #667eea, #764ba2); transition: width 0.3s;"></div>
+                </div>
+                <p id="conversion-status" style="opacity: 0.7; font-size: 14px;">Initializing FFmpeg...</p>
+                <button onclick="closeStream()" style="margin-top: 20px; padding: 10px 20px; background: rgba(255,255,255,0.1); border: 1px solid rgba(255,255,255,0.2); border-radius: 8px; color: white; cursor: pointer;">
+                    Cancel
+                </button>
+            </div>
+        `;
+
+        // Check file size first - from the batched metadata, no request per file
+        const messageId = messageIdFromUrl(url);
+        if (messageId && !fileMeta[messageId]) {
+            await loadFileMeta([messageId]);
+        }
+        let fileSize = messageId && fileMeta[messageId] ? fileMeta[messageId].size : 0;
+        if (!fileSize) {
+            const response = await fetch(url, { method: 'HEAD' });
+            fileSize = parseInt(response.headers.get('content-length') || '0');
+        }
+
+        if (fileSize > 50 * 1024 * 1024) { // 50MB limit for browser conversion
+            throw new Error('File too large for browser conversion (>50MB). Please use VLC or download instead.');
+        }
+
+        // Update status
+        document.getElementById('conversion-status').textContent = 'Loading FFmpeg WebAssembly...';
+        document.getElementById('conversion-progress').style.width = '5%';
+
+        // Initialize FFmpeg
+        await initFFmpeg();
+
+        if (!ffmpeg) {
+            throw new Error('FFmpeg WebAssembly failed to load. Your browser may not support this feature.');
+        }
+
+        // Update progress
+        document.getElementById('conversion-status').textContent = 'Downloading video file...';
+        document.getElementById('conversion-progress').style.width = '15%';
+
+        // Fetch the video file
+        const videoResponse = await fetch(url);
+        if (!videoResponse.ok) {
+            throw new Error(`Failed to download video: ${videoResponse.status} ${videoResponse.statusText}`);
+        }
+
+        const arrayBuffer = await videoResponse.arrayBuffer();
+        const inputData = new Uint8Array(arrayBuffer);
+
+        // Update progress
+        document.getElementById('conversion-status').textContent = 'Preparing conversion...';
+        document.getElementById('conversion-progress').style.width = '25%';
+
+        // Write input file
+        await ffmpeg.writeFile('input.mkv', inputData);
+
+        // Update progress
+        document.getElementById('conversion-status').textContent = 'Converting to MP4 (this may take a while)...';
+        document.getElementById('conversion-progress').style.width = '35%';
+
+        // Convert with optimized settings for web playback
+        await ffmpeg.exec([
+            '-i', 'input.mkv',
+            '-c:v', 'libx264',
+            '-preset', 'ultrafast',
+            '-crf', '28',
+            '-c:a', 'aac',
+            '-ac', '2',
+            '-ar', '44100',
+            '-movflags', '+faststart',
+            '-f', 'mp4',
+            'output.mp4'
+        ]);
+
+        // Update progress
+        document.getElementById('conversion-status').textContent = 'Finalizing...';
+        document.getElementById('conversion-progress').style.width = '90%';
+
+        // Read output file
+        const outputData = await ffmpeg.readFile('output.mp4');
+
+        // Create blob URL
+        const blob = new Blob([outputData.buffer], { type: 'video/mp4' });
+        const convertedUrl = URL.createObjectURL(blob);
+
+        // Update progress
+        document.getElementById('conversion-progress').style.width = '100%';
+
+        // Clean up FFmpeg files
+        try {
+            await ffmpeg.deleteFile('input.mkv');
+            await ffmpeg.deleteFile('output.mp4');
+        } catch (e) {
+            console.warn('Failed to clean up FFmpeg files:', e);
+        }
+
+        // Play converted video
+        title.textContent = name;
+        player.innerHTML = `
+            <video 
+                id="plyr-converted" 
+                class="plyr-video" 
+                controls 
+                autoplay
+                style="width: 100%; max-height: 70vh;"
+            >
+                <source src="${convertedUrl}" type="video/mp4">
+            </video>
+        `;
+
+        // Initialize Plyr for converted video
+        const videoElement = document.getElementById('plyr-converted');
+        currentPlayer = new Plyr(videoElement, {
+            controls: [
+                'play-large', 'play', 'progress', 'current-time', 'duration',
+                'mute', 'volume', 'settings', 'fullscreen'
+            ]
+        });
+
+        currentPlayer.on('ready', () => {
+            console.log('Converted video ready');
+        });
+
+    } catch (error) {
+        console.error('Conversion failed:', error);
+
+        let errorMessage = error.message;
+        let suggestions = [];
+
+        if (error.message.includes('FFmpeg WebAssembly failed to load')) {
+            suggestions.push('Try using a modern browser (Chrome, Firefox, Safari)');
+            suggestions.push('Check if JavaScript is enabled');
+        } else if (error.message.includes('File too large')) {
+            suggestions.push('Use VLC Player for large files');
+            suggestions.push('Download the file to watch locally');
+        } else if (error.message.includes('Failed to download')) {
+            suggestions.push('Check your internet connection');
+            suggestions.push('Try refreshing the page');
+        } else {
+            suggestions.push('VLC Player can play MKV files perfectly');
+            suggestions.push('Try downloading the file instead');
+        }
+
+        player.innerHTML = `
+            <div style="text-align: center; padding: 40px; color: #ff6b6b;">
+                <p style="margin-bottom: 20px;">⚠️ Conversion failed</p>
+                <p style="margin-bottom: 20px; font-size: 14px; opacity: 0.7;">
+                    ${errorMessage}
+                </p>
+                <div style="display: flex; gap: 10px; justify-content: center; flex-wrap: wrap; margin-bottom: 20px;">
+                    <button onclick="openInVLC('${url}', '${name}')" class="btn btn-stream" style="flex: none;">
+                        🎯 Try VLC Instead
+                    </button>
+                    <a href="${url.replace('/stream/', '/dl/')}" download class="btn btn-download" style="flex: none;">
+                        ⬇️ Download
+                    </a>
+                </div>
+                <div style="font-size: 12px; opacity: 0.6; text-align: left; max-width: 400px; margin: 0 auto;">
+                    <p style="margin-bottom: 10px;"><strong>💡 Suggestions:</strong></p>
+                    ${suggestions.map(s => `<p style="margin-bottom: 5px;">• ${s}</p>`).join('')}
+                </div>
+            </div>
+        `;
+    }
+}
+
+function closeStream() {
+    const modal = document.getElementById('streamModal');
+    const player = document.getElementById('mediaPlayer');
+
+    // Destroy Plyr instance
+    if (currentPlayer) {
+        currentPlayer.destroy();
+        currentPlayer = null;
+    }
+
+    // Clean up any blob URLs
+    const videos = player.querySelectorAll('video');
+    videos.forEach(video => {
+        if (video.src && video.src.startsWith('blob:')) {
+            URL.revokeObjectURL(video.src);
+        }
+    });
+
+    gsap.to('.modal-content', {
+        scale: 0.8,
+        opacity: 0,
+        duration: 0.2,
+        onComplete: () => {
+            modal.classList.remove('active');
+            player.innerHTML = '';
+        }
+    });
+}
+
+async function testStreaming() {
+    console.log('Testing streaming functionality...');
+
+    const ids = listState.files.map(file => file.message_id);
+    if (!ids.length) {
+        alert('No files found to test with');
+        return;
+    }
+
+    // One batched metadata call instead of a /test-stream round-trip per file
+    try {
+        const data = await loadFileMeta(ids);
+        console.log('Stream test result:', data);
+        const found = data.files.filter(file => file.found);
+        const streamable = found.filter(file => file.can_stream);
+        alert(`✅ Streaming test passed!\n\nFiles: ${found.length} of ${ids.length} reachable\nStreamable: ${streamable.length}\nFetched from Telegram: ${data.fetched}, cached: ${data.cached}`);
+    } catch (error) {
+        console.error('Stream test error:', error);
+        alert(`❌ Streaming test failed!\n\nError: ${error.message}`);
+    }
+}
+
+// ========================================
+// Three.js Interactive 3D Scene
+// ========================================
+
+let scene, camera, renderer, particles, folders, mouse, raycaster;
+
+function initThreeJS() {
+    // Scene setup
+    scene = new THREE.Scene();
+    camera = new THREE.PerspectiveCamera(75, window.innerWidth / window.innerHeight, 0.1, 1000);
+    camera.position.z = 30;
+
+    renderer = new THREE.WebGLRenderer({ alpha: true, antialias: true });
+    renderer.setSize(window.innerWidth, window.innerHeight);
+    renderer.setPixelRatio(window.devicePixelRatio);
+    document.getElementById('three-bg').appendChild(renderer.domElement);
+
+    // Mouse tracking
+    mouse = new THREE.Vector2();
+    raycaster = new THREE.Raycaster();
+
+    // Create floating particles
+    createParticles();
+
+    // Create 3D folder icons
+    createFolders();
+
+    // Lighting
+    const ambientLight = new THREE.AmbientLight(0xffffff, 0.5);
+    scene.add(ambientLight);
+
+    const pointLight = new THREE.PointLight(0x667eea, 2);
+    pointLight.position.set(10, 10, 10);
+    scene.add(pointLight);
+
+    const pointLight2 = new THREE.PointLight(0x764ba2, 2);
+    pointLight2.position.set(-10, -10, 10);
+    scene.add(pointLight2);
+
+    // Event listeners
+    window.addEventListener('mousemove', onMouseMove);
+    window.addEventListener('click', onMouseClick);
+    window.addEventListener('resize', onWindowResize);
+
+    // Start animation
+    animate();
+}
+
+function createParticles() {
+    const geometry = new THREE.BufferGeometry();
+    const particleCount = 200;
+    const positions = new Float32Array(particleCount * 3);
+    const colors = new Float32Array(particleCount * 3);
+
+    for (let i = 0; i < particleCount * 3; i += 3) {
+        positions[i] = (Math.random() - 0.5) * 100;
+        positions[i + 1] = (Math.random() - 0.5) * 100;
+        positions[i + 2] = (Math.random() - 0.5) * 50;
+
+        // Gradient colors
+        const t = Math.random();
+        colors[i] = 0.4 + t * 0.2;     // R
+        colors[i + 1] = 0.5 + t * 0.2; // G
+        colors[i + 2] = 0.9 + t * 0.1; // B
+    }
+
+    geometry.setAttribute('position', new THREE.BufferAttribute(positions, 3));
+    geometry.setAttribute('color', new THREE.BufferAttribute(colors, 3));
+
+    const material = new THREE.PointsMaterial({
+        size: 0.5,
+        vertexColors: true,
+        transparent: true,
+        opacity: 0.8,
+        blending: THREE.AdditiveBlending
+    });
+
+    particles = new THREE.Points(geometry, material);
+    scene.add(particles);
+}
+
+function createFolders() {
+    folders = [];
+    const folderCount = 8;
+
+    for (let i = 0; i < folderCount; i++) {
+        // Create folder shape
+        const folderGroup = new THREE.Group();
+
+        // Folder body
+        const bodyGeometry = new THREE.BoxGeometry(3, 2, 0.5);
+        const bodyMaterial = new THREE.MeshPhongMaterial({
+            color: 0x667eea,
+            transparent: true,
+            opacity: 0.7,
+            emissive: 0x667eea,
+            emissiveIntensity: 0.2
+        });
+        const body = new THREE.Mesh(bodyGeometry, bodyMaterial);
+        folderGroup.add(body);
+
+        // Folder tab
+        const tabGeometry = new THREE.BoxGeometry(1.5, 0.5, 0.5);
+        const tab = new THREE.Mesh(tabGeometry, bodyMaterial);
+        tab.position.set(-0.75, 1.25, 0);
+        folderGroup.add(tab);
+
+        // Position folders in a circle
+        const angle = (i / folderCount) * Math.PI * 2;
+        const radius = 15;
+        folderGroup.position.x = Math.cos(angle) * radius;
+        folderGroup.position.y = Math.sin(angle) * radius;
+        folderGroup.position.z = Math.random() * 10 - 5;
+
+        // Random rotation
+        folderGroup.rotation.x = Math.random() * Math.PI;
+        folderGroup.rotation.y = Math.random() * Math.PI;
+
+        // Store initial position for animation
+        folderGroup.userData = {
+            initialX: folderGroup.position.x,
+            initialY: folderGroup.position.y,
+            initialZ: folderGroup.position.z,
+            rotationSpeed: Math.random() * 0.02 - 0.01,
+            floatSpeed: Math.random() * 0.5 + 0.5
+        };
+
+        scene.add(folderGroup);
+        folders.push(folderGroup);
+    }
+}
+
+function onMouseMove(event) {
+    mouse.x = (event.clientX / window.innerWidth) * 2 - 1;
+    mouse.y = -(event.clientY / window.innerHeight) * 2 + 1;
+
+    // Move camera based on mouse
+    camera.position.x = mouse.x * 5;
+    camera.position.y = mouse.y * 5;
+    camera.lookAt(scene.position);
+}
+
+function onMouseClick(event) {
+    raycaster.setFromCamera(mouse, camera);
+    const intersects = raycaster.intersectObjects(folders, true);
+
+    if (intersects.length > 0) {
+        const clickedFolder = intersects[0].object.parent;
+
+        // Explosion animation
+        gsap.to(clickedFolder.position, {
+            x: clickedFolder.position.x * 2,
+            y: clickedFolder.position.y * 2,
+            z: clickedFolder.position.z + 20,
+            duration: 0.5,
+            ease: 'power2.out',
+            onComplete: () => {
+                // Return to original position
+                gsap.to(clickedFolder.position, {
+                    x: clickedFolder.userData.initialX,
+                    y: clickedFolder.userData.initialY,
+                    z: clickedFolder.userData.initialZ,
+                    duration: 1,
+                    ease: 'elastic.out'
+                });
+            }
+        });
+    }
+}
+
+function onWindowResize() {
+    camera.aspect = window.innerWidth / window.innerHeight;
+    camera.updateProjectionMatrix();
+    renderer.setSize(window.innerWidth, window.innerHeight);
+}
+
+function animate() {
+    requestAnimationFrame(animate);
+
+    const time = Date.now() * 0.001;
+
+    // Rotate particles
+    if (particles) {
+        particles.rotation.y = time * 0.05;
+        particles.rotation.x = time * 0.03;
+    }
+
+    // Animate folders
+    folders.forEach((folder, i) => {
+        // Floating animation
+        folder.position.y = folder.userData.initialY + Math.sin(time * folder.userData.floatSpeed + i) * 2;
+
+        // Gentle rotation
+        folder.rotation.z += folder.userData.rotationSpeed;
+    });
+
+    renderer.render(scene, camera);
+}
+
+// ========================================
+// GSAP Animations with Advanced Effects
+// ========================================
+
+gsap.registerPlugin(ScrollTrigger);
+
+// Tilt, spotlight and button hover effects, bound once per card element
+function attachCardEffects(card) {
+    // Perspective Tilt Effect on File Cards
+    card.addEventListener('mousemove', (e) => {
+        const rect = card.getBoundingClientRect();
+        const x = e.clientX - rect.left;
+        const y = e.clientY - rect.top;
+
+        const centerX = rect.width / 2;
+        const centerY = rect.height / 2;
+
+        const rotateX = (y - centerY) / centerY * -10;
+        const rotateY = (x - centerX) / centerX * 10;
+
+        gsap.to(card, {
+            duration: 0.3,
+            rotationX: rotateX,
+            rotationY: rotateY,
+            transformPerspective: 1000,
+            ease: "power2.out"
+        });
+    });
+
+    card.addEventListener('mouseleave', () => {
+        gsap.to(card, {
+            duration: 0.5,
+            rotationX: 0,
+            rotationY: 0,
+            ease: "elastic.out(1, 0.3)"
+        });
+    });
+
+    // Enhanced Button Effects
+    card.querySelectorAll('.btn-stream').forEach(button => {
+        button.addEventListener('mouseenter', () => {
+            gsap.to(button, {
+                duration: 0.3,
+                scale: 1.05,
+                ease: "power2.out"
+            });
+        });
+
+        button.addEventListener('mouseleave', () => {
+            gsap.to(button, {
+                duration: 0.3,
+                scale: 1,
+                ease: "power2.out"
+            });
+        });
+    });
+
+    // Spotlight Effect
+    card.addEventListener('mouseenter', () => {
+        gsap.to(document.getElementById('spotlight'), {
+            duration: 0.3,
+            opacity: 0.5,
+            ease: "power2.out"
+        });
+    });
+
+    card.addEventListener('mouseleave', () => {
+        gsap.to(document.getElementById('spotlight'), {
+            duration: 0.5,
+            opacity: 0,
+            ease: "power2.out"
+        });
+    });
+}
+
+// Initialize everything when DOM is ready
+document.addEventListener('DOMContentLoaded', () => {
+    // Initialize Three.js
+    initThreeJS();
+
+    initFileList();
+
+    // Metadata for the first page in one request; also warms the server's media cache
+    const cardIds = listState.files.map(file => file.message_id);
+    if (cardIds.length) {
+        loadFileMeta(cardIds).catch(error => console.warn('Metadata preload failed:', error));
+    }
+
+    // New and deleted channel files show up without reloading the page
+    watchFileChanges(cardIds.length ? Math.max(...cardIds) : 0);
+
+    // Staggered Entrance Animation, for the cards on screen at load
+    const initialCards = Array.from(listState.rendered.values());
+    gsap.set(initialCards, { y: 100, opacity: 0, rotationX: -15 });
+
+    gsap.to(initialCards, {
+        y: 0,
+        opacity: 1,
+        rotationX: 0,
+        duration: 0.8,
+        stagger: {
+            amount: 1.2,
+            from: "start",
+            ease: "back.out(1.7)"
+        },
+        ease: "back.out(1.7)",
+        delay: 0.5
+    });
+
+    // Animate header
+    gsap.from('.header', {
+        y: -100,
+        opacity: 0,
+        duration: 1.2,
+        ease: 'bounce.out',
+        delay: 0.2
+    });
+
+    // Close modal on background click
+    const modal = document.getElementById('streamModal');
+    modal.addEventListener('click', (e) => {
+        if (e.target.id === 'streamModal') {
+            closeStream();
+        }
+    });
+
+    // A card clicked while the page was still streaming in
+    if (window.pendingStream) {
+        openStream(...window.pendingStream);
+        window.pendingStream = null;
+    }
+});
+
+// PWA Service Worker
+if ('serviceWorker' in navigator) {
+    // Root scope so listings, thumbnails and media go through it; drop the old /static/ registration
+    navigator.serviceWorker.getRegistrations().then(registrations => {
+        registrations.filter(reg => reg.scope.endsWith('/static/')).forEach(reg => reg.unregister());
+    });
+    navigator.serviceWorker.register('/sw.js', { scope: '/' })
+        .then(reg => console.log('SW registered', reg))
+        .catch(err => console.log('SW error', err));
+}
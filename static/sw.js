@@ -1,36 +1,248 @@
 // Service Worker for PWA
-const CACHE_NAME = 'tg-browser-v1';
-const urlsToCache = [
-  '/',
-  '/static/manifest.json',
-  'https://cdnjs.cloudflare.com/ajax/libs/gsap/3.12.5/gsap.min.js',
-  'https://unpkg.com/@splinetool/viewer@1.0.47/build/spline-viewer.js'
-];
-
-self.addEventListener('install', event => {
+// Served from /sw.js (root scope) with __ASSET_VERSION__ replaced by the asset pipeline hash
+const VERSION = '__ASSET_VERSION__';
+const PAGES_CACHE = `tg-pages-${VERSION}`;
+const ASSETS_CACHE = `tg-assets-${VERSION}`;
+const THUMBS_CACHE = 'tg-thumbs';
+const MEDIA_CACHE = 'tg-media';
+const SETTINGS_CACHE = 'tg-settings';
+const SETTINGS_URL = '/__sw/settings';
+const MEDIA_INDEX_URL = '/__sw/media-index';
+
+const CHUNK_SIZE = 1024 * 1024;  // Same as the server's chunk cache
+const FETCH_CHUNKS = 2;  // Whole chunks fetched for an uncached range
+const MAX_LOCAL_RESPONSE = 8 * CHUNK_SIZE;  // Bytes answered from the store per range request
+const LISTING_PATHS = ['/', '/api/files'];
+const MEDIA_PATH = /^\/(faststart|raw-stream|proxy|stream|remux)\//;
+
+self.addEventListener('install', () => {
+  self.skipWaiting();
+});
+
+self.addEventListener('activate', event => {
+  const current = [PAGES_CACHE, ASSETS_CACHE, THUMBS_CACHE, MEDIA_CACHE, SETTINGS_CACHE];
   event.waitUntil(
-    caches.open(CACHE_NAME)
-      .then(cache => cache.addAll(urlsToCache))
+    caches.keys()
+      .then(cacheNames => Promise.all(
+        cacheNames
+          .filter(cacheName => !current.includes(cacheName))
+          .map(cacheName => caches.delete(cacheName))
+      ))
+      .then(() => self.clients.claim())
   );
 });
 
 self.addEventListener('fetch', event => {
-  event.respondWith(
-    caches.match(event.request)
-      .then(response => response || fetch(event.request))
-  );
+  const request = event.request;
+  const url = new URL(request.url);
+  if (request.method !== 'GET' || url.origin !== self.location.origin) {
+    return;
+  }
+
+  if (LISTING_PATHS.includes(url.pathname)) {
+    event.respondWith(staleWhileRevalidate(event, PAGES_CACHE));
+  } else if (url.pathname.startsWith('/assets/')) {
+    // Fingerprinted - a URL never changes content
+    event.respondWith(cacheFirst(request, ASSETS_CACHE));
+  } else if (url.pathname.startsWith('/thumbnail/') && url.searchParams.has('v')) {
+    // v is the thumbnail's unique id, also sent as its ETag
+    event.respondWith(cacheFirst(request, THUMBS_CACHE));
+  } else if (MEDIA_PATH.test(url.pathname) && !url.search && request.headers.has('range')) {
+    event.respondWith(mediaRange(event, url));
+  }
 });
 
-self.addEventListener('activate', event => {
+async function staleWhileRevalidate(event, cacheName) {
+  const cache = await caches.open(cacheName);
+  const cached = await cache.match(event.request);
+  const network = fetch(event.request).then(response => {
+    if (response.ok) {
+      cache.put(event.request, response.clone());
+    }
+    return response;
+  });
+  if (cached) {
+    event.waitUntil(network.catch(() => {}));
+    return cached;
+  }
+  return network;
+}
+
+async function cacheFirst(request, cacheName) {
+  const cache = await caches.open(cacheName);
+  const cached = await cache.match(request);
+  if (cached) {
+    return cached;
+  }
+  const response = await fetch(request);
+  if (response.ok) {
+    cache.put(request, response.clone());
+  }
+  return response;
+}
+
+// ========================================
+// Opt-in chunk store for recently played media
+// ========================================
+
+async function readJson(cache, key, fallback) {
+  const response = await cache.match(key);
+  return response ? response.json() : fallback;
+}
+
+function writeJson(cache, key, value) {
+  return cache.put(key, new Response(JSON.stringify(value), { headers: { 'Content-Type': 'application/json' } }));
+}
+
+async function getSettings() {
+  const cache = await caches.open(SETTINGS_CACHE);
+  return readJson(cache, SETTINGS_URL, { mediaCache: false, budgetMB: 512 });
+}
+
+// Serialize read-modify-write of the media index across concurrent range requests
+let mediaIndexLock = Promise.resolve();
+function withMediaIndex(update) {
+  const run = mediaIndexLock.then(async () => {
+    const cache = await caches.open(MEDIA_CACHE);
+    const index = await readJson(cache, MEDIA_INDEX_URL, { files: {} });
+    const result = await update(cache, index);
+    await writeJson(cache, MEDIA_INDEX_URL, index);
+    return result;
+  });
+  mediaIndexLock = run.catch(() => {});
+  return run;
+}
+
+async function evictFile(cache, index, key) {
+  const requests = await cache.keys();
+  await Promise.all(
+    requests
+      .filter(request => new URL(request.url).pathname === key)
+      .map(request => cache.delete(request))
+  );
+  delete index.files[key];
+}
+
+async function storeChunks(key, firstIndex, data, meta, settings) {
+  const chunks = [];
+  for (let offset = 0; offset < data.length; offset += CHUNK_SIZE) {
+    const chunk = data.subarray(offset, offset + CHUNK_SIZE);
+    const index = firstIndex + offset / CHUNK_SIZE;
+    // Only whole chunks, or the final one of the file
+    if (chunk.length === CHUNK_SIZE || index * CHUNK_SIZE + chunk.length === meta.size) {
+      chunks.push([index, chunk]);
+    }
+  }
+  if (!chunks.length) {
+    return;
+  }
+  const bytes = chunks.reduce((sum, [, chunk]) => sum + chunk.length, 0);
+
+  await withMediaIndex(async (cache, index) => {
+    const entry = index.files[key] || { bytes: 0, used: 0, chunks: [] };
+    index.files[key] = entry;
+    entry.used = Date.now();
+
+    // Least recently played files go first, within the budget and the origin quota
+    const budget = settings.budgetMB * 1024 * 1024;
+    const estimate = navigator.storage && navigator.storage.estimate ? await navigator.storage.estimate() : null;
+    const total = () => Object.values(index.files).reduce((sum, file) => sum + file.bytes, 0);
+    const overQuota = () => estimate && estimate.usage + bytes > estimate.quota * 0.8;
+    const victims = Object.keys(index.files)
+      .filter(other => other !== key)
+      .sort((a, b) => index.files[a].used - index.files[b].used);
+    while ((total() + bytes > budget || overQuota()) && victims.length) {
+      const victim = victims.shift();
+      if (estimate) {
+        estimate.usage -= index.files[victim].bytes;
+      }
+      await evictFile(cache, index, victim);
+    }
+    if (total() + bytes > budget || overQuota()) {
+      return;
+    }
+
+    await writeJson(cache, `${key}?meta`, meta);
+    for (const [chunkIndex, chunk] of chunks) {
+      if (!entry.chunks.includes(chunkIndex)) {
+        await cache.put(`${key}?chunk=${chunkIndex}`, new Response(chunk));
+        entry.chunks.push(chunkIndex);
+        entry.bytes += chunk.length;
+      }
+    }
+  });
+}
+
+function rangeResponse(pieces, start, stop, meta) {
+  return new Response(new Blob(pieces, { type: meta.type }), {
+    status: 206,
+    headers: {
+      'Content-Type': meta.type,
+      'Content-Range': `bytes ${start}-${stop}/${meta.size}`,
+      'Content-Length': String(stop - start + 1),
+      'Accept-Ranges': 'bytes'
+    }
+  });
+}
+
+async function mediaRange(event, url) {
+  const request = event.request;
+  const settings = await getSettings();
+  const match = /^bytes=(\d+)-(\d*)$/.exec(request.headers.get('range'));
+  if (!settings.mediaCache || !match) {
+    return fetch(request);
+  }
+  const key = url.pathname;
+  const start = parseInt(match[1]);
+  const end = match[2] ? parseInt(match[2]) : null;
+  const firstIndex = Math.floor(start / CHUNK_SIZE);
+  const cache = await caches.open(MEDIA_CACHE);
+
+  // Answer locally from the contiguous cached chunks starting at the requested byte
+  const meta = await readJson(cache, `${key}?meta`, null);
+  if (meta && start < meta.size) {
+    const stop = Math.min(end === null ? meta.size - 1 : end, start + MAX_LOCAL_RESPONSE - 1, meta.size - 1);
+    const pieces = [];
+    let position = start;
+    for (let index = firstIndex; position <= stop; index++) {
+      const chunk = await cache.match(`${key}?chunk=${index}`);
+      if (!chunk) {
+        break;
+      }
+      const data = new Uint8Array(await chunk.arrayBuffer());
+      const base = index * CHUNK_SIZE;
+      const piece = data.subarray(position - base, Math.min(stop - base + 1, data.length));
+      pieces.push(piece);
+      position += piece.length;
+    }
+    if (pieces.length) {
+      event.waitUntil(withMediaIndex(async (_, index) => {
+        if (index.files[key]) {
+          index.files[key].used = Date.now();
+        }
+      }));
+      return rangeResponse(pieces, start, position - 1, meta);
+    }
+  }
+
+  // Miss - fetch whole aligned chunks so they can be stored, then answer from them
+  const alignedStart = firstIndex * CHUNK_SIZE;
+  const response = await fetch(url.pathname, {
+    headers: { Range: `bytes=${alignedStart}-${alignedStart + FETCH_CHUNKS * CHUNK_SIZE - 1}` }
+  });
+  const size = parseInt((response.headers.get('content-range') || '').split('/')[1]);
+  if (response.status !== 206 || !size) {
+    return response.status === 206 ? fetch(request) : response;
+  }
+
+  const data = new Uint8Array(await response.arrayBuffer());
+  const fetchedMeta = { size, type: response.headers.get('content-type') || 'application/octet-stream' };
+  const stop = Math.min(end === null ? size - 1 : end, alignedStart + data.length - 1);
+  if (start > stop) {
+    return fetch(request);
+  }
   event.waitUntil(
-    caches.keys().then(cacheNames => {
-      return Promise.all(
-        cacheNames.map(cacheName => {
-          if (cacheName !== CACHE_NAME) {
-            return caches.delete(cacheName);
-          }
-        })
-      );
-    })
+    storeChunks(key, firstIndex, data, fetchedMeta, settings).catch(error => console.warn('Media cache store failed:', error))
   );
-});
+  return rangeResponse([data.subarray(start - alignedStart, stop - alignedStart + 1)], start, stop, fetchedMeta);
+}
@@ -5,13 +5,25 @@ Deploy this to a free host like Railway, Render, or Vercel
 """
 
 import os
+import re
+import json
+import hmac
+import time
+import base64
+import hashlib
 import logging
-from typing import AsyncGenerator
+import asyncio
+from collections import OrderedDict
+from typing import AsyncGenerator, Dict
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pyrogram import Client
-from pyrogram.errors import RPCError
+from pyrogram import Client, raw
+from pyrogram.errors import (
+    AuthBytesInvalid, FileReferenceExpired, FileReferenceInvalid, FloodWait, InternalServerError
+)
+from pyrogram.file_id import FileId, FileType
+from pyrogram.session import Session, Auth
 import uvicorn
 from dotenv import load_dotenv
 
@@ -27,6 +39,14 @@ API_ID = os.getenv("TG_API_ID")
 API_HASH = os.getenv("TG_API_HASH")
 SESSION_STRING = os.getenv("TG_SESSION_STRING")
 PORT = int(os.getenv("PORT", 8000))
+MAX_STREAMS = int(os.getenv("MAX_STREAMS", 8))  # Concurrent streams this node is sized for, reported to main.py
+STREAM_SECRET = os.getenv("STREAM_SECRET")  # Shared with main.py to verify signed /s/ links
+STREAM_RETRIES = int(os.getenv("STREAM_RETRIES", 5))  # Consecutive failed GetFile attempts before a stream gives up
+STREAM_MAX_FLOOD_WAIT = int(os.getenv("STREAM_MAX_FLOOD_WAIT", 60))  # Longest FloodWait (seconds) waited out mid-stream
+REFRESHED_IDS_SIZE = int(os.getenv("REFRESHED_IDS_SIZE", 5000))  # Refreshed file ids kept in memory
+
+# Telegram serves files in parts of at most 1 MiB
+CHUNK_SIZE = 1024 * 1024
 
 # Validate environment variables
 if not all([API_ID, API_HASH, SESSION_STRING]):
@@ -55,6 +75,199 @@ client = Client(
     takeout=False
 )
 
+# Streams currently being served, reported by /healthz for load-aware routing
+active_streams = 0
+
+# Streams resumed after transient errors, reported by /healthz
+stream_stats = {"resumed": 0, "retries": 0, "stalled_seconds": 0.0, "failed": 0}
+
+# Fresh file ids for "chat_id:message_id" whose signed file_reference expired
+refreshed_file_ids: "OrderedDict[str, str]" = OrderedDict()
+
+
+async def get_media_session(dc_id: int) -> Session:
+    """Return a persistent media session for a DC, creating it on first use"""
+    async with client.media_sessions_lock:
+        session = client.media_sessions.get(dc_id)
+        if session:
+            return session
+
+        test_mode = await client.storage.test_mode()
+
+        if dc_id == await client.storage.dc_id():
+            session = Session(client, dc_id, await client.storage.auth_key(), test_mode, is_media=True)
+            await session.start()
+        else:
+            session = Session(client, dc_id, await Auth(client, dc_id, test_mode).create(), test_mode, is_media=True)
+            await session.start()
+
+            for _ in range(3):
+                exported_auth = await client.invoke(raw.functions.auth.ExportAuthorization(dc_id=dc_id))
+                try:
+                    await session.invoke(
+                        raw.functions.auth.ImportAuthorization(id=exported_auth.id, bytes=exported_auth.bytes)
+                    )
+                except AuthBytesInvalid:
+                    continue
+                else:
+                    break
+            else:
+                await session.stop()
+                raise AuthBytesInvalid
+
+        client.media_sessions[dc_id] = session
+        return session
+
+
+def get_file_location(file_id: FileId):
+    """Build the GetFile input location for a decoded file id"""
+    if file_id.file_type == FileType.PHOTO:
+        return raw.types.InputPhotoFileLocation(
+            id=file_id.media_id,
+            access_hash=file_id.access_hash,
+            file_reference=file_id.file_reference,
+            thumb_size=file_id.thumbnail_size
+        )
+    return raw.types.InputDocumentFileLocation(
+        id=file_id.media_id,
+        access_hash=file_id.access_hash,
+        file_reference=file_id.file_reference,
+        thumb_size=file_id.thumbnail_size
+    )
+
+
+def get_media(message):
+    """Return the downloadable media object of a message, if any"""
+    for kind in ("video", "audio", "document", "photo", "animation", "voice", "video_note"):
+        media = getattr(message, kind, None)
+        if media:
+            return media
+    return None
+
+
+async def refresh_file_id(ref: Dict) -> FileId:
+    """Re-fetch the message behind a file to get a fresh file_reference"""
+    message = await client.get_messages(ref["chat_id"], ref["message_id"])
+    media = get_media(message) if message else None
+    if not media:
+        raise HTTPException(status_code=404, detail="Media not found")
+
+    key = f"{ref['chat_id']}:{ref['message_id']}"
+    refreshed_file_ids[key] = media.file_id
+    refreshed_file_ids.move_to_end(key)
+    while len(refreshed_file_ids) > REFRESHED_IDS_SIZE:
+        refreshed_file_ids.popitem(last=False)
+    logger.info(f"Refreshed file reference for {ref['chat_id']}/{ref['message_id']}")
+    return FileId.decode(media.file_id)
+
+
+def resume_delay(error: Exception, attempt: int):
+    """Seconds to wait before retrying a GetFile part, None when the error is not transient"""
+    if isinstance(error, FloodWait):
+        return error.value if error.value <= STREAM_MAX_FLOOD_WAIT else None
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError, OSError, InternalServerError)) or \
+            re.search(r"Timeout|Connection|RPC_CALL_FAIL", f"{type(error).__name__}: {error}"):
+        return min(0.5 * 2 ** attempt, 8)
+    return None
+
+
+async def iter_file(ref: Dict, start: int, end: int) -> AsyncGenerator[bytes, None]:
+    """
+    Yield bytes start..end (inclusive) of a file straight from GetFile.
+
+    ref holds chat_id, message_id and file_id. An expired file_reference is
+    refreshed from the message once, and timeouts, dropped connections,
+    Telegram 500s and short FloodWaits are retried with backoff; either way
+    the read resumes at the same offset, so the client only sees a pause.
+    """
+    key = f"{ref['chat_id']}:{ref['message_id']}"
+    file_id_str = refreshed_file_ids.get(key, ref["file_id"])
+    if key in refreshed_file_ids:
+        refreshed_file_ids.move_to_end(key)
+    file_id = FileId.decode(file_id_str)
+    session = await get_media_session(file_id.dc_id)
+
+    offset = start - start % CHUNK_SIZE
+    skip = start - offset
+    remaining = end - start + 1
+    refreshed = False
+    failures = 0
+    retries = 0
+    stalled = 0.0
+
+    while remaining > 0:
+        started = time.monotonic()
+        try:
+            r = await session.invoke(
+                raw.functions.upload.GetFile(location=get_file_location(file_id), offset=offset, limit=CHUNK_SIZE),
+                sleep_threshold=30
+            )
+        except (FileReferenceExpired, FileReferenceInvalid):
+            if refreshed:
+                raise
+            file_id = await refresh_file_id(ref)
+            refreshed = True
+            retries += 1
+            continue
+        except Exception as e:
+            delay = resume_delay(e, failures)
+            if delay is None or failures >= STREAM_RETRIES:
+                stream_stats["failed"] += 1
+                raise
+            failures += 1
+            retries += 1
+            stream_stats["retries"] += 1
+            logger.warning(f"GetFile at {offset} of {ref['chat_id']}/{ref['message_id']} failed: {e}; retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            stalled += time.monotonic() - started
+            continue
+
+        if failures:
+            stream_stats["resumed"] += 1
+            stream_stats["stalled_seconds"] += stalled
+            logger.info(f"Stream {ref['chat_id']}/{ref['message_id']} resumed at {offset} after {retries} retries, {stalled:.1f}s stalled")
+            failures = 0
+            stalled = 0.0
+
+        part = r.bytes
+        if not part:
+            break
+        last_part = len(part) < CHUNK_SIZE
+
+        part = part[skip:skip + remaining]
+        skip = 0
+        remaining -= len(part)
+        offset += CHUNK_SIZE
+        yield part
+
+        if last_part:
+            break
+
+
+def b64url_decode(data: str) -> bytes:
+    """Decode unpadded URL-safe base64"""
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def verify_stream_token(token: str) -> Dict:
+    """Check a signed link from main.py and return its claims"""
+    if not STREAM_SECRET:
+        raise HTTPException(status_code=404, detail="Signed links are not enabled")
+
+    try:
+        body, signature = token.split(".")
+        expected = hmac.new(STREAM_SECRET.encode(), body.encode(), hashlib.sha256).digest()[:16]
+        if not hmac.compare_digest(b64url_decode(signature), expected):
+            raise ValueError("bad signature")
+        claims = json.loads(b64url_decode(body))
+    except (ValueError, TypeError) as e:
+        logger.warning(f"Rejected stream token: {e}")
+        raise HTTPException(status_code=403, detail="Invalid stream link")
+
+    if claims["e"] < time.time():
+        raise HTTPException(status_code=403, detail="Stream link expired")
+    return claims
+
 @app.on_event("startup")
 async def startup_event():
     """Start Pyrogram client"""
@@ -77,6 +290,18 @@ async def root():
         "features": ["range_requests", "cors_enabled", "high_speed_streaming"]
     }
 
+@app.get("/healthz")
+async def healthz():
+    """Health and load report polled by main.py's streamer fleet monitor"""
+    if not client.is_connected:
+        raise HTTPException(status_code=503, detail="Telegram client not connected")
+    return {
+        "status": "ok",
+        "active_streams": active_streams,
+        "capacity": MAX_STREAMS,
+        "resumes": stream_stats
+    }
+
 @app.options("/stream/{chat_id}/{message_id}")
 async def stream_options(chat_id: str, message_id: int):
     """Handle CORS preflight requests"""
@@ -147,14 +372,15 @@ async def stream_file(chat_id: str, message_id: int, request: Request):
         
         # Get file info
         file_size, mime_type, file_name = get_file_info(message, message_id)
+        ref = {"chat_id": actual_chat_id, "message_id": message_id, "file_id": get_media(message).file_id}
         
         # Handle range requests (critical for video seeking)
         range_header = request.headers.get("range")
         
         if range_header and file_size > 0:
-            return await handle_range_request(message, range_header, file_size, mime_type, file_name)
+            return await handle_range_request(ref, range_header, file_size, mime_type, file_name)
         else:
-            return await handle_full_request(message, file_size, mime_type, file_name)
+            return await handle_full_request(ref, file_size, mime_type, file_name)
         
     except HTTPException:
         raise
@@ -162,7 +388,49 @@ async def stream_file(chat_id: str, message_id: int, request: Request):
         logger.error(f"Stream error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-async def handle_range_request(message, range_header: str, file_size: int, mime_type: str, file_name: str):
+@app.head("/s/{token}")
+@app.head("/s/{token}/{file_name}")
+async def signed_stream_head(token: str, file_name: str = None):
+    """HEAD for signed links - answered from the token alone"""
+    claims = verify_stream_token(token)
+    
+    headers = {
+        "Content-Type": claims["t"],
+        "Content-Length": str(claims["s"]),
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f'inline; filename="{claims["n"]}"',
+        "Access-Control-Allow-Origin": "*",
+        "Access-Control-Expose-Headers": "Content-Length, Content-Range, Accept-Ranges",
+        "Cache-Control": "public, max-age=3600"
+    }
+    
+    return Response(headers=headers)
+
+@app.get("/s/{token}")
+@app.get("/s/{token}/{file_name}")
+async def signed_stream(token: str, request: Request, file_name: str = None):
+    """
+    Stream a signed link from main.py.
+    The token carries the file location, size, MIME and name, so no get_messages call is needed.
+    """
+    claims = verify_stream_token(token)
+    ref = {"chat_id": claims["c"], "message_id": claims["m"], "file_id": claims["f"]}
+    
+    try:
+        range_header = request.headers.get("range")
+        
+        if range_header and claims["s"] > 0:
+            return await handle_range_request(ref, range_header, claims["s"], claims["t"], claims["n"])
+        else:
+            return await handle_full_request(ref, claims["s"], claims["t"], claims["n"])
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Signed stream error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def handle_range_request(ref: Dict, range_header: str, file_size: int, mime_type: str, file_name: str):
     """Handle HTTP 206 range requests for seeking"""
     try:
         # Parse range header
@@ -179,24 +447,17 @@ async def handle_range_request(message, range_header: str, file_size: int, mime_
         
         # Optimized streaming generator
         async def stream_range():
-            bytes_sent = 0
-            chunk_size = min(1024 * 1024, content_length)  # 1MB chunks or remaining
-            
+            global active_streams
+            active_streams += 1
             try:
-                async for chunk in client.stream_media(message, offset=start, limit=content_length):
-                    # Ensure we don't exceed the requested range
-                    if bytes_sent + len(chunk) > content_length:
-                        chunk = chunk[:content_length - bytes_sent]
-                    
+                async for chunk in iter_file(ref, start, end):
                     yield chunk
-                    bytes_sent += len(chunk)
-                    
-                    if bytes_sent >= content_length:
-                        break
                         
             except Exception as e:
                 logger.error(f"Range streaming error: {e}")
                 raise
+            finally:
+                active_streams -= 1
         
         headers = {
             "Content-Range": f"bytes {start}-{end}/{file_size}",
@@ -223,12 +484,15 @@ async def handle_range_request(message, range_header: str, file_size: int, mime_
         logger.error(f"Invalid range: {range_header}")
         raise HTTPException(status_code=416, detail="Range Not Satisfiable")
 
-async def handle_full_request(message, file_size: int, mime_type: str, file_name: str):
+async def handle_full_request(ref: Dict, file_size: int, mime_type: str, file_name: str):
     """Handle full file streaming"""
     async def stream_full():
+        global active_streams
+        active_streams += 1
         try:
             chunk_count = 0
-            async for chunk in client.stream_media(message):
+            # Unknown sizes read until Telegram returns an empty part
+            async for chunk in iter_file(ref, 0, file_size - 1 if file_size > 0 else (1 << 62)):
                 chunk_count += 1
                 # Log progress for large files
                 if chunk_count % 1000 == 0:
@@ -237,6 +501,8 @@ async def handle_full_request(message, file_size: int, mime_type: str, file_name
         except Exception as e:
             logger.error(f"Full streaming error: {e}")
             raise
+        finally:
+            active_streams -= 1
     
     headers = {
         "Content-Type": mime_type,